@@ -0,0 +1,117 @@
+import os
+import logging
+import tempfile
+import numpy as np
+
+from data_ops.batching import collate, get_sample_sizes
+
+'''
+Store of samples padded once per run, reused by every epoch.
+Samples are sorted by number of nodes and split in buckets of as many
+samples. Each bucket is one contiguous zero-padded float32 array of
+(nb_samples, largest_size, nb_features), in memory or memory-mapped.
+Batches are then slices or gathers of rows, trimmed to their largest
+sample, instead of being decoded, padded and converted every epoch.
+'''
+
+
+class BatchStore():
+  '''
+  Padded samples of `X`, indexed as `X`: `store[idx]` is a batch of
+  samples `idx`, `store[:nb]` the store of the first `nb` samples, and
+  `store.take(idx)` the store of samples `idx`
+  '''
+  def __init__(self, X, nb_buckets=8, directory=None, chunk_size=1024):
+    self.nb_nodes = get_sample_sizes(X)
+    order = np.argsort(self.nb_nodes, kind='stable')
+    bounds = np.unique(np.linspace(0, len(order), nb_buckets + 1).astype(int))
+    self.bucket = np.zeros(len(order), dtype=int)
+    self.row = np.zeros(len(order), dtype=int)
+    self.arrays = []
+    for b, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+      samples = order[start:end]
+      self.bucket[samples] = b
+      self.row[samples] = np.arange(len(samples))
+      array = self._allocate(samples, X, directory)
+      for i in range(0, len(samples), chunk_size):
+        batch = collate(_gather(X, samples[i:i+chunk_size]), [], [])[0]
+        array[i:i+len(batch), :batch.shape[1]] = batch
+      self.arrays.append(array)
+
+  def _allocate(self, samples, X, directory):
+    nb_features = collate(_gather(X, samples[:1]), [], [])[0].shape[2]
+    shape = (len(samples), int(self.nb_nodes[samples].max()), nb_features)
+    if directory is None:
+      return np.zeros(shape, dtype=np.float32)
+    # The file is removed once mapped: its pages live as long as the
+    # mapping, and nothing is left on disk by runs which do not exit cleanly
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(fd)
+    array = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+    os.remove(path)
+    return array
+
+  def take(self, idx):
+    '''Store of samples `idx`, sharing the padded arrays'''
+    store = BatchStore.__new__(BatchStore)
+    store.nb_nodes = self.nb_nodes[idx]
+    store.bucket = self.bucket[idx]
+    store.row = self.row[idx]
+    store.arrays = self.arrays
+    return store
+
+  def __len__(self):
+    return len(self.nb_nodes)
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      return self.take(np.arange(len(self))[idx])
+    return StoredBatch(self, np.asarray(idx))
+
+  def nbytes(self):
+    return sum(array.nbytes for array in self.arrays)
+
+
+class StoredBatch():
+  '''Samples `idx` of a `BatchStore`, padded when collated'''
+  def __init__(self, store, idx):
+    self.store = store
+    self.idx = idx
+    self.nb_nodes = store.nb_nodes[idx]
+
+  def __len__(self):
+    return len(self.idx)
+
+  def padded(self, largest_size):
+    '''
+    (B, largest_size, F) zero-padded batch. Always a copy, as layers
+    may modify their input in place. Batches of consecutive rows of a
+    bucket, as sorted batches are, copy a single slice
+    '''
+    buckets = self.store.bucket[self.idx]
+    rows = self.store.row[self.idx]
+    width = min(largest_size, int(self.nb_nodes.max()))
+    first = self.store.arrays[buckets[0]]
+    batch = np.zeros((len(self.idx), largest_size, first.shape[2]), dtype=np.float32)
+    if (buckets == buckets[0]).all() and (np.diff(rows) == 1).all():
+      batch[:, :width] = first[rows[0]:rows[-1]+1, :width]
+      return batch
+    order = np.argsort(buckets, kind='stable')
+    for group in np.split(order, np.flatnonzero(np.diff(buckets[order])) + 1):
+      array = self.store.arrays[buckets[group[0]]]
+      bucket_width = min(width, array.shape[1])
+      batch[group, :bucket_width] = array[rows[group], :bucket_width]
+    return batch
+
+
+def _gather(X, idx):
+  # Event stores gather a whole batch from an index array
+  if hasattr(X, 'node_rows'):
+    return X[idx]
+  return [X[s] for s in idx]
+
+
+def log_store(store, name):
+  real = 4. * store.nb_nodes.sum() * store.arrays[0].shape[2] if len(store) else 0.
+  logging.info('{} batch store: {:.1f} MB in {} buckets, {:.1f}% real nodes'.format(
+                name, store.nbytes() / 2**20, len(store.arrays), 100 * real / (store.nbytes() + 10**-20)))
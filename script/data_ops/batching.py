@@ -8,34 +8,154 @@ def _divide_batch(nb_samples_in, batch_size, idx):
   for i in range(0,nb_batches*batch_size, batch_size):
     idx_list.append(idx[i:i+batch_size])
   return idx_list
-  
 
-def _get_unsorted_batches(nb_samples_in, batch_size, shuffle_batch=False):
+
+def batch_cost(nb_samples, largest_size, cost='edges'):
+  '''Padded work of a batch: B * N_max^2 for `edges`, B * N_max for `nodes`'''
+  return nb_samples * largest_size ** (2 if cost == 'edges' else 1)
+
+
+def divide_budget(idx, sample_sizes, node_budget, cost='edges'):
+  '''
+  Groups indices `idx`, in order, into batches whose padded work
+  `batch_cost` stays within `node_budget`. Samples over budget get a
+  batch of their own. The last batch is kept, even if small
+  '''
+  exponent = 2 if cost == 'edges' else 1
+  sizes = np.asarray(sample_sizes)[np.asarray(idx, dtype=int)].tolist()
+  idx_list = []
+  start, largest = 0, 0
+  for i, size in enumerate(sizes):
+    largest_with = max(largest, size)
+    if i > start and (i - start + 1) * largest_with ** exponent > node_budget:
+      idx_list.append(idx[start:i])
+      start, largest_with = i, size
+    largest = largest_with
+  if start < len(sizes):
+    idx_list.append(idx[start:])
+  return idx_list
+
+
+def _divide(idx, batch_size, sample_sizes=None, node_budget=0, cost='edges'):
+  if node_budget > 0:
+    return divide_budget(idx, sample_sizes, node_budget, cost)
+  return _divide_batch(len(idx), batch_size, idx)
+
+
+def block_shuffle(nb_samples, block_size, window):
+  '''
+  Random order of samples which keeps reads local on disk.
+  Blocks of `block_size` consecutive samples are visited in random order,
+  then samples are shuffled within windows of `window` consecutive positions
+  '''
+  starts = np.random.permutation(np.arange(0, nb_samples, block_size))
+  idx = np.arange(nb_samples)
+  if len(starts) > 0:
+    idx = np.concatenate([np.arange(s, min(s+block_size, nb_samples)) for s in starts])
+  window = max(window, 1)
+  for i in range(0, nb_samples, window):
+    np.random.shuffle(idx[i:i+window])
+  return idx
+
+
+def _get_unsorted_batches(nb_samples_in, batch_size, shuffle_batch=False, block_size=0, window=0, divide=None):
   # Note: The operator // is floor division
+  divide = divide or (lambda idx: _divide_batch(len(idx), batch_size, idx))
+  if shuffle_batch == True and block_size > 0:
+    return divide(block_shuffle(nb_samples_in, block_size, window))
   idx = list(range(nb_samples_in))
   if (shuffle_batch==True):
     shuffle(idx)
-  return _divide_batch(nb_samples_in, batch_size, idx)
+  return divide(idx)
+
+
+def get_sample_sizes(X):
+  '''
+  Number of nodes of each sample, read from the event store
+  index when available instead of looping over samples
+  '''
+  if hasattr(X, 'nb_nodes'):
+    return np.asarray(X.nb_nodes)
+  return np.array([sample.shape[1] for sample in X], dtype=int)
 
 
-def get_batches(nb_samples_in,batch_size,X,shuffle_batch=False,sort_batch=False):
+def bucket_batches(idx, sample_sizes, batch_size, nb_buckets, node_budget=0, cost='edges'):
+  '''
+  Randomized length-bucketed batches of samples `idx`.
+  Samples are split in `nb_buckets` buckets of node counts holding as many
+  samples each, shuffled within buckets, and batched per bucket. Left over
+  samples of all buckets are batched together. Batches are then shuffled.
+  With `node_budget` > 0, buckets are split by `divide_budget` instead
+  '''
+  idx = np.asarray(idx)
+  sizes = np.asarray(sample_sizes)[idx]
+  edges = np.unique(np.percentile(sizes, np.linspace(0, 100, nb_buckets + 1)[1:-1])) if len(idx) else []
+  buckets = np.searchsorted(edges, sizes, side='right')
+
+  idx_list = []
+  leftover = []
+  for bucket in range(len(edges) + 1):
+    in_bucket = np.random.permutation(idx[buckets == bucket])
+    if node_budget > 0:
+      idx_list += divide_budget(in_bucket, sample_sizes, node_budget, cost)
+      continue
+    nb_full = (len(in_bucket) // batch_size) * batch_size
+    idx_list += _divide_batch(nb_full, batch_size, in_bucket)
+    leftover.append(in_bucket[nb_full:])
+  leftover = np.random.permutation(np.concatenate(leftover)) if leftover else np.zeros(0, dtype=int)
+  idx_list += _divide_batch(len(leftover), batch_size, leftover)
+  shuffle(idx_list)
+  return idx_list
+
+
+def padding_efficiency(idx_list, sample_sizes, nb_extra_nodes=0):
+  '''Fraction of real nodes among all nodes of padded batches'''
+  sample_sizes = np.asarray(sample_sizes)
+  real, padded = 0, 0
+  for idx in idx_list:
+    sizes = sample_sizes[np.asarray(idx)]
+    real += sizes.sum()
+    padded += len(sizes) * (sizes.max() + nb_extra_nodes)
+  return real / (padded + 10**-20)
+
+
+def get_batches(nb_samples_in,batch_size,X,shuffle_batch=False,sort_batch=False,block_size=0,window=0,subset=None,nb_buckets=0,node_budget=0,cost='edges'):
   '''
   Gets batches for testing sets, grouping together
   batches of similar size.
   This allows speedup in testing, where sample
   order doesn't matter.
+  With `block_size` > 0, unsorted batches are shuffled with `block_shuffle`
+  With `subset`, sorted sample indices, only these samples are batched
+  With `nb_buckets` > 0, unsorted shuffled batches come from `bucket_batches`
+  With `node_budget` > 0, batch sizes vary so that the padded work of each
+  batch stays within budget, see `divide_budget`
   '''
+  sample_sizes = get_sample_sizes(X) if node_budget > 0 or sort_batch or nb_buckets > 0 else None
+  divide = lambda idx: _divide(idx, batch_size, sample_sizes, node_budget, cost)
+
+  if shuffle_batch == True and sort_batch == False and nb_buckets > 0:
+    idx = np.arange(nb_samples_in) if subset is None else np.asarray(subset)
+    return bucket_batches(idx, sample_sizes, batch_size, nb_buckets, node_budget, cost)
+
+  if subset is not None and sort_batch == False:
+    subset = np.asarray(subset)
+    divide_subset = lambda idx: divide(subset[idx])
+    return _get_unsorted_batches(len(subset), batch_size, shuffle_batch, block_size, window, divide_subset)
+
   if sort_batch == False:
-    return _get_unsorted_batches(nb_samples_in, batch_size, shuffle_batch)
+    return _get_unsorted_batches(nb_samples_in, batch_size, shuffle_batch, block_size, window, divide)
 
   # Sort samples by nb_nodes
-  sample_sizes = np.zeros(nb_samples_in)
-  for i, sample in enumerate(X):
-    sample_sizes[i] = sample.shape[1]
-  sm_to_lg = np.argsort(sample_sizes)
+  if subset is not None:
+    subset = np.asarray(subset)
+    nb_samples_in = len(subset)
+    sm_to_lg = subset[np.argsort(sample_sizes[subset], kind='stable')]
+  else:
+    sm_to_lg = np.argsort(sample_sizes[:nb_samples_in], kind='stable')
 
   # Get batches
-  idx_list = _divide_batch(nb_samples_in, batch_size, sm_to_lg)
+  idx_list = divide(sm_to_lg)
 
   # Optionally shuffle order of batches
   if shuffle_batch == True:
@@ -43,26 +163,122 @@ def get_batches(nb_samples_in,batch_size,X,shuffle_batch=False,sort_batch=False)
   return idx_list
 
 
-def pad_batch(X, nb_extra_nodes=0):
-  nb_samples = len(X)
-  nb_features = X[0].shape[0]
+def alias_table(weights):
+  '''
+  Alias table (prob, alias) of Vose's method, for drawing
+  samples with probability proportional to `weights` in O(1)
+  '''
+  weights = np.asarray(weights, dtype=np.float64)
+  if len(weights) == 0 or weights.min() < 0 or weights.sum() <= 0:
+    raise ValueError('Sampling weights should be non-negative with a positive sum')
+  nb = len(weights)
+  scaled = (weights * nb / weights.sum()).tolist()
+  prob = np.ones(nb)
+  alias = np.arange(nb)
+  small = [i for i, p in enumerate(scaled) if p < 1]
+  large = [i for i, p in enumerate(scaled) if p >= 1]
+  while small and large:
+    s, l = small.pop(), large.pop()
+    prob[s] = scaled[s]
+    alias[s] = l
+    scaled[l] -= 1 - scaled[s]
+    if scaled[l] < 1:
+      small.append(l)
+    else:
+      large.append(l)
+  # Left over entries are 1 up to rounding errors
+  return prob, alias
+
+
+def sample_alias(table, nb_draws):
+  '''Draws `nb_draws` indices, with replacement, from an alias table'''
+  prob, alias = table
+  idx = np.random.randint(0, len(prob), nb_draws)
+  return np.where(np.random.random_sample(nb_draws) < prob[idx], idx, alias[idx])
+
+
+def effective_sample_size(weights):
+  '''Number of equally weighted samples worth as much as `weights`'''
+  weights = np.asarray(weights, dtype=np.float64)
+  return weights.sum()**2 / ((weights**2).sum() + 10**-20)
+
+
+def get_sampled_batches(nb_samples_in, batch_size, X, table, sort_batch=False, subset=None, nb_buckets=0,
+                        node_budget=0, cost='edges'):
+  '''
+  Batches of samples drawn from alias `table`, as many as
+  `get_batches` would give. Indices are sorted within each
+  batch, or across all batches with `sort_batch`, for local reads.
+  With `subset`, draws outside of it are dropped.
+  With `nb_buckets` > 0, draws are batched by `bucket_batches`.
+  With `node_budget` > 0, batches are split by `divide_budget`
+  '''
+  idx = sample_alias(table, (nb_samples_in // batch_size) * batch_size)
+  if subset is not None:
+    idx = idx[np.isin(idx, subset)]
+  sample_sizes = get_sample_sizes(X)
+  if sort_batch == False and nb_buckets > 0:
+    idx_list = bucket_batches(idx, sample_sizes, batch_size, nb_buckets, node_budget, cost)
+    return [np.sort(batch) for batch in idx_list]
+  if sort_batch == True:
+    idx = idx[np.argsort(sample_sizes[idx], kind='stable')]
+  idx_list = [np.sort(batch) for batch in _divide(idx, batch_size, sample_sizes, node_budget, cost)]
+  if sort_batch == True:
+    shuffle(idx_list)
+  return idx_list
+
+
+def _pack(X, sample_sizes, nb_extra_nodes=0):
+  # Nodes of all samples, each followed by `nb_extra_nodes` zero nodes
+  if hasattr(X, 'node_rows'):
+    nodes = X.codec.decode(np.asarray(X.features[X.node_rows()]))
+  else:
+    nodes = np.concatenate([sample.transpose() for sample in X]).astype(np.float32, copy=False)
+  if nb_extra_nodes == 0:
+    return np.ascontiguousarray(nodes, dtype=np.float32)
+  batch = np.zeros((len(nodes) + nb_extra_nodes * len(sample_sizes), nodes.shape[1]), dtype=np.float32)
+  extra_before = nb_extra_nodes * np.repeat(np.arange(len(sample_sizes)), sample_sizes)
+  batch[np.arange(len(nodes)) + extra_before] = nodes
+  return batch
+
+
+def collate(X, y, w, nb_extra_nodes=0, packed=False):
+  '''
+  Gathers samples into one zero-padded, contiguous float32 (B, N, F) array,
+  the layout fed to the model. `X` is a list of (nb_features, nb_nodes)
+  samples, or an EventList whose nodes are all read and decoded at once.
+  Returns the batch, sample sizes, labels and weights as arrays. Padded
+  nodes are masked by the model from sample sizes alone.
+  With `packed`, the batch is instead a (nb_nodes_total, F) array of the
+  nodes of all samples, without padding (see `utils.packed`).
+  `X` may also be a batch of a `data_ops.batch_store.BatchStore`
+  '''
+  sample_sizes = get_sample_sizes(X).astype(np.int64)
+  nb_samples = len(sample_sizes)
+  largest_size = int(sample_sizes.max()) + nb_extra_nodes
 
-  largest_size = 0
-  sample_sizes = np.zeros(nb_samples,dtype=int)
-  for i, sample in enumerate(X):
-    sample_sizes[i] = sample.shape[1]
-    largest_size = max(largest_size, sample_sizes[i])
+  if hasattr(X, 'padded'):
+    # Batches of a `BatchStore` are already decoded and padded
+    batch = X.padded(largest_size)
+    if packed:
+      batch = batch[np.arange(largest_size) < (sample_sizes + nb_extra_nodes)[:, None]]
+  elif packed:
+    batch = _pack(X, sample_sizes, nb_extra_nodes)
+  elif hasattr(X, 'node_rows'):
+    # Scatter all nodes of the batch at once
+    nodes = X.codec.decode(np.asarray(X.features[X.node_rows()]))
+    batch = np.zeros((nb_samples, largest_size, nodes.shape[1]), dtype=np.float32)
+    first_rows = np.repeat(np.cumsum(sample_sizes) - sample_sizes, sample_sizes)
+    batch[np.repeat(np.arange(nb_samples), sample_sizes),
+          np.arange(len(nodes)) - first_rows] = nodes
+  else:
+    batch = np.zeros((nb_samples, largest_size, X[0].shape[0]), dtype=np.float32)
+    for i, sample in enumerate(X):
+      batch[i, :sample_sizes[i]] = sample.transpose()
 
-  largest_size += nb_extra_nodes
-  pad_sizes = largest_size - sample_sizes 
   sample_sizes += nb_extra_nodes
-  mask = np.zeros(shape=(nb_samples, largest_size, largest_size))
-  # Pad samples with zeros
-  for i in range(nb_samples):
-    zeros = np.zeros(shape=(nb_features, pad_sizes[i]))
-    X[i] = np.concatenate((X[i], zeros),axis=1)
-    mask[i,:sample_sizes[i],:sample_sizes[i]] = 1
-  return X, mask, sample_sizes
+  return (batch, sample_sizes,
+          np.asarray(y, dtype=np.float32), np.asarray(w, dtype=np.float32))
 
 if __name__ == "__main__":
   n = 10
@@ -0,0 +1,43 @@
+import numpy as np
+
+'''
+Graph-size curriculum: early epochs train only on samples with at most
+`node_cap` nodes, a cap growing over epochs until all samples are used.
+Kernels cost O(N^2) per sample, so small graphs make early epochs cheaper.
+'''
+
+schedules = ['linear', 'geometric']
+
+
+def node_cap(epoch, start, nb_epochs, largest, schedule='linear'):
+  '''
+  Node cap of `epoch`, growing from `start` nodes at epoch 0 to `largest`
+  at epoch `nb_epochs`. Returns None once samples are no longer capped
+  '''
+  if start <= 0 or epoch >= nb_epochs or start >= largest:
+    return None
+  progress = epoch / float(nb_epochs)
+  if schedule == 'linear':
+    cap = start + (largest - start) * progress
+  elif schedule == 'geometric':
+    cap = start * (largest / float(start)) ** progress
+  else:
+    raise ValueError('Curriculum schedule should be one of {}'.format(schedules))
+  return int(cap)
+
+
+def capped_subset(sample_sizes, cap):
+  '''Indices of samples with at most `cap` nodes'''
+  return np.where(np.asarray(sample_sizes) <= cap)[0]
+
+
+def compute_saved(sample_sizes, cap):
+  '''
+  Fraction of samples kept under `cap`, and fraction of the
+  O(N^2) compute of a full epoch saved by leaving out the others
+  '''
+  sample_sizes = np.asarray(sample_sizes, dtype=np.float64)
+  kept = sample_sizes <= cap
+  cost = (sample_sizes ** 2).sum()
+  saved = 1 - (sample_sizes[kept] ** 2).sum() / (cost + 10**-20)
+  return kept.mean() if len(kept) else 1., saved
@@ -0,0 +1,86 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+_done = object()  # queued by the producer after the last batch
+
+
+class Prefetcher(object):
+  '''
+  Iterates over make_batch(b) for b in batches.
+  A producer thread advances `batches`, which reads samples from disk when
+  streaming, and hands each batch to a pool of `nb_workers` threads
+  preparing it. Up to `depth` upcoming batches are queued while the
+  current one is used, so that reads and preparation overlap with
+  training. Threads share memory with the trainer, so prepared tensors
+  are handed over without copy.
+  With depth 0, batches are read and prepared synchronously.
+  Time spent waiting for batches is accumulated in `wait_time`.
+  '''
+  def __init__(self, batches, make_batch, depth=0, nb_workers=1):
+    self.batches = batches
+    self.make_batch = make_batch
+    self.depth = depth
+    self.nb_workers = max(1, nb_workers)
+    self.wait_time = 0.0
+
+  def _iter_sync(self):
+    batches = iter(self.batches)
+    while True:
+      t0 = time.time()
+      batch = next(batches, _done)
+      if batch is _done:
+        return
+      prepared = self.make_batch(batch)
+      self.wait_time += time.time() - t0
+      yield prepared
+
+  def _produce(self, executor, pending, stop):
+    try:
+      for batch in self.batches:
+        if not _put(pending, executor.submit(self.make_batch, batch), stop):
+          return
+    except Exception as e:
+      # Raised in the trainer, in order
+      failed = Future()
+      failed.set_exception(e)
+      _put(pending, failed, stop)
+    _put(pending, _done, stop)
+
+  def __iter__(self):
+    if self.depth <= 0:
+      for prepared in self._iter_sync():
+        yield prepared
+      return
+
+    pending = queue.Queue(self.depth)
+    stop = threading.Event()
+    with ThreadPoolExecutor(self.nb_workers) as executor:
+      producer = threading.Thread(target=self._produce, args=(executor, pending, stop), daemon=True)
+      producer.start()
+      try:
+        while True:
+          t0 = time.time()
+          future = pending.get()
+          if future is _done:
+            break
+          prepared = future.result()
+          self.wait_time += time.time() - t0
+          yield prepared
+      finally:
+        # Also when the trainer stops early
+        stop.set()
+        producer.join()
+
+
+def _put(pending, item, stop):
+  '''Queues `item` unless the trainer stopped. Returns whether it was queued'''
+  while not stop.is_set():
+    try:
+      pending.put(item, timeout=0.1)
+      return True
+    except queue.Full:
+      pass
+  return False
@@ -1,13 +1,14 @@
 import logging
-import pickle
 import time
 import torch
 import torch.nn as nn
 import os.path as path
 
 import train_model as model
+import data_ops.curriculum as curriculum
 import loading.model.model_parameters as param
 from loading.model import get_model
+from loading.model.checkpoint import CheckpointWriter, checkpoint_path, make_checkpoint
 from graphics.roccurve import ROCCurve
 
 
@@ -15,7 +16,7 @@ def train_model(train_X, train_y, train_w, test_X, test_y, test_w):
   """Loads data, recover network then train, test and save network"""
 
 
-  net = get_model.make_net_if_not_there(
+  net, checkpoint = get_model.make_net_if_not_there(
                                         param.args, 
                                         param.args.savedir
                                         )
@@ -30,19 +31,70 @@ def train_model(train_X, train_y, train_w, test_X, test_y, test_w):
 
   criterion = nn.functional.binary_cross_entropy
 
+  # A single optimizer keeps its moment estimates over epochs and resumes
+  optimizer = torch.optim.Adamax(net.parameters(), lr=param.args.lrate)
+
   # Track best model performance
   param.args.bestInvFpr = 0.0
   param.args.bestAuc = 0.0
+  start_epoch = 0
+  if checkpoint is not None:
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    param.args.lrate = checkpoint['lrate']
+    param.args.bestInvFpr = checkpoint['best_inv_fpr']
+    param.args.bestAuc = checkpoint['best_auc']
+    start_epoch = checkpoint['epoch']
+  writer = CheckpointWriter()
+  try:
+    _train_epochs(net, optimizer, writer, start_epoch, criterion,
+                  train_X, train_y, train_w, test_X, test_y, test_w)
+  finally:
+    writer.close()
+
+
+def _train_epochs(net, optimizer, writer, start_epoch, criterion,
+                  train_X, train_y, train_w, test_X, test_y, test_w):
+  """Trains and tests from epoch `start_epoch` to --nbepoch"""
 
   # Set up roc plotting
   zooms = [1., 0.01, 0.001, 0.0001]
-  roc_train = ROCCurve("train", zooms=zooms)
+  # Only online metrics subsample predictions, tests on --nbtest training samples keep them all
+  reservoir = param.args.train_metrics_reservoir if param.args.online_train_metrics else 0
+  roc_train = ROCCurve("train", zooms=zooms, reservoir=reservoir)
+  roc_online = roc_train if param.args.online_train_metrics else None
   roc_test  = ROCCurve("test", zooms=zooms)
 
-  for epoch in range(param.args.nbepoch):
+  # Samples are padded once, and batches served from stores every epoch
+  if param.args.batch_store:
+    train_X = model.get_batch_store(train_X, 'train')
+    test_X = model.get_batch_store(test_X, 'test')
+
+  # Train metrics are computed on the same random training subset every epoch
+  if not param.args.online_train_metrics:
+    subset_X, subset_y, subset_w = model.get_train_subset(train_X, train_y, train_w, param.args.nbtest)
+
+  # Draw training events by weight instead of weighting their loss
+  sampling = None
+  if param.args.weight_sampling:
+    sampling = model.get_sampling_table(train_w)
+
+  # Graph-size curriculum caps the number of nodes of early epochs' samples
+  largest = 0
+  if param.args.curriculum_start > 0:
+    largest = int(model.get_sample_sizes(train_X).max())
+
+  for epoch in range(start_epoch, param.args.nbepoch):
     t0 = time.time()
     logging.info('\nLearning rate: {0:.3g}'.format(param.args.lrate))
-    optimizer = torch.optim.Adamax(net.parameters(), lr=param.args.lrate)
+    for group in optimizer.param_groups:
+      group['lr'] = param.args.lrate
+    node_cap = curriculum.node_cap(
+                                   epoch,
+                                   param.args.curriculum_start,
+                                   param.args.curriculum_epochs,
+                                   largest,
+                                   param.args.curriculum_schedule
+                                   )
 
     epoch_loss_avg = model.train_net(
                                       net, 
@@ -50,20 +102,26 @@ def train_model(train_X, train_y, train_w, test_X, test_y, test_w):
                                       train_y, 
                                       train_w, 
                                       criterion, 
-                                      optimizer
+                                      optimizer,
+                                      sampling,
+                                      node_cap,
+                                      roc_online
                                       )
     param.args.lrate *= param.args.lrdecay
     logging.info(param.args.name+' loss epoch {} : {}'.format(epoch+1,epoch_loss_avg))
 
-    # Model performance on subset of training data, test data
-    auc_train, loss_train, fpr_train, roc_train = model.test_net(
-                                                      net, 
-                                                      train_X[:param.args.nbtest],
-                                                      train_y[:param.args.nbtest],
-                                                      train_w[:param.args.nbtest],
-                                                      criterion,
-                                                      roc_train
-                                                      )
+    # Model performance on training data, seen while training or on a subset, and test data
+    if param.args.online_train_metrics:
+      auc_train, loss_train, fpr_train, roc_train = model.online_metrics(roc_train, epoch_loss_avg)
+    else:
+      auc_train, loss_train, fpr_train, roc_train = model.test_net(
+                                                        net, 
+                                                        subset_X,
+                                                        subset_y,
+                                                        subset_w,
+                                                        criterion,
+                                                        roc_train
+                                                        )
     auc_test, loss_test, fpr_test, roc_test = model.test_net(
                                                       net, 
                                                       test_X, 
@@ -101,7 +159,9 @@ def train_model(train_X, train_y, train_w, test_X, test_y, test_w):
       roc_train.plot_roc_curve()
       roc_test.plot_roc_curve()
       if (param.args.save_best_model):
-        save_model(net)
+        save_model(net, optimizer, epoch + 1, writer, best=True)
+    if param.args.checkpoint:
+      save_model(net, optimizer, epoch + 1, writer)
 
     logging.info("Epoch took {} seconds\n".format(int(time.time()-t0)))
 
@@ -114,15 +174,22 @@ def print_epoch_info(epoch, name, loss, auc, invFpr):
       + ' -- 1/FPR {: >.3E}'.format(invFpr)
   )
 
-def save_model(net):
+def save_model(net, optimizer, nb_epochs_done, writer, best=False):
+  '''
+  Checkpoints training after `nb_epochs_done` epochs. State dicts are
+  copied to cpu, and written by `writer` while training goes on
+  '''
+  checkpoint = make_checkpoint(
+                               net,
+                               optimizer,
+                               nb_epochs_done,
+                               param.args.lrate,
+                               param.args.bestInvFpr,
+                               param.args.bestAuc
+                               )
+  writer.save(checkpoint, checkpoint_path(param.args.savedir, param.args.name, best))
   try:
-    with open(path.join(param.args.savedir, param.args.name + '.pkl'), 'wb') as fileout:
-      # net -> cpu in case later running without cuda
-      pickle.dump(net.cpu(), fileout)
-      if (param.args.cuda):
-        net.cuda()
-    logging.warning('Model saved')
     param.save_args()
   except:
-    logging.error("Issue saving model or model parameters")
+    logging.error("Issue saving model parameters")
     exit()
@@ -1,5 +1,6 @@
 import logging
 from os.path import join
+import numpy as np
 import matplotlib; matplotlib.use('Agg')  # no display on clusters 
 import matplotlib.pyplot as plt
 from sklearn.metrics import roc_auc_score, roc_curve
@@ -82,10 +83,14 @@ def _get_fpr(gt, pred, weights, p=0.5):
 
 
 class ROCCurve():
-  """ROC curve like statistics"""
+  """ROC curve like statistics.
+  With `reservoir` > 0, a uniform subsample of at most `reservoir`
+  samples is kept instead of all of them, bounding memory
+  """
 
-  def __init__(self, type_, zooms=[1.0], p=0.5):
+  def __init__(self, type_, zooms=[1.0], p=0.5, reservoir=0):
     self.zooms = zooms
+    self.reservoir = reservoir
     self.type_ = type_
     self.name = param.args.name
     self.savedir = param.args.savedir
@@ -99,15 +104,43 @@ class ROCCurve():
     self.gt = []
     self.pred = []
     self.weights = []
+    self.nb_seen = 0
 
   def update(self, output, label, weights=None):
     """adds predictions to ROC curve buffer"""
 
-    self.gt.extend([int(l) for l in label])
-    self.pred.extend(output)
+    # Buffered as python numbers, converted once per batch
+    gt = label.cpu().numpy().astype(int).tolist()
+    pred = output.detach().cpu().numpy().tolist()
+    if weights is not None:
+      weights = weights.cpu().numpy().tolist()
+    if self.reservoir > 0:
+      self._sample(gt, pred, weights)
+      return
+    self.gt.extend(gt)
+    self.pred.extend(pred)
     if weights is not None:
       self.weights.extend(weights)
 
+  def _sample(self, gt, pred, weights):
+    # Reservoir sampling: the i-th sample seen replaces a kept one with probability reservoir / i
+    for i in range(len(gt)):
+      self.nb_seen += 1
+      if len(self.gt) < self.reservoir:
+        slot = len(self.gt)
+        self.gt.append(None)
+        self.pred.append(None)
+        if weights is not None:
+          self.weights.append(None)
+      else:
+        slot = np.random.randint(self.nb_seen)
+        if slot >= self.reservoir:
+          continue
+      self.gt[slot] = gt[i]
+      self.pred[slot] = pred[i]
+      if weights is not None:
+        self.weights[slot] = weights[i]
+
   def score_auc(self, is_weighted=True):
     """returns Area Under Curve for data in buffer"""
 
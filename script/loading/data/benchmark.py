@@ -0,0 +1,392 @@
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from os.path import exists, join
+import numpy as np
+import h5py as h5
+
+
+"""Data loading benchmark on synthetic data.
+
+Generates events shaped like NYU, NERSC and ICECUBE data, written in the
+formats read by the loaders, and measures for each storage dtype:
+  - build  : first load, converting raw data into an event store
+  - full   : load of all events from the store, reading each of them once
+  - subset : load of a random tenth of the events, reading each of them once
+  - stream : one pass over a streamed dataset
+  - batch  : collating all loaded events into padded batches
+and, to attribute load time, each stage of loading on its own:
+  - pickle_decode : unpickling raw NYU and ICECUBE files
+  - h5_open       : opening raw NERSC files and looking up each event
+  - h5_read       : reading fields of all events from NERSC files
+  - transpose     : transposing raw events into (nb_features, nb_nodes)
+  - decode        : decoding stored features into float32
+  - pad           : zero-padding decoded events into batches
+Each measurement runs in a fresh process, reporting events/s, MB/s of
+decoded float32 features and peak RSS, and is repeated to keep the fastest
+run. Results are written as JSON, and compared to a baseline file if given.
+Run from `script/` as
+  python -m loading.data.benchmark --out bench.json [--baseline baseline.json]
+"""
+
+formats = {
+           'NYU': 'pickle',
+           'NERSC': 'raw_h5',
+           'NERSC_converted': 'converted_h5',
+           'ICECUBE': 'pickle',
+           }
+scenarios = ['build', 'full', 'subset', 'stream', 'batch']
+stages = {
+          'pickle': ['pickle_decode', 'transpose', 'decode', 'pad'],
+          'raw_h5': ['h5_open', 'h5_read', 'decode', 'pad'],
+          'converted_h5': ['h5_read', 'decode', 'pad'],
+          }
+
+
+def _sizes(rng, nb_events, mean_nodes):
+    return 1 + rng.poisson(mean_nodes - 1, nb_events)
+
+
+def make_nyu(datadir, nb_events, rng):
+    """Pickle of (data, label), data being (nb_nodes, 9) arrays of
+    p, eta, phi, E, pt, theta, px, py, pz"""
+
+    data = []
+    for n in _sizes(rng, nb_events, 40):
+        pt = rng.exponential(20, n)
+        eta, phi = rng.normal(0, 0.3, n), rng.normal(0, 0.3, n)
+        p = pt * np.cosh(eta)
+        theta = 2 * np.arctan(np.exp(-eta))
+        data.append(np.stack([p, eta, phi, p, pt, theta,
+                              pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)], axis=1))
+    label = rng.randint(0, 2, nb_events)
+    path = join(datadir, 'train.pickle')
+    with open(path, 'wb') as fileout:
+        pickle.dump((data, label), fileout, protocol=2)
+    return path
+
+
+def make_nersc(datadir, nb_events, rng, nb_files=4):
+    """Raw NERSC files of GG and QCD events, with their `DelphesNevents`"""
+
+    per_file = nb_events // (2 * nb_files)
+    for filetype in ['GG', 'QCD']:
+        for k in range(nb_files):
+            with h5.File(join(datadir, '{}_{:03d}_02.h5'.format(filetype, k)), 'w') as fileout:
+                fileout.attrs['nb_event'] = per_file
+                for i, n in enumerate(_sizes(rng, per_file, 60)):
+                    event = fileout.create_group('event_{}'.format(i))
+                    event['clusE'] = rng.exponential(5000, n)
+                    event['clusEta'] = rng.uniform(-2.5, 2.5, n)
+                    event['clusPhi'] = rng.uniform(-np.pi, np.pi, n)
+                    event['clusEM'] = rng.exponential(2000, n)
+                    event['weight'] = rng.exponential(1.)
+    with open(join(datadir, 'DelphesNevents'), 'w') as fileout:
+        fileout.write('Delphes_GG {}\nDelphes_QCD {}\n'.format(per_file * nb_files, per_file * nb_files))
+    return datadir
+
+
+def make_icecube(datadir, nb_events, rng):
+    """Pickle of (X, y, weights), X being (nb_hits, 6) arrays whose
+    first 3 features are positions of modules on a fixed grid"""
+
+    modules = rng.uniform(-500, 500, (5160, 3))
+    X = []
+    for n in _sizes(rng, nb_events, 30):
+        hits = modules[rng.randint(0, len(modules), n)]
+        X.append(np.concatenate((hits, rng.exponential(1, (n, 3))), axis=1))
+    path = join(datadir, 'train.pickle')
+    with open(path, 'wb') as fileout:
+        pickle.dump((X, rng.randint(0, 2, nb_events), rng.exponential(1, nb_events)), fileout)
+    return path
+
+
+def make_datasets(workdir, nb_events, seed=0):
+    """Writes synthetic raw data of each dataset, returns their paths"""
+
+    rng = np.random.RandomState(seed)
+    paths = {}
+    for name, make in [('NYU', make_nyu), ('NERSC', make_nersc), ('ICECUBE', make_icecube)]:
+        datadir = join(workdir, name)
+        os.makedirs(datadir)
+        paths[name] = make(datadir, nb_events, rng)
+
+    # NERSC files converted by `prepare_data_nersc`
+    from loading.data.nersc.prepare_data_nersc import _create_dataset
+    from loading.data.nersc.file2weightfactor import init_weight_factors
+    from loading.data.nersc.manifest import is_train_file
+    converted = join(workdir, 'NERSC_converted')
+    os.makedirs(converted)
+    weight_factors = init_weight_factors(is_train_file, paths['NERSC'])
+    _create_dataset(paths['NERSC'], join(converted, 'data_train.h5'), is_train_file,
+                    weight_factors, lambda string: None, None)
+    paths['NERSC_converted'] = converted
+    return paths
+
+
+def _copy_raw(src, dst):
+    """Links raw data into a fresh directory, so that each storage dtype builds its own store"""
+
+    if os.path.isdir(src):
+        os.makedirs(dst)
+        for name in os.listdir(src):
+            if name.endswith('.h5') or name == 'DelphesNevents':
+                os.symlink(join(src, name), join(dst, name))
+        return dst
+    os.makedirs(dst)
+    path = join(dst, os.path.basename(src))
+    os.symlink(src, path)
+    return path
+
+
+def _current_rss_mb():
+    with open('/proc/self/statm') as filein:
+        return int(filein.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def _loader(dataset):
+    import loading.data.nyu.load_data as nyu
+    import loading.data.nersc.load_data as nersc
+    import loading.data.icecube.load_data as icecube
+
+    if dataset == 'NYU':
+        return (lambda path, nb: nyu.load_raw_data(path, nb, 'train'),
+                lambda path, nb: nyu.stream_raw_data(path, nb, 'train'))
+    if dataset in ['NERSC', 'NERSC_converted']:
+        return (lambda path, nb: nersc.load_raw_data(path, nb, 'train'),
+                lambda path, nb: nersc.stream_raw_data(path, nb, 'train'))
+    return icecube.load_raw_data, icecube.stream_raw_data
+
+
+def run_scenario(spec):
+    """Runs one measurement, in a fresh process"""
+
+    import loading.model.model_parameters as param
+    import loading.model.read_args as ra
+    from data_ops.batching import collate
+
+    param.args = ra.read_args(['--storage_dtype', spec['storage_dtype']])
+    load, stream = _loader(spec['dataset'])
+    path, scenario = spec['path'], spec['scenario']
+    nb_all = 2**62
+    rss_start = _current_rss_mb()
+
+    t0 = time.time()
+    if scenario == 'stream':
+        data, _, _ = stream(path, nb_all)
+        events = (x for x, _, _ in data.events(shuffle=True))
+    else:
+        nb_ex = spec['nb_events'] // 10 if scenario == 'subset' else nb_all
+        data, _, _ = load(path, nb_ex)
+        events = iter(data)
+
+    nb_events, nb_bytes = 0, 0
+    if scenario == 'batch':
+        t0 = time.time()
+        batch_size = 100
+        for start in range(0, len(data) - batch_size + 1, batch_size):
+            batch = data[np.arange(start, start + batch_size)]
+            batch_X = collate(batch, np.zeros(batch_size), np.ones(batch_size))[0]
+            nb_bytes += 4 * int(batch.nb_nodes.sum()) * batch_X.shape[2]
+            nb_events += batch_size
+    else:
+        for x in events:
+            x.sum()  # read every event once
+            nb_events += 1
+            nb_bytes += 4 * x.size
+    elapsed = time.time() - t0 + 10**-20
+
+    return {
+            'nb_events': nb_events,
+            'seconds': elapsed,
+            'events_per_s': nb_events / elapsed,
+            'mb_per_s': nb_bytes / elapsed / 2**20,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+            'rss_increase_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 - rss_start,
+            }
+
+
+def _time_stages(spec):
+    """Seconds spent in each loading stage, with the number of events and
+    of decoded bytes they handled"""
+
+    import loading.data.nersc.load_data as nersc
+    from loading.data.nersc.manifest import load_manifest, is_train_file
+    from data_ops.batching import collate
+
+    load, _ = _loader(spec['dataset'])
+    path = spec['path']
+    timings = {}
+
+    def timed(stage, fn, *args):
+        t0 = time.time()
+        out = fn(*args)
+        timings[stage] = time.time() - t0
+        return out
+
+    if formats[spec['dataset']] == 'pickle':
+        def unpickle():
+            with open(path, 'rb') as filein:
+                return pickle.load(filein)
+        raw = timed('pickle_decode', unpickle)
+        timed('transpose', lambda: [np.array(x).transpose() for x in raw[0]])
+    elif formats[spec['dataset']] == 'raw_h5':
+        manifest = load_manifest(path)
+        files = manifest.data_files(is_train_file)
+
+        def open_events():
+            for filename in files:
+                with h5.File(join(path, filename), 'r') as datafile:
+                    for i in range(manifest.nb_events(filename)):
+                        datafile['event_{}'.format(i)]
+        timed('h5_open', open_events)
+
+        def read_all():
+            file_ids = np.concatenate([np.full(manifest.nb_events(f), k, dtype=np.int32)
+                                       for k, f in enumerate(files)])
+            event_ids = np.concatenate([np.arange(manifest.nb_events(f)) for f in files])
+            with nersc.H5HandlePool(path) as pool:
+                return nersc.read_events(pool, files, file_ids, event_ids,
+                                         manifest.get_weight_factors(is_train_file),
+                                         nb_nodes=manifest.nb_nodes(files))
+        timed('h5_read', read_all)
+    else:
+        timed('h5_read', load, path, 2**62)
+
+    data, _, _ = load(path, 2**62)
+    features = timed('decode', lambda: data.codec.decode(np.asarray(data.features[data.node_rows()])))
+    sizes = np.asarray(data.nb_nodes)
+    events = np.split(features, np.cumsum(sizes)[:-1])
+    events = [x.transpose() for x in events]
+
+    def pad(batch_size=100):
+        for start in range(0, len(events), batch_size):
+            batch = events[start:start + batch_size]
+            collate(batch, np.zeros(len(batch)), np.ones(len(batch)))
+    timed('pad', pad)
+
+    return timings, len(data), 4 * features.size
+
+
+def run_stages(spec):
+    """Measures each loading stage, in a fresh process"""
+
+    import loading.model.model_parameters as param
+    import loading.model.read_args as ra
+
+    param.args = ra.read_args(['--storage_dtype', spec['storage_dtype']])
+    timings, nb_events, nb_bytes = _time_stages(spec)
+    return {
+            stage: {
+                    'nb_events': nb_events,
+                    'seconds': seconds,
+                    'events_per_s': nb_events / (seconds + 10**-20),
+                    'mb_per_s': nb_bytes / (seconds + 10**-20) / 2**20,
+                    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+                    }
+            for stage, seconds in timings.items()
+            }
+
+
+def run_all(workdir, nb_events, storage_dtypes, datasets, repeats=3):
+    paths = make_datasets(workdir, nb_events)
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for dataset in datasets:
+        for storage_dtype in storage_dtypes:
+            path = _copy_raw(paths[dataset], join(workdir, 'runs', dataset, storage_dtype))
+            for scenario in scenarios:
+                if dataset == 'NERSC_converted' and scenario in ['build', 'stream']:
+                    continue  # read directly, without store
+                spec = {
+                        'dataset': dataset,
+                        'path': path,
+                        'storage_dtype': storage_dtype,
+                        'scenario': scenario,
+                        'nb_events': nb_events,
+                        }
+                # A store is only built once
+                nb_runs = 1 if scenario == 'build' else repeats
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    runs = [pool.apply(run_scenario, (spec,)) for _ in range(nb_runs)]
+                result = max(runs, key=lambda run: run['events_per_s'])
+                key = '/'.join([dataset, formats[dataset], storage_dtype, scenario])
+                results[key] = result
+                print('{:<50} {:>10.0f} events/s {:>8.1f} MB/s {:>8.0f} MB peak RSS'.format(
+                      key, result['events_per_s'], result['mb_per_s'], result['peak_rss_mb']))
+
+            # Stages, each keeping its fastest run
+            spec = {'dataset': dataset, 'path': path, 'storage_dtype': storage_dtype}
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                runs = [pool.apply(run_stages, (spec,)) for _ in range(repeats)]
+            for stage in stages[formats[dataset]]:
+                result = max((run[stage] for run in runs), key=lambda run: run['events_per_s'])
+                key = '/'.join([dataset, formats[dataset], storage_dtype, 'stage', stage])
+                results[key] = result
+                print('{:<50} {:>10.3f} s {:>10.0f} events/s {:>8.1f} MB/s'.format(
+                      key, result['seconds'], result['events_per_s'], result['mb_per_s']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints throughput relative to `baseline`, returns keys slower by more than `tolerance`"""
+
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        ratio = result['events_per_s'] / (baseline[key]['events_per_s'] + 10**-20)
+        rss_ratio = result['peak_rss_mb'] / (baseline[key]['peak_rss_mb'] + 10**-20)
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = '  <- slower'
+            regressions.append(key)
+        print('{:<50} {:>6.2f}x speed {:>6.2f}x peak RSS{}'.format(key, ratio, rss_ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Data loading benchmark on synthetic data')
+    add_arg = parser.add_argument
+    add_arg('--out', default='bench.json', help='JSON file where results are written')
+    add_arg('--baseline', default=None, help='JSON results to compare against')
+    add_arg('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+    add_arg('--nb_events', type=int, default=20000, help='number of synthetic events per dataset')
+    add_arg('--repeats', type=int, default=3, help='runs of each measurement, the fastest is kept')
+    add_arg('--storage_dtypes', nargs='+', default=['float32', 'float16'])
+    add_arg('--datasets', nargs='+', default=list(formats))
+    add_arg('--workdir', default=None, help='where synthetic data is written (default: temporary)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='gcnn_bench_')
+    if exists(join(workdir, 'NYU')):
+        raise ValueError('{} already holds benchmark data'.format(workdir))
+    results = run_all(workdir, args.nb_events, args.storage_dtypes, args.datasets, args.repeats)
+
+    with open(args.out, 'w') as fileout:
+        json.dump({
+                   'config': {
+                              'nb_events': args.nb_events,
+                              'storage_dtypes': args.storage_dtypes,
+                              'repeats': args.repeats,
+                              'workdir': workdir,
+                              },
+                   'results': results,
+                   }, fileout, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.out))
+
+    if args.baseline is not None:
+        with open(args.baseline) as filein:
+            baseline = json.load(filein)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
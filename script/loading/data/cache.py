@@ -0,0 +1,85 @@
+import os
+import shutil
+import hashlib
+import logging
+from os.path import exists, getmtime, join
+import numpy as np
+
+from loading.data.event_store import meta_name, is_store, read_meta, write_event_store, load_event_store
+from loading.data.nersc.manifest import delphes_name
+
+
+"""Cross-run cache of loaded datasets.
+
+Loaded samples are written as an event store named after a hash of
+everything that determines them (dataset path and content, number of
+samples, seed, feature options). Later runs with the same key attach to the
+memory-mapped store instead of loading again, and runs on the same node
+share its page cache. Least recently used entries are evicted above a size cap.
+"""
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def source_signature(path):
+    """mtime and size of a data file, or of each input file of a data
+    directory: its `.h5` files and `DelphesNevents`. Files written there by
+    loaders (manifest, event stores) are left out, as loading changes them
+    """
+
+    if os.path.isdir(path):
+        names = sorted(name for name in os.listdir(path)
+                       if name.endswith('.h5') or name == delphes_name)
+        return tuple((name,) + _stat(join(path, name)) for name in names)
+    return _stat(path)
+
+
+def cache_key(**key_parts):
+    return hashlib.sha1(repr(sorted(key_parts.items())).encode()).hexdigest()
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def evict(cache_dir, size_cap, keep=None):
+    """Removes least recently used entries until the cache fits in `size_cap` bytes"""
+
+    entries = [join(cache_dir, name) for name in os.listdir(cache_dir)]
+    entries = [entry for entry in entries if is_store(entry)]
+    entries.sort(key=lambda entry: getmtime(join(entry, meta_name)))
+    sizes = {entry: _dir_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= size_cap:
+            break
+        if entry == keep:
+            continue
+        logging.info('Evicting {} from data cache'.format(entry))
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+
+
+def cached_load(load_fn, key, cache_dir, size_cap):
+    """Returns `load_fn()` from the cache entry `key`, creating it if needed"""
+
+    if not exists(cache_dir):
+        os.makedirs(cache_dir)
+    storedir = join(cache_dir, key)
+
+    if is_store(storedir):
+        os.utime(join(storedir, meta_name))  # mark as recently used
+        logging.info('Data attached from cache {}'.format(storedir))
+        return load_event_store(storedir, read_meta(storedir)['nb_events'])
+
+    X, y, w = load_fn()
+    if len(X) == 0:
+        return X, y, w
+    write_event_store(storedir, X, y, w, getattr(X, 'codec', None))
+    logging.info('Data cached in {}'.format(storedir))
+    evict(cache_dir, size_cap, keep=storedir)
+    return load_event_store(storedir, len(X))
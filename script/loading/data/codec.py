@@ -0,0 +1,132 @@
+import logging
+import numpy as np
+
+
+"""Storage encodings of node features.
+
+Features stay in their storage dtype on disk and in memory, and are only
+widened to float32 when events are read (`FeatureCodec.decode`).
+  - float32 : default, lossless for all loaders
+  - float16 : half the memory, ~1e-3 relative precision
+  - int16   : each column linearly quantized over its (low, high) range
+Momentum columns can be stored as sign(x) * log1p(|x|), which keeps the
+relative precision constant over several decades of momentum. They always
+are with float16 storage, which overflows above 65504, and with int16
+storage, where ranges are given in that log scale.
+"""
+
+storage_dtypes = ['float32', 'float16', 'int16']
+_qmax = np.iinfo(np.int16).max
+
+
+def _slog(x):
+    return np.sign(x) * np.log1p(np.abs(x))
+
+
+def _sexp(x):
+    return np.sign(x) * np.expm1(np.abs(x))
+
+
+class FeatureCodec():
+    """Encodes (nb_nodes, nb_features) float arrays into a storage dtype.
+    `ranges` is a (nb_features, 2) array of (low, high) values of each
+    encoded column, needed by quantized storage; see `fit`.
+    """
+
+    def __init__(self, dtype='float32', log_columns=(), ranges=None):
+        self.dtype = np.dtype(dtype)
+        self.log_columns = sorted(log_columns)
+        self.ranges = None if ranges is None else np.asarray(ranges, dtype=np.float64)
+
+    @property
+    def quantized(self):
+        return self.dtype.kind == 'i'
+
+    @property
+    def spec(self):
+        """The requested policy, independent of fitted ranges"""
+        return (self.dtype.str, tuple(self.log_columns))
+
+    def to_meta(self):
+        return {
+                'dtype': self.dtype.str,
+                'log_columns': self.log_columns,
+                'ranges': None if self.ranges is None else self.ranges.tolist(),
+                }
+
+    @classmethod
+    def from_meta(cls, meta):
+        """Codec of an event store. Stores written before codecs hold plain floats"""
+        codec = meta.get('codec', {'dtype': meta['dtype']})
+        return cls(codec['dtype'], codec.get('log_columns', ()), codec.get('ranges'))
+
+    def _scale(self):
+        low, high = self.ranges[:, 0], self.ranges[:, 1]
+        return (low + high) / 2, np.maximum(high - low, 1e-12) / (2 * _qmax)
+
+    def fit(self, X):
+        """Codec with ranges covering events `X`, a list of (nb_features, nb_nodes)
+        arrays. Only quantized storage needs ranges.
+        """
+
+        if not self.quantized or self.ranges is not None:
+            return self
+        ranges = np.zeros((X[0].shape[0], 2))
+        ranges[:, 0] = np.inf
+        ranges[:, 1] = -np.inf
+        for x in X:
+            if x.shape[1] == 0:
+                continue
+            y = self._log(np.array(x.transpose(), dtype=np.float64))
+            ranges[:, 0] = np.minimum(ranges[:, 0], y.min(axis=0))
+            ranges[:, 1] = np.maximum(ranges[:, 1], y.max(axis=0))
+        ranges[~np.isfinite(ranges)] = 0
+        return FeatureCodec(self.dtype, self.log_columns, ranges)
+
+    def _log(self, y):
+        if self.log_columns:
+            y[:, self.log_columns] = _slog(y[:, self.log_columns])
+        return y
+
+    def encode(self, x):
+        """(nb_nodes, nb_features) float array -> storage dtype"""
+
+        if not self.log_columns and not self.quantized:
+            if self.dtype.itemsize < 4 and np.abs(x).max(initial=0) > np.finfo(self.dtype).max:
+                raise ValueError('Features overflow {} storage'.format(self.dtype.name))
+            return np.ascontiguousarray(x, dtype=self.dtype)
+        y = self._log(np.array(x, dtype=np.float64))
+        if not self.quantized:
+            return y.astype(self.dtype)
+        if self.ranges is None:
+            raise ValueError('Quantized storage needs feature ranges')
+
+        center, scale = self._scale()
+        q = np.rint((y - center) / scale)
+        nb_clipped = np.count_nonzero(np.abs(q) > _qmax)
+        if nb_clipped > 0:
+            logging.warning('{} feature values clipped to their storage range'.format(nb_clipped))
+        return np.clip(q, -_qmax, _qmax).astype(self.dtype)
+
+    def decode(self, x):
+        """Storage dtype -> (nb_nodes, nb_features) float32 array.
+        Float32 storage is returned without copy.
+        """
+
+        if not self.log_columns and not self.quantized:
+            return np.asarray(x, dtype=np.float32)
+        y = np.array(x, dtype=np.float32)
+        if self.quantized:
+            center, scale = self._scale()
+            y *= scale.astype(np.float32)
+            y += center.astype(np.float32)
+        if self.log_columns:
+            y[:, self.log_columns] = _sexp(y[:, self.log_columns])
+        return y
+
+
+def codec_from_args(args, momentum_columns=(), ranges=None):
+    """Codec of the storage policy set by `--storage_dtype` and `--log_momenta`"""
+
+    log = args.log_momenta or args.storage_dtype != 'float32'
+    return FeatureCodec(args.storage_dtype, momentum_columns if log else (), ranges)
@@ -0,0 +1,125 @@
+import numpy as np
+
+from loading.data.codec import FeatureCodec
+from loading.data.event_store import EventList
+
+
+"""Event-level derived node features, computed once at load time
+instead of in the kernels at every forward pass.
+
+Appended after the stored features of each node:
+  - pT / mean pT of the event's nodes
+  - each spatial coordinate relative to the pT-weighted event axis,
+    with phi wrapped in [-pi, pi] when periodic
+Dataset-wide feature statistics are accumulated over chunks of events
+with `FeatureStats`.
+"""
+
+
+def nb_derived(spatial_coords):
+    return 1 + len(spatial_coords)
+
+
+def derive_features(features, sizes, pt_column, spatial_coords, periodic_coord=None):
+    """Derived features of events stored consecutively in `features`,
+    a float (nb_nodes_total, nb_features) array, as (nb_nodes_total, nb_derived)
+    """
+
+    event_of_row = np.repeat(np.arange(len(sizes)), sizes)
+    pt = features[:, pt_column].astype(np.float64)
+    sum_pt = np.bincount(event_of_row, weights=pt, minlength=len(sizes))
+    safe_sum_pt = np.where(sum_pt == 0, 1, sum_pt)
+
+    derived = np.empty((len(features), nb_derived(spatial_coords)), dtype=np.float32)
+    mean_pt = safe_sum_pt / np.maximum(sizes, 1)
+    derived[:, 0] = pt / mean_pt[event_of_row]
+
+    for k, coord in enumerate(spatial_coords):
+        x = features[:, coord].astype(np.float64)
+        if coord == periodic_coord:
+            # Circular mean of angles
+            sin = np.bincount(event_of_row, weights=pt * np.sin(x), minlength=len(sizes))
+            cos = np.bincount(event_of_row, weights=pt * np.cos(x), minlength=len(sizes))
+            axis = np.arctan2(sin, cos)
+            derived[:, k + 1] = (x - axis[event_of_row] + np.pi) % (2 * np.pi) - np.pi
+        else:
+            axis = np.bincount(event_of_row, weights=pt * x, minlength=len(sizes)) / safe_sum_pt
+            derived[:, k + 1] = x - axis[event_of_row]
+    return derived
+
+
+def add_derived_features(X, pt_column, spatial_coords, periodic_coord=None):
+    """EventList with derived features appended, encoded like `X`"""
+
+    sizes = np.asarray(X.nb_nodes, dtype=np.int64)
+    features = X.codec.decode(np.asarray(X.features[X.node_rows()]))
+    features = np.concatenate(
+        (features, derive_features(features, sizes, pt_column, spatial_coords, periodic_coord)), axis=1)
+
+    new_starts = np.cumsum(sizes) - sizes
+    codec = FeatureCodec(X.codec.dtype, X.codec.log_columns)
+    codec = codec.fit(EventList(features, new_starts, new_starts + sizes))
+    return EventList(codec.encode(features), new_starts, new_starts + sizes, codec)
+
+
+class FeatureStats():
+    """Per-feature count, mean, standard deviation and root mean square of
+    node features, updated chunk by chunk.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.
+        self.sumsq = 0.
+
+    def update(self, features):
+        """Adds the nodes of a (nb_nodes, nb_features) array"""
+        features = np.asarray(features, dtype=np.float64)
+        self.count += len(features)
+        self.sum = self.sum + features.sum(axis=0)
+        self.sumsq = self.sumsq + (features ** 2).sum(axis=0)
+
+    @property
+    def mean(self):
+        return self.sum / max(self.count, 1)
+
+    @property
+    def rms(self):
+        return np.sqrt(self.sumsq / max(self.count, 1))
+
+    @property
+    def std(self):
+        return np.sqrt(np.maximum(self.rms ** 2 - self.mean ** 2, 0))
+
+    def to_dict(self):
+        return {
+                'count': self.count,
+                'mean': self.mean.tolist(),
+                'std': self.std.tolist(),
+                'rms': self.rms.tolist(),
+                }
+
+
+def feature_stats(X, chunk_size=10000):
+    """FeatureStats over all nodes of `X`, any sequence of (nb_features, nb_nodes) events"""
+
+    stats = FeatureStats()
+    if isinstance(X, EventList):
+        rows = X.node_rows()
+        for start in range(0, len(rows), 100 * chunk_size):
+            stats.update(X.codec.decode(np.asarray(X.features[rows[start:start + 100 * chunk_size]])))
+        return stats
+
+    if hasattr(X, 'events'):
+        events = (x for x, _, _ in X.events())  # streamed
+    else:
+        events = iter(X)
+    chunk = []
+    for x in events:
+        chunk.append(x)
+        if len(chunk) == chunk_size:
+            stats.update(np.concatenate(chunk, axis=1).transpose())
+            chunk = []
+    if chunk:
+        stats.update(np.concatenate(chunk, axis=1).transpose())
+    return stats
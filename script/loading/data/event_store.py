@@ -0,0 +1,204 @@
+import os
+import shutil
+import pickle
+import logging
+from os.path import exists, join
+import numpy as np
+from numpy.random import permutation
+
+from loading.data.codec import FeatureCodec
+
+
+"""Ragged columnar event store shared by all datasets.
+
+A store is a directory holding flat binary columns readable through `np.memmap`:
+  - features.dat : (nb_nodes_total, nb_features) concatenated node features,
+                   encoded by the store's `FeatureCodec`
+  - offsets.dat  : (nb_events + 1,) int64, event i owns rows offsets[i]:offsets[i+1]
+  - labels.dat   : (nb_events,) int8
+  - weights.dat  : (nb_events,) float64
+  - meta.pickle  : sizes and dtypes of the columns above, and feature codec
+"""
+
+meta_name = 'meta.pickle'
+label_dtype = np.int8
+weight_dtype = np.float64
+offset_dtype = np.int64
+
+
+def store_path(datapath):
+    """Location of the event store built from `datapath`"""
+
+    return os.path.splitext(datapath.rstrip('/'))[0] + '.store'
+
+
+def is_store(storedir):
+    return exists(join(storedir, meta_name))
+
+
+class EventStoreWriter():
+    """Appends events to a store. The store only becomes visible on `close`"""
+
+    def __init__(self, storedir, nb_features, codec=None, extra_meta=None):
+        self.storedir = storedir
+        self.extra_meta = extra_meta or {}
+        self.tmpdir = '{}.tmp{}'.format(storedir, os.getpid())
+        self.nb_features = nb_features
+        self.codec = codec or FeatureCodec()
+        if self.codec.quantized and self.codec.ranges is None:
+            raise ValueError('Quantized storage needs feature ranges, see `FeatureCodec.fit`')
+        self.nb_events = 0
+        self.nb_nodes = 0
+
+        if not exists(self.tmpdir):
+            os.makedirs(self.tmpdir)
+        self.files = {name: open(join(self.tmpdir, name + '.dat'), 'wb')
+                      for name in ['features', 'offsets', 'labels', 'weights']}
+        np.zeros(1, dtype=offset_dtype).tofile(self.files['offsets'])
+
+    def append(self, X, y, w):
+        """Adds events `X`, a list of (nb_features, nb_nodes) arrays"""
+
+        sizes = np.array([x.shape[1] for x in X], dtype=offset_dtype)
+        for x in X:
+            self.codec.encode(x.transpose()).tofile(self.files['features'])
+        (self.nb_nodes + np.cumsum(sizes)).tofile(self.files['offsets'])
+        np.asarray(y, dtype=label_dtype).tofile(self.files['labels'])
+        np.asarray(w, dtype=weight_dtype).tofile(self.files['weights'])
+        self.nb_events += len(sizes)
+        self.nb_nodes += int(sizes.sum())
+
+    def close(self):
+        for fileout in self.files.values():
+            fileout.close()
+        meta = {
+                'nb_events': self.nb_events,
+                'nb_nodes': self.nb_nodes,
+                'nb_features': self.nb_features,
+                'dtype': self.codec.dtype.str,
+                'codec': self.codec.to_meta(),
+                }
+        meta.update(self.extra_meta)
+        with open(join(self.tmpdir, meta_name), 'wb') as fileout:
+            pickle.dump(meta, fileout)
+        try:
+            os.rename(self.tmpdir, self.storedir)
+        except OSError:
+            # Another process wrote the same store first
+            if not is_store(self.storedir):
+                raise
+            shutil.rmtree(self.tmpdir)
+
+
+def write_event_store(storedir, X, y, w, codec=None):
+    codec = (codec or FeatureCodec()).fit(X)
+    writer = EventStoreWriter(storedir, X[0].shape[0], codec)
+    writer.append(X, y, w)
+    writer.close()
+
+
+def make_store_if_not_there(storedir, build_fn, codec=None):
+    """Converts data returned by `build_fn` into a store, if not done yet
+    or if the store was written with another storage policy than `codec`
+    """
+
+    codec = codec or FeatureCodec()
+    if is_store(storedir):
+        if FeatureCodec.from_meta(read_meta(storedir)).spec == codec.spec:
+            return
+        logging.warning('Event store {} has another storage dtype, rebuilding'.format(storedir))
+        shutil.rmtree(storedir)
+    logging.warning('Building event store {}'.format(storedir))
+    X, y, w = build_fn()
+    write_event_store(storedir, X, y, w, codec)
+
+
+class EventList():
+    """Sequence of events read from a store. Features stay encoded by
+    `codec` in memory, each item is decoded into a (nb_features, nb_nodes)
+    float32 array, a view into the feature column for float32 storage.
+    """
+
+    def __init__(self, features, starts, ends, codec=None):
+        self.features = features
+        self.starts = starts
+        self.ends = ends
+        self.codec = codec or FeatureCodec()
+
+    @property
+    def nb_nodes(self):
+        return self.ends - self.starts
+
+    def node_rows(self):
+        """Rows of the feature column holding the nodes of all events, in order"""
+
+        starts = np.asarray(self.starts, dtype=np.int64)
+        sizes = np.asarray(self.nb_nodes, dtype=np.int64)
+        offsets = np.cumsum(sizes) - sizes
+        return np.repeat(starts - offsets, sizes) + np.arange(sizes.sum())
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, (slice, np.ndarray, list)):
+            return EventList(self.features, self.starts[i], self.ends[i], self.codec)
+        return self.codec.decode(self.features[self.starts[i]:self.ends[i]]).transpose()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def read_meta(storedir):
+    with open(join(storedir, meta_name), 'rb') as filein:
+        return pickle.load(filein)
+
+
+def open_event_store(storedir):
+    """Memory-maps all columns of a store"""
+
+    meta = read_meta(storedir)
+
+    def _memmap(name, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(join(storedir, name + '.dat'), dtype=dtype, mode='r', shape=shape)
+
+    columns = {
+               'features': _memmap('features', np.dtype(meta['dtype']),
+                                   (meta['nb_nodes'], meta['nb_features'])),
+               'offsets': _memmap('offsets', offset_dtype, (meta['nb_events'] + 1,)),
+               'labels': _memmap('labels', label_dtype, (meta['nb_events'],)),
+               'weights': _memmap('weights', weight_dtype, (meta['nb_events'],)),
+               }
+    return meta, columns
+
+
+def load_event_store(storedir, nb_ex, shuffle=False):
+    """Loads `nb_ex` events of a store, randomly chosen if `shuffle`.
+    Only the selected events are read, in store order for local reads.
+    Chosen events are returned in random order: stores are written file
+    by file, so that store order groups events by label.
+    """
+
+    meta, columns = open_event_store(storedir)
+    nb_events = min(nb_ex, meta['nb_events'])
+    if shuffle:
+        chosen = permutation(meta['nb_events'])[:nb_events]
+        order = np.argsort(chosen)
+        index = chosen[order]
+    else:
+        index = np.arange(nb_events)
+
+    offsets = columns['offsets']
+    starts, ends = np.asarray(offsets[index]), np.asarray(offsets[index + 1])
+    y = np.asarray(columns['labels'][index])
+    w = np.asarray(columns['weights'][index])
+    if shuffle:
+        # Back from store order to the drawn order
+        restore = np.argsort(order)
+        starts, ends, y, w = starts[restore], ends[restore], y[restore], w[restore]
+
+    X = EventList(columns['features'], starts, ends, FeatureCodec.from_meta(meta))
+    return X, y, w
@@ -0,0 +1,78 @@
+import os
+import fcntl
+from contextlib import contextmanager
+from os.path import exists, join
+import numpy as np
+
+"""IceCube detector geometry.
+
+Hits are recorded by optical modules at fixed positions. Module positions
+seen in the data are kept in `geometry.npy` in the data directory, in
+order of first appearance, so module IDs stay valid when new modules are
+added. Runs sharing a data directory add modules one at a time, under a
+lock on `geometry.npy.lock`. Layer 0 kernels read pairwise distances from a (nb_modules, nb_modules)
+table indexed by module ID instead of recomputing them for each event.
+"""
+
+coord_rows = [0, 1, 2]  # x, y, z rows of IceCube events
+
+
+def geometry_path(datadir):
+  return join(datadir, 'geometry.npy')
+
+
+def load_geometry(datadir):
+  """(nb_modules, 3) positions of known modules"""
+  if not exists(geometry_path(datadir)):
+    return np.zeros((0, len(coord_rows)), dtype=np.float32)
+  return np.load(geometry_path(datadir))
+
+
+def _save_geometry(datadir, positions):
+  tmp = geometry_path(datadir) + '.tmp{}.npy'.format(os.getpid())
+  np.save(tmp, positions)
+  os.replace(tmp, geometry_path(datadir))
+
+
+@contextmanager
+def _geometry_lock(datadir):
+  # Held from load to save, so that concurrent runs do not give the
+  # same ID to different modules, nor drop modules added by another run
+  with open(geometry_path(datadir) + '.lock', 'a') as lockfile:
+    fcntl.flock(lockfile, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def add_module_ids(X, datadir):
+  """Appends the module ID of each hit as a last row of events `X`,
+  a list of (nb_features, nb_hits) arrays. Unknown modules are added
+  to the geometry of `datadir`.
+  """
+  coords = np.concatenate([x[coord_rows] for x in X], axis=1).transpose().astype(np.float32)
+  unique, inverse = np.unique(coords, axis=0, return_inverse=True)
+
+  with _geometry_lock(datadir):
+    positions = load_geometry(datadir)
+    module_ids = {tuple(pos): i for i, pos in enumerate(positions.tolist())}
+    new = [pos for pos in unique.tolist() if tuple(pos) not in module_ids]
+    if new:
+      for pos in new:
+        module_ids[tuple(pos)] = len(module_ids)
+      positions = np.concatenate((positions, np.array(new, dtype=np.float32)))
+      _save_geometry(datadir, positions)
+
+  hit_ids = np.array([module_ids[tuple(pos)] for pos in unique.tolist()])[inverse.reshape(-1)]
+  sizes = [x.shape[1] for x in X]
+  hit_ids = np.split(hit_ids, np.cumsum(sizes)[:-1])
+  return [np.concatenate((x, ids[np.newaxis].astype(x.dtype))) for x, ids in zip(X, hit_ids)]
+
+
+def sqdist_table(positions):
+  """(nb_modules, nb_modules) squared distances between modules"""
+  positions = positions.astype(np.float64)
+  sqnorm = (positions ** 2).sum(1)
+  sqdist = sqnorm[:, np.newaxis] + sqnorm[np.newaxis, :] - 2 * positions.dot(positions.transpose())
+  return np.maximum(sqdist, 0).astype(np.float32)
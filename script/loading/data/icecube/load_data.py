@@ -1,12 +1,52 @@
 import pickle
+from os.path import abspath, dirname
 
-def load_raw_data(filepath, nb_ex):
-  """Loads data from the IceCube project"""
+from loading.data.codec import codec_from_args
+from loading.data.event_store import store_path, make_store_if_not_there, load_event_store
+from loading.data.stream import StreamDataset
+from loading.data.icecube.geometry import add_module_ids, load_geometry, sqdist_table
+import loading.model.model_parameters as param
+
+pt_column = 4  # nodes have no pT, they are ranked by this feature (DOM charge)
+module_id_column = 6  # appended by --module_geometry
+
+def _read_pickle(filepath):
+  """Reads the whole pickle, used once to build the event store"""
   with open(filepath, 'rb') as filein:
     X, y, weights = pickle.load(filein)
-  x_t = []
-  w = []
-  for i in range(min(nb_ex,len(X))):
-    x_t.append(X[i].transpose())
-    w.append(float(weights[i]))
-  return x_t[:nb_ex], y[:nb_ex], w[:nb_ex]
+  x_t = [x.transpose() for x in X]
+  w = [float(weight) for weight in weights]
+  return x_t, y, w
+
+def _get_store(filepath):
+  """Event store of `filepath`, with module IDs appended to hits if --module_geometry"""
+  storedir = store_path(filepath)
+  build_fn = lambda: _read_pickle(filepath)
+  if param.args.module_geometry:
+    if param.args.storage_dtype == 'float16':
+      raise ValueError('--module_geometry needs module IDs stored exactly, not with float16 storage')
+    storedir = storedir[:-len('.store')] + '_modules.store'
+    datadir = dirname(abspath(filepath))
+    def build_fn():
+      X, y, w = _read_pickle(filepath)
+      return add_module_ids(X, datadir), y, w
+  make_store_if_not_there(storedir, build_fn, codec_from_args(param.args))
+  return storedir
+
+def load_raw_data(filepath, nb_ex):
+  """Loads data from the IceCube project"""
+  return load_event_store(_get_store(filepath), nb_ex)
+
+def stream_raw_data(filepath, nb_ex):
+  """Streams data from the IceCube project without loading it in memory"""
+  data = StreamDataset(
+                       [_get_store(filepath)],
+                       nb_ex,
+                       buffer_size=param.args.shuffle_buffer,
+                       chunk_size=param.args.shuffle_block
+                       )
+  return data, None, None
+
+def module_sqdist(filepath):
+  """Squared distances between all modules of the detector, indexed by module ID"""
+  return sqdist_table(load_geometry(dirname(abspath(filepath))))
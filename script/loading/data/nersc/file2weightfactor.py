@@ -30,9 +30,10 @@ def findtype(filename, filetypes):
         'Type of file `{}` not found in {}'.format(filename, filetypes))
 
 
-def init_weight_factors(is_used, rawdatadir):
+def init_weight_factors(is_used, rawdatadir, h5_files=None):
     """reads from file `DelphesNevents` the number of such events
-    and computes the renormalizing factors"""
+    and computes the renormalizing factors.
+    `h5_files` lists the raw files, `rawdatadir` is scanned if not given"""
 
     with open(os.path.join(rawdatadir, 'DelphesNevents'), 'r') as delphesnevents:
         eventtype = delphesnevents.read().split('\n')
@@ -49,18 +50,17 @@ def init_weight_factors(is_used, rawdatadir):
 
     # number of files of each type
     type2nbfile = dict()
-    h5_files = [filename for filename in os.listdir(rawdatadir)
-                if filename.endswith('.h5')]
-    h5_files = [filename for filename in h5_files
-                if 'data' not in filename]
+    if h5_files is None:
+        h5_files = [filename for filename in os.listdir(rawdatadir)
+                    if filename.endswith('.h5')]
+        h5_files = [filename for filename in h5_files
+                    if 'data' not in filename]
     for filetype in filetypes:
         type2nbfile[filetype] = sum(filetype in filename for filename in h5_files)
 
     # number of used files of each type
     type2nbfileused = dict()
-    h5_files_used = [filename for filename in os.listdir(rawdatadir)
-                     if filename.endswith('.h5') and is_used(filename)
-                     and 'data' not in filename]
+    h5_files_used = [filename for filename in h5_files if is_used(filename)]
     for filetype in filetypes:
         type2nbfileused[filetype] = sum(filetype in filename for filename in h5_files_used)
 
@@ -1,93 +1,213 @@
-import os
+import shutil
+import logging
+from collections import OrderedDict
 from os.path import exists, join
 import numpy as np
-from numpy.random import permutation
 import h5py as h5
-from loading.data.nersc.file2weightfactor import init_weight_factors
+from loading.data.nersc.manifest import load_manifest, is_train_file, is_test_file
+from loading.data.codec import FeatureCodec, codec_from_args
+from loading.data.event_store import EventList, EventStoreWriter, is_store, read_meta, load_event_store
+from loading.data.stream import StreamDataset
+import loading.model.model_parameters as param
 
 
-def _is_train_file(filename):
-    return filename.endswith('02.h5')
-
-
-def _is_test_file(filename):
-    return filename.endswith('01.h5')
+data_fields = ['clusE', 'clusEta', 'clusPhi', 'clusEM']
+nb_features = len(data_fields) + 1  # + clusPT
+momentum_columns = [0, 3, 4]  # clusE, clusEM, clusPT
+pt_column = 4
+# Momenta are kept in the units of raw files, by event stores and `prepare_data_nersc`
+momentum_unit = 'MeV'
+# Ranges of quantized storage, momenta in MeV in log scale
+storage_ranges = [(-17, 17), (-6, 6), (-np.pi, np.pi), (-17, 17), (-17, 17)]
 
 
 def load_raw_data(datadir, nb_ex, train_test):
-    """creates a data loader containing (data, label, weight)"""
-    if train_test == 'train':
-      is_used = _is_train_file
-    elif train_test == 'test':
-      is_used = _is_test_file
-
-    nb_events_files, all_event_coords_ = all_event_coords(datadir, is_used)
-    weight_factors = init_weight_factors(is_used, datadir)
-
-    nb_events_ = min(sum(nb_events_files), nb_ex)
-    data_loader = (load_raw_event(datadir, event_coord, weight_factors)
-                   for event_coord in permutation(all_event_coords_)[:nb_events_])
+    """loads (data, label, weight) from the file made by `prepare_data_nersc`
+    if there is one, otherwise as views into the event store of `datadir`"""
 
-    samples_to_load = permutation(all_event_coords_)[:nb_events_]
-    X = []
-    y = []
-    w = []
-    for idx in samples_to_load:
-      X_, y_, w_ = load_raw_event(datadir, idx, weight_factors)
-      X.append(X_)
-      y.append(y_)
-      w.append(w_)
+    converted = join(datadir, 'data_{}.h5'.format(train_test))
+    if exists(converted):
+      return load_converted_data(converted, nb_ex)
 
-    return X, y, w
+    storedir = _get_store(datadir, train_test)
+    return load_event_store(storedir, nb_ex, shuffle=True)
 
 
-def load_raw_event(datadir, event_coord, weight_factors):
-    """loads one event, given the file and the event index"""
+def load_converted_data(datapath, nb_ex):
+    """loads the first `nb_ex` events of the stored permutation of a file
+    made by `prepare_data_nersc`. Runs of consecutive events are read at once.
+    """
 
-    chosen_file, idx = event_coord
-    datapath = join(datadir, chosen_file)
-    event_name = 'event_{}'.format(idx)
     with h5.File(datapath, 'r') as datafile:
-        event = datafile[event_name]
-        data_fields = ['clusE', 'clusEta', 'clusPhi', 'clusEM']
-        data_fields = [event[field][()] for field in data_fields]
-
-        cluspt = data_fields[0] / np.cosh(data_fields[1])  # clusE / cosh(clusEta)
-        data_fields.append(cluspt)
-
-        weight = event['weight'][()]
-
-    data = np.array([clus for clus in data_fields])
-
-    weight_factor = weight_factors[chosen_file]
-    weight = float(weight * weight_factor)
-
-    label = int(chosen_file.startswith('GG'))
-
-    return (data, label, weight)
-
-
-def all_event_coords(datadir, is_used):
-    data_files_ = data_files(datadir, is_used)
-    nb_events_file = [nb_events(join(datadir, filename)) for filename in data_files_]
-    all_coords = [(filename, idx)
-                  for i, filename in enumerate(data_files_)
-                  for idx in range(nb_events_file[i])]
-
-    return nb_events_file, all_coords
-
-
-def data_files(datadir, is_used):
-    """Lists all relevant files in `datadir`"""
-
-    datafiles = [filename for filename in os.listdir(datadir) if filename.endswith('.h5')]
-    datafiles = [filename for filename in datafiles if 'data' not in filename]
-    datafiles = [filename for filename in datafiles if is_used(filename)]
-
-    return datafiles
-
-
-def nb_events(path):
-    with h5.File(path) as h5file:
-        nb = h5file.attrs['nb_event']
-    return nb
+        if datafile.attrs.get('momentum_unit') != momentum_unit:
+            raise ValueError('{} stores momenta in other units than raw files, '
+                             'rerun prepare_data_nersc'.format(datapath))
+        selected = datafile['permutation'][:nb_ex]
+        offsets = datafile['offsets'][()]
+
+        # Read in file order
+        order = np.argsort(selected)
+        index = selected[order]
+        sizes = offsets[index + 1] - offsets[index]
+        starts = np.cumsum(sizes) - sizes
+
+        features = np.empty((int(sizes.sum()), datafile['features'].shape[1]), dtype=np.float32)
+        runs = np.split(np.arange(len(index)), np.where(np.diff(index) != 1)[0] + 1)
+        for run in runs:
+            if len(run) == 0:
+                continue
+            first, last = index[run[0]], index[run[-1]]
+            rows = slice(starts[run[0]], starts[run[-1]] + sizes[run[-1]])
+            if rows.stop > rows.start:
+                datafile['features'].read_direct(features,
+                                                 source_sel=np.s_[offsets[first]:offsets[last + 1]],
+                                                 dest_sel=np.s_[rows])
+
+        labels = datafile['labels'][()][selected]
+        weights = datafile['weights'][()][selected]
+
+    # Back to permutation order
+    event_starts = np.empty_like(starts)
+    event_starts[order] = starts
+    event_sizes = np.empty_like(sizes)
+    event_sizes[order] = sizes
+
+    # Kept in memory with the requested storage policy
+    codec = _storage_codec()
+    features = codec.encode(features)
+    return EventList(features, event_starts, event_starts + event_sizes, codec), labels, weights
+
+
+def stream_raw_data(datadir, nb_ex, train_test):
+    """streams (data, label, weight) from the event store of `datadir`"""
+
+    storedir = _get_store(datadir, train_test)
+    data = StreamDataset(
+                         [storedir],
+                         nb_ex,
+                         buffer_size=param.args.shuffle_buffer,
+                         chunk_size=param.args.shuffle_block
+                         )
+    return data, None, None
+
+
+def _storage_codec():
+    return codec_from_args(param.args, momentum_columns, storage_ranges)
+
+
+def _get_store(datadir, train_test):
+    """Event store of `datadir`, (re)built if raw files changed
+    or if it was written with another storage policy"""
+    if train_test == 'train':
+      is_used = is_train_file
+    elif train_test == 'test':
+      is_used = is_test_file
+
+    manifest = load_manifest(datadir)
+    if not manifest.data_files(is_used):
+      raise ValueError('No NERSC files found for {} in {}'.format(train_test, datadir))
+    storedir = join(datadir, 'store_{}'.format(train_test))
+    source = manifest.signature(manifest.data_files(is_used))
+    codec = _storage_codec()
+    if (not is_store(storedir)
+        or read_meta(storedir).get('source') != source
+        or FeatureCodec.from_meta(read_meta(storedir)).spec != codec.spec):
+      _build_store(manifest, storedir, is_used, codec)
+    return storedir
+
+
+def _build_store(manifest, storedir, is_used, codec):
+    """Converts all events of used files into an event store, one file at a time"""
+
+    logging.warning('Building event store {}'.format(storedir))
+    if exists(storedir):
+      shutil.rmtree(storedir)
+    datafiles = manifest.data_files(is_used)
+    weight_factors = manifest.get_weight_factors(is_used)
+
+    writer = EventStoreWriter(storedir, nb_features, codec,
+                              extra_meta={'source': manifest.signature(datafiles)})
+    with H5HandlePool(manifest.datadir) as pool:
+      for filename in datafiles:
+        event_ids = np.arange(manifest.nb_events(filename))
+        writer.append(*read_events(
+                                   pool,
+                                   [filename],
+                                   np.zeros(len(event_ids), dtype=np.int32),
+                                   event_ids,
+                                   weight_factors,
+                                   nb_nodes=manifest.nb_nodes([filename])
+                                   ))
+    writer.close()
+
+
+class H5HandlePool():
+    """Keeps up to `max_open` read-only h5 files open, closing the least
+    recently used one when full.
+    """
+
+    def __init__(self, datadir, max_open=32):
+        self.datadir = datadir
+        self.max_open = max_open
+        self.handles = OrderedDict()
+
+    def get(self, filename):
+        if filename in self.handles:
+            self.handles.move_to_end(filename)
+        else:
+            if len(self.handles) >= self.max_open:
+                _, oldest = self.handles.popitem(last=False)
+                oldest.close()
+            self.handles[filename] = h5.File(join(self.datadir, filename), 'r')
+        return self.handles[filename]
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_events(pool, filenames, file_ids, event_ids, weight_factors, nb_nodes=None):
+    """Reads events given by `filenames[file_ids[i]]` and `event_ids[i]`,
+    grouped by file. Each field is read with `read_direct` into one
+    preallocated buffer. `nb_nodes`, the size of each event, is read from
+    the files if not given.
+    Returns events in the requested order, as views into that buffer.
+    """
+
+    # Group requested events by file, in increasing index order
+    order = np.lexsort((event_ids, file_ids))
+
+    # First pass on metadata only: event sizes and weights
+    if nb_nodes is None:
+        nb_nodes = np.zeros(len(order), dtype=np.int64)
+        for pos in order:
+            event = pool.get(filenames[file_ids[pos]])['event_{}'.format(event_ids[pos])]
+            nb_nodes[pos] = event[data_fields[0]].shape[0]
+    sizes = np.asarray(nb_nodes, dtype=np.int64)
+    starts = np.zeros(len(order), dtype=np.int64)
+    starts[order] = np.cumsum(sizes[order]) - sizes[order]
+
+    labels = np.array([int(filename.startswith('GG')) for filename in filenames], dtype=np.int8)[file_ids]
+    weights = np.zeros(len(order))
+
+    # Second pass: bulk read of all fields
+    features = np.empty((int(sizes.sum()), nb_features), dtype=np.float32)
+    for pos in order:
+        filename = filenames[file_ids[pos]]
+        event = pool.get(filename)['event_{}'.format(event_ids[pos])]
+        weights[pos] = event['weight'][()] * weight_factors[filename]
+        if sizes[pos] == 0:
+            continue
+        rows = slice(starts[pos], starts[pos] + sizes[pos])
+        for k, field in enumerate(data_fields):
+            event[field].read_direct(features, dest_sel=np.s_[rows, k])
+    features[:, 4] = features[:, 0] / np.cosh(features[:, 1])  # clusE / cosh(clusEta)
+
+    return EventList(features, starts, starts + sizes), labels, weights
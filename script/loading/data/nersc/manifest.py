@@ -0,0 +1,159 @@
+import os
+import pickle
+import logging
+from os.path import exists, join
+import numpy as np
+import h5py as h5
+
+from loading.data.nersc.file2weightfactor import init_weight_factors
+
+
+"""Persistent index of the raw NERSC files, stored next to the data.
+
+Holds, for every raw `.h5` file, its mtime and size, and the number of nodes
+of each of its events, and the mtime and size of `DelphesNevents`, from
+which weight factors are computed. Weight factors are cached per set of
+used files.
+Only new or modified files are scanned when the manifest is refreshed.
+"""
+
+manifest_name = 'manifest.pickle'
+delphes_name = 'DelphesNevents'
+
+
+def is_train_file(filename):
+    """Split of raw files, shared by event stores and `prepare_data_nersc`"""
+
+    return filename.endswith('02.h5')
+
+
+def is_test_file(filename):
+    return filename.endswith('01.h5')
+
+
+def _is_raw_file(filename):
+    return filename.endswith('.h5') and 'data' not in filename
+
+
+def _scan_file(path):
+    """Reads the node count of every event of one raw file"""
+
+    with h5.File(path, 'r') as h5file:
+        nb = int(h5file.attrs['nb_event'])
+        nb_nodes = [h5file['event_{}'.format(idx)]['clusE'].shape[0] for idx in range(nb)]
+    return np.array(nb_nodes, dtype=np.int32)
+
+
+def _stat(path):
+    if exists(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+    return None
+
+
+class Manifest():
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.path = join(datadir, manifest_name)
+        self.files = {}  # filename -> {'mtime', 'size', 'nb_nodes'}
+        self.weight_factors = {}  # tuple of used files -> {filename: factor}
+        self.delphes_stat = None
+
+        if exists(self.path):
+            with open(self.path, 'rb') as filein:
+                state = pickle.load(filein)
+            self.files = state['files']
+            self.weight_factors = state['weight_factors']
+            self.delphes_stat = state.get('delphes_stat')
+
+    def refresh(self):
+        """Rescans files added or modified since the manifest was saved"""
+
+        changed = False
+        filenames = [filename for filename in os.listdir(self.datadir) if _is_raw_file(filename)]
+        for filename in set(self.files) - set(filenames):
+            del self.files[filename]
+            changed = True
+        for filename in filenames:
+            stat = os.stat(join(self.datadir, filename))
+            entry = self.files.get(filename)
+            if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                logging.info('Manifest: scanning {}'.format(filename))
+                self.files[filename] = {
+                                        'mtime': stat.st_mtime,
+                                        'size': stat.st_size,
+                                        'nb_nodes': _scan_file(join(self.datadir, filename)),
+                                        }
+                changed = True
+
+        delphes_stat = _stat(join(self.datadir, delphes_name))
+        if changed or delphes_stat != self.delphes_stat:
+            self.delphes_stat = delphes_stat
+            self.weight_factors = {}
+            self.save()
+
+    def save(self):
+        state = {
+                 'files': self.files,
+                 'weight_factors': self.weight_factors,
+                 'delphes_stat': self.delphes_stat,
+                 }
+        # One temporary file per process, as jobs may refresh the same manifest
+        tmp_path = '{}.tmp{}'.format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fileout:
+                pickle.dump(state, fileout)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning('Manifest could not be saved: {}'.format(e))
+            if exists(tmp_path):
+                os.remove(tmp_path)
+
+    def data_files(self, is_used):
+        """Lists all relevant files"""
+
+        return sorted(filename for filename in self.files if is_used(filename))
+
+    def nb_events(self, filename):
+        return len(self.files[filename]['nb_nodes'])
+
+    def nb_nodes(self, filenames):
+        """Node counts of all events of `filenames`, concatenated"""
+
+        return np.concatenate([self.files[filename]['nb_nodes'] for filename in filenames]
+                              or [np.zeros(0, dtype=np.int32)])
+
+    def event_coords(self, is_used):
+        """Coordinates of all used events, as (filenames, file_ids, event_ids)"""
+
+        filenames = self.data_files(is_used)
+        nb_events_file = [self.nb_events(filename) for filename in filenames]
+        file_ids = np.repeat(np.arange(len(filenames), dtype=np.int32), nb_events_file)
+        event_ids = np.concatenate([np.arange(nb) for nb in nb_events_file] or [np.zeros(0, dtype=int)])
+        return filenames, file_ids, event_ids
+
+    def signature(self, filenames):
+        """Identifies the current content of `filenames`, and of
+        `DelphesNevents` from which their weights are computed"""
+
+        return tuple((filename, self.files[filename]['mtime'], self.files[filename]['size'])
+                     for filename in filenames) + ((delphes_name,) + tuple(self.delphes_stat or ()),)
+
+    def get_weight_factors(self, is_used):
+        used = tuple(self.data_files(is_used))
+        if used not in self.weight_factors:
+            self.weight_factors[used] = init_weight_factors(
+                                                            is_used,
+                                                            self.datadir,
+                                                            h5_files=sorted(self.files)
+                                                            )
+            self.save()
+        return self.weight_factors[used]
+
+
+def load_manifest(datadir):
+    """Loads the manifest of `datadir`, brought up to date"""
+
+    manifest = Manifest(datadir)
+    manifest.refresh()
+    return manifest
@@ -1,64 +1,112 @@
+import os
 from os import path, listdir
+from multiprocessing import Pool
 import h5py as h5
 import numpy as np
 from numpy.random import permutation
-from file2weightfactor import make_weightfactor_if_not_there, findtype
+from loading.data.nersc.file2weightfactor import make_weightfactor_if_not_there
+from loading.data.nersc.manifest import is_train_file, is_test_file
+from loading.data.nersc.load_data import momentum_unit
 
 
 ########################################
 ######## pT = clusE / cosh(Eta) ########
 ########################################
 
+"""Converts raw NERSC files into one ragged file per dataset, with datasets
+  - features    : (nb_nodes_total, 5) clusE, clusEta, clusPhi, clusEM, clusPT,
+                  momenta in the units of raw files, as in event stores
+  - offsets     : (nb_events + 1,) event i owns rows offsets[i]:offsets[i+1]
+  - labels      : (nb_events,)
+  - weights     : (nb_events,) event weight times file weight factor
+  - permutation : (nb_events,) random order in which to read events
+Run from `script/` as `python -m loading.data.nersc.prepare_data_nersc`
+"""
+
+nb_features = 5
+chunk_rows = 16384  # chunks fit in the default 1MB h5 chunk cache
+
+
 def _data_files(datadir, is_used):
     datafiles = [filename for filename in listdir(datadir) if filename.endswith('.h5')]
     datafiles = [filename for filename in datafiles if 'data' not in filename]
     datafiles = [filename for filename in datafiles if is_used(filename)]
 
-    return datafiles
+    return sorted(datafiles)
 
 
-def _count_events(datadir, datafiles, print_fun):
-    def _print_and_len(datafile):
-        print_fun('{} : start'.format(datafile))
-        try:
-            with h5.File(path.join(datadir, datafile), 'r') as h5file:
-                length = h5file.attrs['nb_event']
-        except KeyError:
-            with h5.File(path.join(datadir, datafile), 'r') as h5file:
-                length = len(h5file)
-            with h5.File(path.join(datadir, datafile), 'a') as h5file:
-                h5file.attrs['nb_event'] = length
-            print_fun("attribute 'nb_event' added in {}".format(datafile))
-        print_fun('{} : done'.format(datafile))
-        return length
-    return sum([_print_and_len(datafile) for datafile in datafiles])
+def _read_one_file(args):
+    """Reads all events of one raw file into flat arrays, computing
+    features vectorised over the whole file"""
 
+    datapath, label, wf_file = args
+    with h5.File(datapath, 'r') as filein:
+        events = [filein[event_name] for event_name in filein]
+        sizes = np.array([event['clusE'].shape[0] for event in events], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
 
-def _transfer_one_event(filein, fileout, event, new_idx, label, wf_file):
-    event_name = 'event_{}'.format(new_idx)
-    shape = filein[event]['clusE'].shape + (5,)
-    fileout.create_dataset(event_name, shape=shape)
-    fileout[event_name].attrs['label'] = label
-    fileout[event_name].attrs['weight'] = filein[event]['weight'][()] * wf_file
+        fields = {field: np.empty(offsets[-1]) for field in ['clusE', 'clusEta', 'clusPhi', 'clusEM']}
+        weights = np.empty(len(events))
+        for i, event in enumerate(events):
+            weights[i] = event['weight'][()]
+            if sizes[i] == 0:
+                continue
+            for field, buf in fields.items():
+                event[field].read_direct(buf, dest_sel=np.s_[offsets[i]:offsets[i + 1]])
 
-    cluse, cluseta = filein[event]['clusE'][()] / 10000, filein[event]['clusEta'][()]
-    cluspt = cluse / np.cosh(cluseta)
+    features = np.empty((offsets[-1], nb_features), dtype=np.float32)
+    features[:, 0] = fields['clusE']
+    features[:, 1] = fields['clusEta']
+    features[:, 2] = fields['clusPhi']
+    features[:, 3] = fields['clusEM']
+    features[:, 4] = features[:, 0] / np.cosh(features[:, 1])
 
-    fileout[event_name][:, 0] = cluse
-    fileout[event_name][:, 1] = cluseta
-    fileout[event_name][:, 2] = filein[event]['clusPhi'][()]
-    fileout[event_name][:, 3] = filein[event]['clusEM'][()] / 10000
-    fileout[event_name][:, 4] = cluspt
+    labels = np.full(len(events), label, dtype=np.int8)
+    return features, sizes, labels, weights * wf_file
 
 
-def _transfer_one_file(datapath, fileout, idx_permutation, label, wf_file):
-    with h5.File(datapath, 'r') as filein:
-        for event in filein:
-            new_idx = idx_permutation.pop()
-            _transfer_one_event(filein, fileout, event, new_idx, label, wf_file)
+def _append(dataset, values):
+    start = dataset.shape[0]
+    dataset.resize(start + values.shape[0], axis=0)
+    dataset[start:] = values
 
 
-def _create_dataset(datadir, outputpath, is_used, weight_fact):
+def _create_dataset(datadir, outputpath, is_used, weight_fact, print_fun, nb_workers):
+    datafiles = _data_files(datadir, is_used)
+    jobs = [(path.join(datadir, filein), int(filein.startswith('GG')), weight_fact[filein])
+            for filein in datafiles]
+
+    with h5.File(outputpath, 'w') as fileout:
+        fileout.attrs['momentum_unit'] = momentum_unit
+        features = fileout.create_dataset('features', shape=(0, nb_features), dtype=np.float32,
+                                          maxshape=(None, nb_features), chunks=(chunk_rows, nb_features),
+                                          compression='gzip', shuffle=True)
+        offsets = fileout.create_dataset('offsets', data=np.zeros(1, dtype=np.int64),
+                                         maxshape=(None,), chunks=(chunk_rows,))
+        labels = fileout.create_dataset('labels', shape=(0,), dtype=np.int8,
+                                        maxshape=(None,), chunks=(chunk_rows,))
+        weights = fileout.create_dataset('weights', shape=(0,), dtype=np.float64,
+                                         maxshape=(None,), chunks=(chunk_rows,))
+
+        # Files are read in parallel, and written sequentially in order
+        nb_nodes = 0
+        with Pool(nb_workers) as pool:
+            for filein, result in zip(datafiles, pool.imap(_read_one_file, jobs)):
+                features_, sizes_, labels_, weights_ = result
+                _append(features, features_)
+                _append(offsets, nb_nodes + np.cumsum(sizes_))
+                _append(labels, labels_)
+                _append(weights, weights_)
+                nb_nodes += int(sizes_.sum())
+                print_fun('{} : {} events transfered'.format(filein, len(sizes_)))
+
+        nb_events = labels.shape[0]
+        fileout.create_dataset('nbevent', data=(nb_events,))
+        fileout.create_dataset('permutation', data=permutation(nb_events))
+    print_fun('{} events in {}\n'.format(nb_events, outputpath))
+
+
+def main(datadir, outputdir, dest=None, nb_workers=None):
     def print_(string, dest=None):
         if dest is None:
             print(string)
@@ -67,48 +115,29 @@ def _create_dataset(datadir, outputpath, is_used, weight_fact):
                 fileout.write(string + '\n')
 
     print_fun = lambda string: print_(string, dest)
-    datafiles = _data_files(datadir, is_used)
-    nb_events = _count_events(datadir, datafiles, print_fun)
-    print_fun('rearanging {} events...'.format(nb_events))
-    print_fun('...done\n')
-    fileout = h5.File(outputpath, 'w')
-
-    fileout.create_dataset('nbevent', data=(nb_events,))
-    idx_permutation = list(permutation(nb_events))
-
-    for filein in datafiles:
-        print_fun('{} start...'.format(filein))
-        datapath = path.join(datadir, filein)
-        label = filein.startswith('GG')
-        wf_file = weight_fact[filein]
-        _transfer_one_file(datapath, fileout, idx_permutation, label, wf_file)
-        print_fun('...done\n{} events transfered'.format(nb_events - len(idx_permutation)))
-
-
-def main(datadir, outputdir, dest=None):
-    is_test = lambda string: string.endswith('_01.h5')
-    weight_test = make_weightfactor_if_not_there(datadir, path.join(outputdir, 'wf_test.pkl'), is_test)
+    nb_workers = nb_workers or os.cpu_count()
+
+    weight_test = make_weightfactor_if_not_there(datadir, path.join(outputdir, 'wf_test.pkl'), is_test_file)
     print('weights calculated for testing set')
-    _create_dataset(datadir, path.join(outputdir, 'data_test.h5'), is_test, weight_test)
+    _create_dataset(datadir, path.join(outputdir, 'data_test.h5'), is_test_file, weight_test, print_fun, nb_workers)
 
-    is_train = lambda string: not is_test(string)
-    weight_train = make_weightfactor_if_not_there(datadir, path.join(outputdir, 'wf_train.pkl'), is_train)
+    weight_train = make_weightfactor_if_not_there(datadir, path.join(outputdir, 'wf_train.pkl'), is_train_file)
     print('weights calculated for training set')
-    _create_dataset(datadir, path.join(outputdir, 'data_train.h5'), is_train, weight_train)
+    _create_dataset(datadir, path.join(outputdir, 'data_train.h5'), is_train_file, weight_train, print_fun, nb_workers)
 
 
 if __name__ == '__main__':
     indir = '/data/grochette/data_nersc'
     outdir = '/data/grochette/data_nersc'
     dest = None
-    
+
     # indir = '/home/gaspar/Desktop/rawdataNERSC'
     # outdir = '/home/gaspar/Desktop/dataNERSC'
     # dest = None
-    
+
     if dest is not None:
         with open(dest, 'w') as fileout:
             pass  # empty file
-        
+
     main(indir, outdir, dest=dest)
     print('DONE')
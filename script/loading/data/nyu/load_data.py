@@ -1,14 +1,19 @@
 import pickle
 import numpy as np
-from random import shuffle
 
 from utils.in_out import print_
 import loading.model.model_parameters as param
+from loading.data.codec import codec_from_args
+from loading.data.event_store import store_path, make_store_if_not_there, load_event_store
+from loading.data.stream import StreamDataset
 
 
 
-def load_raw_data(filepath, nb_ex, mode):
-    """Loads data from the NYU project, makes it into torch Variables"""
+pt_column = 4  # p, eta, phi, E, pt, theta
+
+
+def _read_pickle(filepath, mode):
+    """Reads the whole pickle, used once to build the event store"""
 
     if mode == 'test':
         with open(filepath, 'rb') as filein:
@@ -22,19 +27,41 @@ def load_raw_data(filepath, nb_ex, mode):
                 data, label = pickle.load(filein, encoding='latin1')  # python3
             except TypeError:
                 data, label = pickle.load(filein)  # python2
+        weights = np.ones(len(label))
+
+    data = [np.array(X[:, :6]).transpose() for X in data]  # dump px, py, pz
+    return data, label, weights
+
+
+def _storage_codec():
+    return codec_from_args(param.args, momentum_columns=[0, 3, 4])  # p, E, pt
 
-    idx = [i for i in range(len(data))]
-    if param.args.shuffle_while_training or mode=='test':
-      shuffle(idx)
-    idx = idx[:nb_ex]
-    
 
-    data  = [data[i]  for i in idx]
-    label = [label[i] for i in idx]
-    # data, label = data[idx], label[idx]
+def load_raw_data(filepath, nb_ex, mode):
+    """Loads data from the NYU project, as views into its event store"""
+
+    storedir = store_path(filepath)
+    make_store_if_not_there(storedir, lambda: _read_pickle(filepath, mode), _storage_codec())
+
+    shuffle = param.args.shuffle_while_training or mode=='test'
+    data, label, _ = load_event_store(storedir, nb_ex, shuffle)
     # NOTE: Trying all samples unweighted
-    weights = [1.0 for _ in range(min(nb_ex,len(data)))]
+    weights = np.ones(len(label))
 
-     
-    data = [np.array(X[:, :6]).transpose() for X in data]  # dump px, py, pz
     return data, label, weights
+
+
+def stream_raw_data(filepath, nb_ex, mode):
+    """Streams data from the NYU project without loading it in memory"""
+
+    storedir = store_path(filepath)
+    make_store_if_not_there(storedir, lambda: _read_pickle(filepath, mode), _storage_codec())
+
+    data = StreamDataset(
+                         [storedir],
+                         nb_ex,
+                         buffer_size=param.args.shuffle_buffer,
+                         chunk_size=param.args.shuffle_block,
+                         unit_weights=True
+                         )
+    return data, None, None
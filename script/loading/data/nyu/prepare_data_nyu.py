@@ -1,91 +1,106 @@
-import pickle
+import os
+from multiprocessing import Pool
 import numpy as np
 import h5py as h5
 
-def get_weights(data, label):
-    """generates weights for NYU data"""
+from loading.data.codec import FeatureCodec
+from loading.data.event_store import EventStoreWriter
 
-    # Cropping
-    data, label = _cropping(data, label)
-    label = np.array(label)
-
-    # Weights for flatness in pt
-    weight = np.zeros(len(label))
-
-    data0 = [data[i] for i in range(len(label)) if label[i] == 0]
-    pdf, edges = np.histogram([j["pt"] for j in data0], density=True, range=[250, 300], bins=50)
-    pts = [j["pt"] for j in data0]
-    indices = np.searchsorted(edges, pts) - 1
-    inv_w = 1. / pdf[indices]
-    inv_w /= inv_w.sum()
-    weight[label == 0] = inv_w
-
-    data1 = [data[i] for i in range(len(label)) if label[i] == 1]
-    pdf, edges = np.histogram([j["pt"] for j in data1], density=True, range=[250, 300], bins=50)
-    pts = [j["pt"] for j in data1]
-    indices = np.searchsorted(edges, pts) - 1
-    inv_w = 1. / pdf[indices]
-    inv_w /= inv_w.sum()
-    print(inv_w.shape)
-    weight[label == 1] = inv_w
-    print(weight.shape)
-
-    return data, label, weight
-
-
-def _cropping(data, label):
-    data_ = [j for j in data if 250 < j["pt"] < 300 and 50 < j["mass"] < 110]
-    label_ = [label[i] for i, j in enumerate(data) if 250 < j["pt"] < 300 and 50 < j["mass"] < 110]
-    return data_, label_
 
+"""Converts NYU jets from h5 into an event store read by `nyu.load_data`.
+Jets are cropped in pt and mass, and weighted for flatness in pt.
+Run from `script/` as `python -m loading.data.nyu.prepare_data_nyu`
+"""
 
-def _transfer_one_event(filein, ev_name):
-    event = filein[ev_name]
-    if ev_name.endswith('000'):
-        print(ev_name)
+feature_fields = ['p', 'eta', 'phi', 'E', 'pt', 'theta']
+momentum_columns = [0, 3, 4]
+pt_range = [250, 300]
+mass_range = [50, 110]
 
-    # label
-    label = event.attrs['label']
 
-    # weight related
-    jet_pt = event.attrs['jet_pt']
-    jet_mass = event.attrs['jet_mass']
+def get_weights(pt, label):
+    """generates weights for NYU data, flat in pt for each label"""
 
-    # features
-    length = event.attrs['jet_length']
-    data = np.empty([length, 6])
-
-    data[:, 0] = event['p'][()]
-    data[:, 1] = event['eta'][()]
-    data[:, 2] = event['phi'][()]
-    data[:, 3] = event['E'][()]
-    data[:, 4] = event['pt'][()]
-    data[:, 5] = event['theta'][()]
-
-    event_descr = {'data': data, 'pt': jet_pt, 'mass': jet_mass}
-    return (event_descr, label)
-
-
-def _transfer_one_file(pathin):
-    filein = h5.File(pathin, 'r')
-    event_list = []
-    event_list = [_transfer_one_event(filein, event) for event in filein]
-    filein.close()
-    data_list = [data for data, _ in event_list]
-    label_list = [label for _, label in event_list]
-    return data_list, label_list
+    weight = np.zeros(len(label))
+    for label_value in [0, 1]:
+        is_label = (label == label_value)
+        pdf, edges = np.histogram(pt[is_label], density=True, range=pt_range, bins=50)
+        indices = np.searchsorted(edges, pt[is_label]) - 1
+        inv_w = 1. / pdf[indices]
+        inv_w /= inv_w.sum()
+        weight[is_label] = inv_w
+
+    return weight
+
+
+def _cropping(pt, mass):
+    return ((pt_range[0] < pt) & (pt < pt_range[1])
+            & (mass_range[0] < mass) & (mass < mass_range[1]))
+
+
+def _read_attributes(args):
+    """Reads label, jet pt and jet mass of a shard of events"""
+
+    pathin, event_names = args
+    with h5.File(pathin, 'r') as filein:
+        attrs = [filein[name].attrs for name in event_names]
+        label = np.array([attr['label'] for attr in attrs], dtype=np.int8)
+        jet_pt = np.array([attr['jet_pt'] for attr in attrs])
+        jet_mass = np.array([attr['jet_mass'] for attr in attrs])
+    return label, jet_pt, jet_mass
+
+
+def _read_features(args):
+    """Reads the features of a shard of events as (6, nb_nodes) arrays"""
+
+    pathin, event_names = args
+    with h5.File(pathin, 'r') as filein:
+        data = []
+        for name in event_names:
+            event = filein[name]
+            features = np.empty([len(feature_fields), event.attrs['jet_length']])
+            for k, field in enumerate(feature_fields):
+                event[field].read_direct(features, dest_sel=np.s_[k])
+            data.append(features)
+    return data
+
+
+def convert(pathin, pathout, nb_workers=None, nb_shards=None, codec=None):
+    """Writes kept jets of `pathin` into an event store at `pathout`, encoded
+    by `codec` (float32 by default). Quantized codecs need their ranges set.
+    """
+    nb_workers = nb_workers or os.cpu_count()
+    nb_shards = nb_shards or 4 * nb_workers
+
+    with h5.File(pathin, 'r') as filein:
+        event_names = np.array(list(filein))
+    shards = np.array_split(np.arange(len(event_names)), nb_shards)
+
+    with Pool(nb_workers) as pool:
+        # Cropping and weights only need jet-level attributes
+        attributes = pool.map(_read_attributes, [(pathin, event_names[shard]) for shard in shards])
+        label, jet_pt, jet_mass = [np.concatenate(column) for column in zip(*attributes)]
+        kept = _cropping(jet_pt, jet_mass)
+        weight = get_weights(jet_pt[kept], label[kept])
+        print('{} of {} jets kept'.format(kept.sum(), len(kept)))
+
+        # Features of kept jets, written in order
+        kept_shards = [shard[kept[shard]] for shard in shards]
+        writer = EventStoreWriter(pathout, len(feature_fields), codec)
+        nb_written = 0
+        for shard, data in zip(kept_shards, pool.imap(_read_features,
+                                                       [(pathin, event_names[shard]) for shard in kept_shards])):
+            nb_shard = len(shard)
+            writer.append(data, label[shard], weight[nb_written:nb_written + nb_shard])
+            nb_written += nb_shard
+        writer.close()
 
 
 def main():
     pathin = '/data/grochette/data_nyu/antikt-kt-test.h5'
-    pathout = '/home/nc2201/research/GCNN/antikt-kt-test.pickle'
-
-    data, label = _transfer_one_file(pathin)
-    data, label, weight = get_weights(data, label)
-    data = [x['data'] for x in data]
+    pathout = '/home/nc2201/research/GCNN/antikt-kt-test.store'
 
-    with open(pathout, 'wb') as fileout:
-        pickle.dump(output, fileout)
+    convert(pathin, pathout)
 
 if __name__ == '__main__':
     main()
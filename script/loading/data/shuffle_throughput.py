@@ -0,0 +1,72 @@
+import os
+import time
+import argparse
+from os.path import join
+import numpy as np
+
+from data_ops.batching import block_shuffle
+from loading.data.event_store import load_event_store
+
+
+"""Reports the read throughput of an event store for one epoch in fully
+random order, and in block-shuffled order (`--shuffle_block`).
+The page cache of the store is dropped before each pass, so reads hit the disk.
+Run from `script/` as
+  python -m loading.data.shuffle_throughput <storedir> --block 1000 --window 10000
+"""
+
+
+def drop_page_cache(storedir):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for name in os.listdir(storedir):
+        fd = os.open(join(storedir, name), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def read_throughput(storedir, order, nb_ex):
+    """Reads events of a store in `order`, returns (events/s, MB/s)"""
+
+    drop_page_cache(storedir)
+    X, _, _ = load_event_store(storedir, nb_ex)
+    row_bytes = X.features.dtype.itemsize * X.features.shape[1]
+
+    t0 = time.time()
+    nb_bytes = 0
+    for i in order:
+        X[i].sum()  # touch all pages of the event
+        nb_bytes += row_bytes * int(X.ends[i] - X.starts[i])
+    elapsed = time.time() - t0 + 10**-20
+    return len(order) / elapsed, nb_bytes / elapsed / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read throughput of shuffled epochs')
+    add_arg = parser.add_argument
+    add_arg('storedir', help='event store to read')
+    add_arg('--nb_ex', type=int, default=None, help='number of events read (default all)')
+    add_arg('--block', type=int, default=1000, help='consecutive events per block')
+    add_arg('--window', type=int, default=10000, help='events shuffled together after block shuffling')
+    add_arg('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    nb_ex = len(load_event_store(args.storedir, args.nb_ex or np.iinfo(np.int64).max)[1])
+    orders = [
+              ('fully random', np.random.permutation(nb_ex)),
+              ('block {} / window {}'.format(args.block, args.window),
+               block_shuffle(nb_ex, args.block, args.window)),
+              ]
+    results = []
+    for name, order in orders:
+        events_per_s, mb_per_s = read_throughput(args.storedir, order, nb_ex)
+        results.append(events_per_s)
+        print('{:<30} {:>12.0f} events/s {:>10.1f} MB/s'.format(name, events_per_s, mb_per_s))
+    print('block shuffle speedup: {:.2f}x'.format(results[1] / results[0]))
+
+
+if __name__ == '__main__':
+    main()
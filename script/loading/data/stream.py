@@ -0,0 +1,164 @@
+import os
+from os.path import join
+import numpy as np
+from numpy.random import permutation, randint
+
+from loading.data.codec import FeatureCodec
+from loading.data.event_store import EventList, is_store, open_event_store
+from data_ops.batching import batch_cost
+
+
+def find_shards(path):
+    """Event stores at `path`: the store itself, or all stores inside it"""
+
+    if is_store(path):
+        return [path]
+    return sorted(join(path, name) for name in os.listdir(path) if is_store(join(path, name)))
+
+
+def choose_chunks(chunks, nb_events):
+    """Random chunks (shard_id, start, stop) holding `nb_events` events, the
+    last one cut short, in shard order for local reads. Stores list events
+    file by file, so that the first events are not a random subset
+    """
+
+    if nb_events >= sum(stop - start for _, start, stop in chunks):
+        return list(chunks)
+    chosen = []
+    nb_left = nb_events
+    for k in permutation(len(chunks)):
+        if nb_left <= 0:
+            break
+        shard_id, start, stop = chunks[k]
+        stop = min(stop, start + nb_left)
+        chosen.append((shard_id, start, stop))
+        nb_left -= stop - start
+    return sorted(chosen)
+
+
+def _as_lists(batch):
+    batch_X, batch_y, batch_w = zip(*batch)
+    return list(batch_X), list(batch_y), list(batch_w)
+
+
+class StreamDataset():
+    """Streams events from event stores (shards) without loading them in memory.
+
+    Shards are cut in chunks of `chunk_size` consecutive events. With
+    `nb_ex`, events of random chunks are streamed (see `choose_chunks`). When
+    shuffling, chunks are read in random order and events go through a
+    shuffle buffer holding at most `buffer_size` events, so memory does not
+    grow with the number of events. `chunk_size` 0 uses `default_chunk_size`.
+    `transform`, if given, maps the EventList of each chunk read.
+    """
+
+    default_chunk_size = 1000
+
+    def __init__(self, storedirs, nb_ex=None, buffer_size=10000, chunk_size=0,
+                 unit_weights=False, transform=None, chunks=None):
+        self.storedirs = storedirs
+        self.transform = transform
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size = chunk_size or self.default_chunk_size
+        self.unit_weights = unit_weights
+        stores = [open_event_store(storedir) for storedir in storedirs]
+        self.shards = [columns for _, columns in stores]
+        self.codecs = [FeatureCodec.from_meta(meta) for meta, _ in stores]
+
+        if chunks is None:
+            chunks = [(shard_id, start, min(start + chunk_size, len(shard['labels'])))
+                      for shard_id, shard in enumerate(self.shards)
+                      for start in range(0, len(shard['labels']), chunk_size)]
+        nb_events_total = sum(stop - start for _, start, stop in chunks)
+        if nb_ex is None:
+            self.nb_events = nb_events_total
+        else:
+            self.nb_events = min(nb_ex, nb_events_total)
+        self.chunks = choose_chunks(chunks, self.nb_events)
+
+    def __len__(self):
+        return self.nb_events
+
+    def __getitem__(self, i):
+        """Only supports `[:n]`, streaming `n` events of random chunks of this dataset"""
+
+        if not isinstance(i, slice) or i.start not in (None, 0) or i.step not in (None, 1):
+            raise IndexError('StreamDataset only supports slices [:n]')
+        return StreamDataset(
+                             self.storedirs,
+                             nb_ex=len(range(self.nb_events)[i]),
+                             buffer_size=self.buffer_size,
+                             chunk_size=self.chunk_size,
+                             unit_weights=self.unit_weights,
+                             transform=self.transform,
+                             chunks=self.chunks
+                             )
+
+    def stored_nb_nodes(self):
+        """Number of nodes of each streamed event as stored, before `transform`"""
+
+        return np.concatenate([np.diff(np.asarray(self.shards[shard_id]['offsets'][start:stop + 1]))
+                               for shard_id, start, stop in self.chunks] or [np.zeros(0, dtype=int)])
+
+    def _read_chunk(self, shard_id, start, stop):
+        shard = self.shards[shard_id]
+        offsets = np.asarray(shard['offsets'][start:stop + 1])
+        features = self.codecs[shard_id].decode(shard['features'][offsets[0]:offsets[-1]])
+        offsets = offsets - offsets[0]
+        X = EventList(features, offsets[:-1], offsets[1:])
+        if self.transform is not None:
+            X = self.transform(X)
+        y = np.asarray(shard['labels'][start:stop])
+        if self.unit_weights:
+            w = np.ones(stop - start)
+        else:
+            w = np.asarray(shard['weights'][start:stop])
+        return zip(X, y.tolist(), w.tolist())
+
+    def events(self, shuffle=False):
+        """Yields (X, y, w) for every event, once"""
+
+        if not shuffle:
+            for chunk in self.chunks:
+                for event in self._read_chunk(*chunk):
+                    yield event
+            return
+
+        buffer = []
+        for chunk_idx in permutation(len(self.chunks)):
+            for event in self._read_chunk(*self.chunks[chunk_idx]):
+                if len(buffer) < self.buffer_size:
+                    buffer.append(event)
+                    continue
+                k = randint(len(buffer))
+                yield buffer[k]
+                buffer[k] = event
+        for k in permutation(len(buffer)):
+            yield buffer[k]
+
+    def batches(self, batch_size, shuffle=False, node_cap=None, node_budget=0, cost='edges'):
+        """Yields batches of `batch_size` events as lists (X, y, w).
+        The last incomplete batch is dropped, as in `batching.get_batches`.
+        Events with more than `node_cap` nodes are skipped.
+        With `node_budget` > 0, batches are cut when their padded work
+        `batching.batch_cost` would exceed the budget instead, and the last
+        batch is kept
+        """
+
+        batch = []
+        largest = 0
+        for event in self.events(shuffle):
+            nb_nodes = event[0].shape[1]
+            if node_cap is not None and nb_nodes > node_cap:
+                continue
+            if node_budget > 0 and batch and \
+               batch_cost(len(batch) + 1, max(largest, nb_nodes), cost) > node_budget:
+                yield _as_lists(batch)
+                batch, largest = [], 0
+            batch.append(event)
+            largest = max(largest, nb_nodes)
+            if node_budget <= 0 and len(batch) == batch_size:
+                yield _as_lists(batch)
+                batch = []
+        if node_budget > 0 and batch:
+            yield _as_lists(batch)
@@ -0,0 +1,56 @@
+import logging
+import numpy as np
+
+from loading.data.event_store import EventList
+
+
+"""Load-time truncation of events to their highest pT nodes.
+
+Kernels are O(N^2) per event, and the largest event of a batch sets the
+padded size of the whole batch. Nodes of each event are sorted by
+decreasing pT, nodes below `min_pt` are dropped, and only the first
+`max_nodes` are kept.
+"""
+
+
+def is_truncating(max_nodes, min_pt):
+    return max_nodes > 0 or min_pt is not None
+
+
+def truncate_events(X, pt_column, max_nodes=0, min_pt=None):
+    """Truncates all events of an EventList at once.
+    Returns an EventList holding kept nodes, still encoded by `X.codec`.
+    """
+
+    sizes = np.asarray(X.nb_nodes, dtype=np.int64)
+    event_of_row = np.repeat(np.arange(len(sizes)), sizes)
+    features = np.asarray(X.features[X.node_rows()])
+    pt = X.codec.decode(features)[:, pt_column]
+
+    kept = np.ones(len(features), dtype=bool) if min_pt is None else pt >= min_pt
+    kept = np.where(kept)[0]
+    # Rows grouped by event, by decreasing pT
+    kept = kept[np.lexsort((-pt[kept], event_of_row[kept]))]
+    new_sizes = np.bincount(event_of_row[kept], minlength=len(sizes))
+    if max_nodes > 0:
+        rank = np.arange(len(kept)) - np.repeat(np.cumsum(new_sizes) - new_sizes, new_sizes)
+        kept = kept[rank < max_nodes]
+        new_sizes = np.minimum(new_sizes, max_nodes)
+
+    new_starts = np.cumsum(new_sizes) - new_sizes
+    return EventList(features[kept], new_starts, new_starts + new_sizes, X.codec)
+
+
+def node_count_summary(sizes):
+    sizes = np.asarray(sizes)
+    if len(sizes) == 0:
+        return 'no events'
+    pcts = np.percentile(sizes, [50, 90, 99])
+    return 'mean {:.1f}, median {:.0f}, 90% {:.0f}, 99% {:.0f}, max {}, total {}'.format(
+                                          sizes.mean(), pcts[0], pcts[1], pcts[2],
+                                          sizes.max(), sizes.sum())
+
+
+def log_truncation(before, after):
+    logging.info('  nodes per event before truncation: {}'.format(node_count_summary(before)))
+    logging.info('  nodes per event after truncation:  {}'.format(node_count_summary(after)))
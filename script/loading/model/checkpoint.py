@@ -0,0 +1,85 @@
+import os
+import logging
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+"""Training checkpoints: state dicts of the model and optimizer, with the
+learning rate, the number of epochs done and the best test scores.
+
+Checkpoints are written by `torch.save` to a temporary file renamed over
+the previous one, so that an interrupted write never leaves a truncated
+checkpoint, and loaded memory-mapped where torch supports it (2.1 and later).
+"""
+
+
+def checkpoint_path(savedir, name, best=False):
+    """`<name>.pt` holds the last epoch, `<name>_best.pt` the best model"""
+
+    return join(savedir, name + ('_best.pt' if best else '.pt'))
+
+
+def _to_cpu(state):
+    # Copies, so that training goes on while the checkpoint is written
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: _to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
+
+
+def make_checkpoint(net, optimizer, epoch, lrate, best_inv_fpr, best_auc):
+    return {
+            'model': _to_cpu(net.state_dict()),
+            'optimizer': _to_cpu(optimizer.state_dict()),
+            # Plain numbers, as numpy scalars cannot be loaded with `weights_only`
+            'epoch': int(epoch),
+            'lrate': float(lrate),
+            'best_inv_fpr': float(best_inv_fpr),
+            'best_auc': float(best_auc),
+            }
+
+
+def write_checkpoint(checkpoint, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fileout:
+        torch.save(checkpoint, fileout)
+        fileout.flush()
+        os.fsync(fileout.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """Memory-maps a checkpoint: tensors are read from disk as they are copied into the model.
+    Versions of torch without `mmap` (before 2.1) read it whole
+    """
+
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+
+class CheckpointWriter():
+    """Writes checkpoints in a background thread, in the order they are saved"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(1)
+
+    def save(self, checkpoint, path):
+        future = self.executor.submit(write_checkpoint, checkpoint, path)
+        future.add_done_callback(lambda done: self._log(done, path))
+
+    def _log(self, done, path):
+        if done.exception() is not None:
+            logging.error('Issue saving checkpoint {}: {}'.format(path, done.exception()))
+        else:
+            logging.warning('Checkpoint saved to {}'.format(path))
+
+    def close(self):
+        """Waits for pending writes"""
+
+        self.executor.shutdown(wait=True)
@@ -3,13 +3,31 @@ import pickle
 from os.path import exists, join
 
 from model.build_model import init_network
+from loading.model.checkpoint import checkpoint_path, load_checkpoint
+
+def _get_restore_path(savedir, name):
+    # Last epoch's checkpoint if any, otherwise the best model's
+    for path in [checkpoint_path(savedir, name), checkpoint_path(savedir, name, best=True)]:
+        if exists(path):
+            return path
+    return None
+
 
 def make_net_if_not_there(args, savedir):
     """
-    Checks for existing network, initiates one if non existant
+    Checks for existing network, initiates one if non existant.
+    Returns the network, and the checkpoint it was restored from, or None
     """
     model_path = join(savedir, args.name)
-    if exists(model_path + '.pkl'):
+    checkpoint = None
+    restore_path = _get_restore_path(savedir, args.name)
+    if restore_path is not None:
+        checkpoint = load_checkpoint(restore_path)
+        net = init_network()
+        net.load_state_dict(checkpoint['model'])
+        logging.warning('Network recovered from {}, after {} epochs'.format(restore_path, checkpoint['epoch']))
+    elif exists(model_path + '.pkl'):
+        # Whole pickled network, saved before checkpoints
         with open(model_path + '.pkl', 'rb') as filein:
             net = pickle.load(filein)
         logging.warning('Network recovered from previous training')
@@ -24,4 +42,4 @@ def make_net_if_not_there(args, savedir):
     logging.info('parameters : {}'.format(
                               sum([param.numel() for param in net.parameters()])
                               ))
-    return net
+    return net, checkpoint
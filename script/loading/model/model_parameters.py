@@ -13,13 +13,46 @@ def init(args_in):
     # Update run-specific arguments
     args.cuda = args_in.cuda
     args.plot = args_in.plot
+    args.checkpoint = args_in.checkpoint
     args.nbtrain  = args_in.nbtrain
     args.nbtest   = args_in.nbtest
     args.nbprint  = args_in.nbprint
     args.nb_batch = args_in.nb_batch
     args.shuffle_while_training = args_in.shuffle_while_training
     args.sorted_training = args_in.sorted_training
+    args.bucketed_training = args_in.bucketed_training
+    args.node_budget = args_in.node_budget
+    args.budget_cost = args_in.budget_cost
+    args.online_train_metrics = args_in.online_train_metrics
+    args.train_metrics_reservoir = args_in.train_metrics_reservoir
+    args.eval_batch = args_in.eval_batch
+    args.eval_node_budget = args_in.eval_node_budget
+    args.packed_batches = args_in.packed_batches
+    args.batch_store = args_in.batch_store
+    args.batch_store_dir = args_in.batch_store_dir
     args.nb_extra_nodes = args_in.nb_extra_nodes
+    args.stream = args_in.stream
+    args.shuffle_buffer = args_in.shuffle_buffer
+    args.shuffle_block = args_in.shuffle_block
+    args.weight_sampling = args_in.weight_sampling
+    args.curriculum_start = args_in.curriculum_start
+    args.curriculum_epochs = args_in.curriculum_epochs
+    args.curriculum_schedule = args_in.curriculum_schedule
+    args.prefetch = args_in.prefetch
+    args.prefetch_workers = args_in.prefetch_workers
+    args.seed = args_in.seed
+    args.cache_dir = args_in.cache_dir
+    args.cache_size = args_in.cache_size
+    args.storage_dtype = args_in.storage_dtype
+    args.log_momenta = args_in.log_momenta
+    # Node cut is kept from the run which created the model
+    if not hasattr(args, 'max_nodes'):
+      args.max_nodes = args_in.max_nodes
+      args.min_pt = args_in.min_pt
+    if not hasattr(args, 'derived_features'):
+      args.derived_features = args_in.derived_features
+    if not hasattr(args, 'module_geometry'):
+      args.module_geometry = args_in.module_geometry
   except:
     args = args_in
     logging.warning("Model arguments created")
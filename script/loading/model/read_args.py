@@ -1,8 +1,8 @@
 import argparse
 from os.path import exists, join
 
-def read_args():
-  """Parses stdin for arguments used for training or network initialisation"""
+def read_args(argv=None):
+  """Parses stdin, or `argv` if given, for arguments used for training or network initialisation"""
 
   parser = argparse.ArgumentParser(description='simple arguments to train GCNN')
   add_arg = parser.add_argument
@@ -17,10 +17,39 @@ def read_args():
   add_arg('--quiet', dest='quiet', help='reduces print', action='store_true')
   add_arg('--plot', dest='plot', help='type of plotting to perform',type=str,default=None)
   add_arg('--save_best_model', dest='save_best_model', help='saves best model based upon test 1/FPR',action='store_true')
+  add_arg('--checkpoint', dest='checkpoint', help='Checkpoint training after every epoch, and resume from the last checkpoint', action='store_true')
   add_arg('--tpr_target', dest='tpr_target', help='Sets TPR score at which 1/FPR is evaluated',type=float,default=0.5)
   add_arg('--no_shuffle', dest='shuffle_while_training',help='Process samples in order of dataset for every epoch',action='store_false')
   add_arg('--nb_batch', dest='nb_batch',help='minibatch size',type=int, default=1)
   add_arg('--sorted_training', dest='sorted_training',help='Group similar-sized samples in training (less 0-padding->faster, but worse gradient estimates)',action='store_true')
+  add_arg('--bucketed_training', dest='bucketed_training', help='Shuffle samples within this many buckets of similar node counts, batch per bucket and shuffle batches (0 to disable)', type=int, default=0)
+  add_arg('--node_budget', dest='node_budget', help='Cap the padded work of each batch, B*N_max^2 or B*N_max (see --budget_cost), instead of its number of samples (0 to disable)', type=int, default=0)
+  add_arg('--budget_cost', dest='budget_cost', help='Padded work counted by --node_budget: edges B*N_max^2, or nodes B*N_max', choices=['edges', 'nodes'], default='edges')
+  add_arg('--online_train_metrics', dest='online_train_metrics', help='Compute train AUC, loss and 1/FPR from predictions made while training, instead of testing on --nbtest training samples', action='store_true')
+  add_arg('--train_metrics_reservoir', dest='train_metrics_reservoir', help='With --online_train_metrics, keep a uniform subsample of this many predictions (0 keeps all)', type=int, default=0)
+  add_arg('--eval_batch', dest='eval_batch', help='Minibatch size when testing, without autograd (0 for --nb_batch)', type=int, default=0)
+  add_arg('--eval_node_budget', dest='eval_node_budget', help='Node budget of test batches (0 for --node_budget)', type=int, default=0)
+  add_arg('--packed_batches', dest='packed_batches', help='Feed batches as concatenated nodes with block-diagonal graphs instead of zero-padded samples. Needs --combine_kernels Affine or Fixed_Balanced, and kernels other than QCDAware', action='store_true')
+  add_arg('--batch_store', dest='batch_store', help='Pad samples once per run into stores of size buckets, from which every epoch serves batches (not with --stream)', action='store_true')
+  add_arg('--batch_store_dir', dest='batch_store_dir', help='Directory where batch stores are memory-mapped instead of held in memory', type=str, default=None)
+  add_arg('--stream', dest='stream', help='Stream samples from disk instead of loading them in memory', action='store_true')
+  add_arg('--shuffle_buffer', dest='shuffle_buffer', help='Number of samples held in the shuffle buffer when streaming', type=int, default=10000)
+  add_arg('--shuffle_block', dest='shuffle_block', help='Shuffle blocks of this many consecutive samples, then samples within --shuffle_buffer, for local disk reads (0 for fully random order)', type=int, default=0)
+  add_arg('--weight_sampling', dest='weight_sampling', help='Draw training samples in proportion to their weight instead of weighting their loss (not with --stream)', action='store_true')
+  add_arg('--curriculum_start', dest='curriculum_start', help='Graph-size curriculum: train the first epoch on samples of at most this many nodes (0 to disable)', type=int, default=0)
+  add_arg('--curriculum_epochs', dest='curriculum_epochs', help='Number of epochs over which the curriculum node cap grows to the largest sample', type=int, default=10)
+  add_arg('--curriculum_schedule', dest='curriculum_schedule', help='Growth of the curriculum node cap over epochs', choices=['linear', 'geometric'], default='linear')
+  add_arg('--prefetch', dest='prefetch', help='Number of batches prepared in background while training (0 to disable)', type=int, default=2)
+  add_arg('--prefetch_workers', dest='prefetch_workers', help='Number of threads preparing batches', type=int, default=1)
+  add_arg('--seed', dest='seed', help='Random seed for choosing and shuffling samples', type=int, default=None)
+  add_arg('--cache_dir', dest='cache_dir', help='Directory, ideally node-local, where loaded samples are cached between runs (requires --seed)', type=str, default=None)
+  add_arg('--cache_size', dest='cache_size', help='Size cap of the data cache in GB', type=float, default=50.)
+  add_arg('--max_nodes', dest='max_nodes', help='Keep the max_nodes highest pT nodes of each sample (0 keeps all). Kept from the first run of a model', type=int, default=0)
+  add_arg('--min_pt', dest='min_pt', help='Drop nodes below this pT. Kept from the first run of a model', type=float, default=None)
+  add_arg('--derived_features', dest='derived_features', help='Append pT / mean pT and coordinates relative to the event axis to node features, computed at load time. Kept from the first run of a model', action='store_true')
+  add_arg('--module_geometry', dest='module_geometry', help='IceCube: map hits to detector module IDs, and read layer 0 distances from a table of module distances. Kept from the first run of a model', action='store_true')
+  add_arg('--storage_dtype', dest='storage_dtype', help='dtype of node features on disk and in memory', choices=['float32', 'float16', 'int16'], default='float32')
+  add_arg('--log_momenta', dest='log_momenta', help='Store momenta in log scale (always done with float16 and int16 storage)', action='store_true')
 
   # Kernel-specific
   add_arg('--kernels', dest='kernels', help='List of kernels. Add \'-layerwise\' to kernel name to create one kernel instance per layer. E.g. \'MLPDirected-layerwise\'', default='Gaussian',nargs='+')
@@ -44,7 +73,7 @@ def read_args():
   add_arg('--conv_type', dest='conv_type',help='Type of graph convolution to use in gnn layers',default='ResGNN')
 
 
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
   return args
 
 
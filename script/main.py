@@ -1,12 +1,88 @@
 import logging
+import random
 import os.path as path
+import numpy as np
 
 from experiment_handler import train_model
 from utils.in_out import make_dir_if_not_there
+from loading.data.cache import cache_key, cached_load, source_signature
+from loading.data.stream import StreamDataset
+from loading.data.truncation import is_truncating, truncate_events, node_count_summary, log_truncation
+from loading.data.derived import add_derived_features, nb_derived, feature_stats
 import loading.model.read_args as ra
 import loading.model.model_parameters as param
 
 
+def preprocess(data):
+    """Applies the --max_nodes / --min_pt node cut and --derived_features to loaded data"""
+
+    X, y, w = data
+    max_nodes, min_pt = param.args.max_nodes, param.args.min_pt
+    stages = []
+    if is_truncating(max_nodes, min_pt):
+        stages.append(lambda events: truncate_events(events, param.args.pt_column, max_nodes, min_pt))
+    if param.args.derived_features:
+        periodic_coord = 2 if param.args.data == 'NERSC' else None  # phi, as in kernels
+        stages.append(lambda events: add_derived_features(
+                                                          events,
+                                                          param.args.pt_column,
+                                                          param.args.spatial_coords,
+                                                          periodic_coord
+                                                          ))
+    if len(stages) == 0:
+        return data
+
+    def transform(events):
+        for stage in stages:
+            events = stage(events)
+        return events
+
+    if isinstance(X, StreamDataset):
+        # Applied to chunks as they are read
+        if is_truncating(max_nodes, min_pt):
+            logging.info('  nodes per event before truncation: {}'.format(node_count_summary(X.stored_nb_nodes())))
+        X.transform = transform
+        return X, y, w
+    X_out = transform(X)
+    if is_truncating(max_nodes, min_pt):
+        log_truncation(X.nb_nodes, X_out.nb_nodes)
+    return X_out, y, w
+
+
+def load_data(load_fn, datapath, nb_ex, *load_args):
+    """Calls `load_fn` and preprocesses events, through the data cache if enabled"""
+
+    load = lambda: preprocess(load_fn(datapath, nb_ex, *load_args))
+    if param.args.seed is not None:
+        # Seed each load separately, so samples do not depend on other loads hitting the cache
+        np.random.seed(int(cache_key(seed=param.args.seed, path=datapath, args=load_args)[:8], 16))
+    if param.args.cache_dir is None or param.args.stream:
+        return load()
+    if param.args.seed is None:
+        logging.warning("Data cache needs --seed to reproduce samples, not used")
+        return load()
+
+    key = cache_key(
+                    data=param.args.data,
+                    path=path.abspath(datapath),
+                    source=source_signature(datapath),
+                    nb_ex=nb_ex,
+                    load_args=load_args,
+                    seed=param.args.seed,
+                    shuffle=param.args.shuffle_while_training,
+                    storage=(param.args.storage_dtype, param.args.log_momenta),
+                    truncation=(param.args.max_nodes, param.args.min_pt, param.args.pt_column),
+                    derived=param.args.derived_features,
+                    module_geometry=param.args.module_geometry,
+                    )
+    return cached_load(
+                       load,
+                       key,
+                       param.args.cache_dir,
+                       param.args.cache_size * 2**30
+                       )
+
+
 def main():
     """Reads args, loads specified dataset, and trains model"""
 
@@ -31,61 +107,105 @@ def main():
     # Set global model parameters
     # Restores model parameters if some training has already occurred
     param.init(args)
+    if param.args.seed is not None:
+        random.seed(param.args.seed)
+        np.random.seed(param.args.seed)
+
+    if param.args.weight_sampling and param.args.stream:
+        raise ValueError('--weight_sampling needs random access to samples, and cannot be used with --stream')
+    if param.args.batch_store and param.args.stream:
+        raise ValueError('--batch_store holds padded samples in memory or mapped files, and cannot be used with --stream')
+    if param.args.packed_batches and param.args.combine_kernels == 'Affine_Normalized':
+        raise ValueError('--combine_kernels Affine_Normalized rescales adjacencies by their min and max over the padded batch, '
+                         'and cannot be used with --packed_batches: use --combine_kernels Affine or Fixed_Balanced')
+    if param.args.packed_batches and 'QCDAware' in [kernel.split('-')[0] for kernel in param.args.kernels]:
+        raise ValueError('--kernels QCDAware renormalizes distances over padded samples, and cannot be used with --packed_batches')
 
     # Dataset-specific operations
     logging.info("Loading data...")
+    param.args.module_id_column = None
     if param.args.data == 'NYU':
-        from loading.data.nyu.load_data import load_raw_data
+        from loading.data.nyu.load_data import load_raw_data, stream_raw_data, pt_column
+        if param.args.stream:
+            load_raw_data = stream_raw_data
+        param.args.first_fm = 6
+        param.args.spatial_coords = [1,2]
+        param.args.pt_column = pt_column
         datadir = '/misc/vlgscratch4/BrunaGroup/data_nyu/'
         trainfile = 'antikt-kt-train-gcnn.pickle'
         testfile  = 'antikt-kt-test.pickle'
-        train_X, train_y, train_w = load_raw_data(
+        train_X, train_y, train_w = load_data(
+                                                  load_raw_data,
                                                   datadir+trainfile, 
                                                   param.args.nbtrain,
                                                   'train'
                                                   )
-        test_X,  test_y,  test_w  = load_raw_data(
+        test_X,  test_y,  test_w  = load_data(
+                                                  load_raw_data,
                                                   datadir+testfile, 
                                                   param.args.nbtest, 
                                                   'test'
                                                   )
-        param.args.first_fm = 6
-        param.args.spatial_coords = [1,2]
     elif param.args.data == 'NERSC':
-        from loading.data.nersc.load_data import load_raw_data
+        from loading.data.nersc.load_data import load_raw_data, stream_raw_data, pt_column
+        if param.args.stream:
+            load_raw_data = stream_raw_data
+        param.args.first_fm = 5
+        param.args.spatial_coords = [1,2]
+        param.args.pt_column = pt_column
         datadir = '/misc/vlgscratch4/BrunaGroup/data_nersc'
-        train_X, train_y, train_w = load_raw_data(
+        train_X, train_y, train_w = load_data(
+                                                  load_raw_data,
                                                   datadir, 
                                                   param.args.nbtrain, 
                                                   'train'
                                                   )
-        test_X,  test_y,  test_w  = load_raw_data(
+        test_X,  test_y,  test_w  = load_data(
+                                                  load_raw_data,
                                                   datadir, 
                                                   param.args.nbtest, 
                                                   'test'
                                                   )
-        param.args.first_fm = 5
-        param.args.spatial_coords = [1,2]
     elif param.args.data == 'ICECUBE':
-        from loading.data.icecube.load_data import load_raw_data
+        from loading.data.icecube.load_data import load_raw_data, stream_raw_data, pt_column
+        from loading.data.icecube.load_data import module_id_column, module_sqdist
+        from model.kernels.general import set_module_sqdist
+        if param.args.stream:
+            load_raw_data = stream_raw_data
+        param.args.first_fm = 6
+        param.args.spatial_coords = [0,1,2]
+        param.args.pt_column = pt_column
+        if param.args.module_geometry:
+            param.args.module_id_column = module_id_column
         # datadir = '/global/homes/n/njchoma/data/njc_data'
         datadir = '/home/nc2201/data/icecube'
         trainfile = 'train.pickle'
         testfile  = 'test.pickle'
-        train_X, train_y, train_w = load_raw_data(
+        train_X, train_y, train_w = load_data(
+                                                  load_raw_data,
                                                   path.join(datadir,trainfile), 
                                                   param.args.nbtrain
                                                   )
-        test_X,  test_y,  test_w  = load_raw_data(
+        test_X,  test_y,  test_w  = load_data(
+                                                  load_raw_data,
                                                   path.join(datadir,testfile), 
                                                   param.args.nbtest
                                                   )
-        param.args.first_fm = 6
-        param.args.spatial_coords = [0,1,2]
+        if param.args.module_geometry:
+            set_module_sqdist(module_sqdist(path.join(datadir,trainfile)))
     else:
         raise ValueError('--data should be NYU or NERSC')
     logging.info("Data loaded")
 
+    if param.args.derived_features:
+        param.args.norm_pt_column = param.args.first_fm
+        param.args.first_fm += nb_derived(param.args.spatial_coords)
+        # Statistics are kept from the run which created the model
+        if getattr(param.args, 'feature_stats', None) is None:
+            param.args.feature_stats = feature_stats(train_X).to_dict()
+            logging.info('Feature means: {}'.format(np.round(param.args.feature_stats['mean'], 3)))
+            logging.info('Feature stdevs: {}'.format(np.round(param.args.feature_stats['std'], 3)))
+
     # Update number train, test in case requested more data than available
     param.args.nbtrain = len(train_X)
     param.args.nbtest  = len(test_X)
@@ -6,6 +6,8 @@ from model.kernels.build_kernels import get_kernels
 from model.kernels.build_combine_kernels import get_combine_kernels
 from model.gnn.build_layers import get_layers
 from model.readout.readout import get_readout
+import loading.model.model_parameters as param
+from utils.packed import PackedGraphs
 
 class GNN(nn.Module):
   '''
@@ -20,21 +22,45 @@ class GNN(nn.Module):
                              combine_kernels = get_combine_kernels()
                              )
     self.readout = get_readout()
+    self.module_id_column = getattr(param.args, 'module_id_column', None)
 
-  def forward(self, emb, mask, batch_nb_nodes, plotting=None):
-    batch_size, nb_pts, fmap  = emb.size()
+  def forward(self, emb, batch_nb_nodes, plotting=None):
+    '''
+    `emb` is a zero-padded (batch, nb_node, fmap) batch, or a packed
+    (nb_nodes_total, fmap) batch of all nodes (see `utils.packed`)
+    '''
+    packed = emb.dim() == 2
+
+    # Detector module of each node, read by kernels instead of used as a feature
+    node_ids = None
+    col = getattr(self, 'module_id_column', None)
+    if col is not None:
+      node_ids = emb[..., col].round().long()
+      emb = torch.cat((emb[..., :col], emb[..., col+1:]), -1)
 
     # Create dummy first adjacency matrix
-    adj = Variable(torch.ones(batch_size, nb_pts, nb_pts))
-    if emb.is_cuda:
-      adj = adj.cuda()
+    if packed:
+      batch_nb_nodes = PackedGraphs(batch_nb_nodes)
+      adj = batch_nb_nodes.ones(emb)
+    else:
+      batch_size, nb_pts, fmap  = emb.size()
+      adj = Variable(torch.ones(batch_size, nb_pts, nb_pts))
+      if emb.is_cuda:
+        adj = adj.cuda()
 
     # Run through layers
     for i, layer in enumerate(self.layers):
-      emb, adj = layer(emb, adj, mask, batch_nb_nodes)
+      emb, adj = layer(emb, adj, batch_nb_nodes, node_ids=node_ids)
       # Apply any plotting
       if plotting is not None:
-        plotting.plot_graph(emb[0].data.cpu().numpy(),adj[0].data.cpu().numpy(),i)
+        emb0, adj0 = batch_nb_nodes.first_graph(emb, adj) if packed else (emb[0], adj[0])
+        plotting.plot_graph(emb0.data.cpu().numpy(),adj0.data.cpu().numpy(),i)
+
+    # Free adjacencies saved by kernels before readout
+    del adj
+    for layer in self.layers:
+      for kernel in layer.kernels:
+        kernel.release()
 
     # Apply final readout and return
-    return self.readout(emb, mask, batch_nb_nodes)
+    return self.readout(emb, batch_nb_nodes)
@@ -5,7 +5,7 @@ import torch.nn as nn
 from model.gnn import graphconv as gc
 from model.node_update import get_node_update
 from model.utils import graph_operators as graph_ops
-from utils.tensor import spatialnorm, mask_embedding
+from utils.tensor import spatialnorm, mask_embedding, mask_adjacency
 
 class GNN_Layer(nn.Module):
   def __init__(self,kernels,combine_kernels,fmap_in,fmap_out,layer_nb):
@@ -30,7 +30,7 @@ class GNN_Layer(nn.Module):
     # Define method for updating nodes
     self.node_update = get_node_update(fmap_in, fmap_out)
 
-  def forward(self, emb_in, adj_in, adj_mask, batch_nb_nodes):
+  def forward(self, emb_in, adj_in, batch_nb_nodes, node_ids=None):
     # Update adjacency matrix
     adj_matrices = []
     for kernel in self.kernels:
@@ -42,27 +42,27 @@ class GNN_Layer(nn.Module):
                                     adj_in, 
                                     emb_in,
                                     layer=self.layer_nb, 
-                                    mask=adj_mask,
-                                    batch_nb_nodes=batch_nb_nodes
+                                    batch_nb_nodes=batch_nb_nodes,
+                                    node_ids=node_ids
                                     ))
     adj = self.combine_kernels(adj_in, adj_matrices)
     # Apply mask only if batch size not 1
     if emb_in.size()[0] != 1:
-      adj = torch.mul(adj, adj_mask)
+      adj = mask_adjacency(adj, batch_nb_nodes)
 
     # Join operators with adjacency matrix
     operators = gc.join_operators(adj, self.operators)
 
     # Apply spatial norm
     if self.layer_nb != 0:
-      emb_update, _, _ = spatialnorm(emb_in, batch_nb_nodes, adj_mask)
+      emb_update, _, _ = spatialnorm(emb_in, batch_nb_nodes)
     else:
       emb_update = emb_in
     # Mask embedding for numerical stability
     # Otherwise can get nan / inf errors
-    emb_update = mask_embedding(emb_update, adj_mask)
+    emb_update = mask_embedding(emb_update, batch_nb_nodes)
     # Apply convolution
-    emb_update = self.convolution(operators, emb_update, batch_nb_nodes, adj_mask)
+    emb_update = self.convolution(operators, emb_update, batch_nb_nodes)
 
     # Apply node update
     emb = self.node_update(emb_in, emb_update)
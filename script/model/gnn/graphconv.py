@@ -7,6 +7,7 @@ import torch.nn.functional as F
 
 import loading.model.model_parameters as param
 from utils.tensor import check_for_nan, mean_with_padding
+from utils.packed import is_packed
 
 def get_convolution_layer(fmap_in, fmap_out, nb_operators, *args, **kwargs):
   
@@ -58,6 +59,9 @@ def join_operators(adj, operator_iter):
   if not operator_iter:  # empty list
       return None
   ops = tuple(operator(adj) for operator in operator_iter)
+  if adj.dim() == 1:
+      # Packed batch : (nb_op, nb_edges) edge values
+      return torch.stack(ops, 0)
   ops = torch.cat(ops, 1)
 
   return ops
@@ -82,25 +86,28 @@ class GraphOpConv(nn.Module):
         super(GraphOpConv, self).__init__()
         self.fc = nn.Linear(in_fm * (nb_op + 1), out_fm)
 
-    def forward(self, ops, emb_in, batch_nb_nodes, adj_mask):
+    def forward(self, ops, emb_in, batch_nb_nodes):
         """Defines the computation performed at every call.
         Computes graph convolution with graph operators `ops`,
         on embedding `emb_in`
         """
 
-        batch_size, nb_node, fmap = emb_in.size()
+        nb_node = emb_in.size()[-2]
 
         # Get mean of features across all nodes
         # Must use batch mean with padding
         '''
         avg = mean_with_padding(
                                 emb_in, 
-                                batch_nb_nodes, 
-                                adj_mask
+                                batch_nb_nodes
                                 ).unsqueeze(1).expand_as(emb_in)
         '''
         if ops is None:  # permutation invariant kernel
             spread = (emb_in, avg,)
+        elif is_packed(batch_nb_nodes):
+            # Block-diagonal operators
+            spread = tuple(batch_nb_nodes.spread(op, emb_in) for op in ops)
+            spread = (emb_in,) + spread
         else:
             spread = torch.bmm(ops, emb_in)
             # Split spreading from different operators 
@@ -109,7 +116,7 @@ class GraphOpConv(nn.Module):
             spread = spread.split(nb_node, 1)
             # spread = (emb_in, avg,) + spread  
             spread = (emb_in,) + spread  
-        spread = torch.cat(spread, 2)
+        spread = torch.cat(spread, -1)
 
         emb_out = self.fc(spread)
 
@@ -132,15 +139,15 @@ class ResGOpConv(nn.Module):
     self.gconv_lin = GraphOpConv(in_fm, half_out_fm, nb_op)
     self.gconv_nlin = GraphOpConv(in_fm, half_out_fm, nb_op)
 
-  def forward(self, ops, emb_in, batch_nb_nodes, adj_mask):
-    linear = self.gconv_lin(ops, emb_in, batch_nb_nodes, adj_mask)
+  def forward(self, ops, emb_in, batch_nb_nodes):
+    linear = self.gconv_lin(ops, emb_in, batch_nb_nodes)
     check_for_nan(linear, 'NAN in resgconv : linear')
 
-    nlinear = self.gconv_nlin(ops, emb_in, batch_nb_nodes, adj_mask)
+    nlinear = self.gconv_nlin(ops, emb_in, batch_nb_nodes)
     check_for_nan(nlinear, 'NAN in resgconv : nlinear')
     nlinear = F.relu(nlinear)
 
-    emb_out = torch.cat((linear, nlinear), 2)
+    emb_out = torch.cat((linear, nlinear), -1)
 
     if (emb_out != emb_out).data.sum() > 0:
       print('NAN in first gconv : before return')
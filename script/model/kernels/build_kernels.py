@@ -42,6 +42,21 @@ def _get_kernel_class(kernel_name):
   return kernel, ker_args, ker_kwargs
 
 
+def _get_first_kernel_kwargs(kernel_name):
+  """
+  Arguments of the first layer kernel only, which reads input features.
+  Uses derived features and dataset statistics computed at load time
+  """
+  first_kwargs = {}
+  if not getattr(param.args, 'derived_features', False):
+    return first_kwargs
+  if kernel_name == 'QCDAwareMeanNorm':
+    first_kwargs['norm_pt_column'] = param.args.norm_pt_column
+  elif kernel_name == 'QCDAware':
+    first_kwargs['momenta_stdev'] = param.args.feature_stats['rms'][param.args.pt_column]
+  return first_kwargs
+
+
 def _get_one_kernel(kernel_name):
   ker_options = kernel_name.split('-')
   kernel, ker_args, ker_kwargs  = _get_kernel_class(ker_options[0])
@@ -54,7 +69,7 @@ def _get_one_kernel(kernel_name):
     init_kernel = kernel(
                           *(param.args.first_fm,)+ker_args,
                           spatial_coords=param.args.spatial_coords,
-                          **ker_kwargs
+                          **dict(ker_kwargs, **_get_first_kernel_kwargs(ker_options[0]))
                           )
     kernels[0] = init_kernel
   if 'layerwise' in ker_options:
@@ -6,6 +6,7 @@ from torch.autograd import Variable
 from torch.nn import Parameter
 
 from model.kernels import sparse
+from utils.packed import is_packed
 
 
 def cartesian(tensor):
@@ -63,14 +64,22 @@ class Adj_Kernel(nn.Module):
   def update(self, *args, **kwargs):
     return self.adj_matrix
 
+  def release(self):
+    '''Drops the adjacency saved for later layers, once the batch is done'''
+    self.adj_matrix = None
+
 class DistMult(Adj_Kernel):
   def __init__(self,fmap,*args,sparse=None,**kwargs):
     super(DistMult, self).__init__(*args,sparse,**kwargs)
     self.matrix = nn.Parameter(torch.zeros(fmap,fmap))
 
-  def forward(self,adj_in,emb_in, *args, mask=None, batch_nb_nodes=None, **kwargs):
-    adj = torch.matmul(emb_in, torch.matmul(self.matrix, emb_in.transpose(1,2)))
-    adj = _softmax_with_padding(adj, mask=mask, batch_nb_nodes=batch_nb_nodes)
+  def forward(self,adj_in,emb_in, *args, batch_nb_nodes=None, **kwargs):
+    if is_packed(batch_nb_nodes):
+      graphs = batch_nb_nodes
+      adj = (torch.matmul(emb_in, self.matrix)[graphs.src] * emb_in[graphs.dst]).sum(1)
+    else:
+      adj = torch.matmul(emb_in, torch.matmul(self.matrix, emb_in.transpose(1,2)))
+    adj = _softmax_with_padding(adj, batch_nb_nodes=batch_nb_nodes)
     self._save_adj(adj)
     return adj
 
@@ -81,7 +90,14 @@ class MLPdirected(Adj_Kernel):
       self.layer1 = nn.Linear(2*fmaps, nb_hidden)
       self.layer2 = nn.Linear(nb_hidden,1)
 
-   def forward(self, adj_in, emb_in,*args,mask=None,batch_nb_nodes=None, **kwargs):
+   def forward(self, adj_in, emb_in,*args,batch_nb_nodes=None, **kwargs):
+      if is_packed(batch_nb_nodes):
+        graphs = batch_nb_nodes
+        edges = torch.cat((emb_in[graphs.src], emb_in[graphs.dst]), 1)
+        adj = self.layer2(functional.relu(self.layer1(edges))).view(-1)
+        adj = functional.sigmoid(adj)
+        self.save_adj(adj)
+        return adj
       batch, nb_node, fmap = emb_in.size()
       # Convert out of batches
       emb_cartesian = cartesian(emb_in)
@@ -99,7 +115,11 @@ class Identity(Adj_Kernel):
   def __init__(self, *args, **kwargs):
     super(Identity, self).__init__()
 
-  def forward(self, adj_in, emb_in,*args, **kwargs):
+  def forward(self, adj_in, emb_in,*args, batch_nb_nodes=None, **kwargs):
+    if is_packed(batch_nb_nodes):
+      identity = (batch_nb_nodes.src == batch_nb_nodes.dst).to(emb_in.dtype)
+      self.save_adj(identity)
+      return identity
     batches, nodes, features = emb_in.size()
     ones = torch.ones(nodes)
     if emb_in.is_cuda:
@@ -130,26 +150,46 @@ def _delete_diag(adj):
 
     return adj
 
-def _softmax_with_padding(adj_in, mask=None, batch_nb_nodes=None):
-  exp = adj_in.exp()
-  summed_exp = exp.sum(2)
-  # Remove padded nodes from sum
-  padding_correction = adj_in.size()[1]-batch_nb_nodes
-  padding_correction = padding_correction.unsqueeze(1).expand_as(summed_exp)
-  summed_exp = summed_exp - torch.mul(padding_correction, exp[:,:,-1])
+def _softmax_with_padding(adj_in, batch_nb_nodes=None):
+  if is_packed(batch_nb_nodes):
+    return batch_nb_nodes.softmax_edges(adj_in)
+  # Padded nodes are left out of the sum, and their rows zeroed
+  mask = ts.node_mask(batch_nb_nodes, adj_in.size()[1])
+  exp = adj_in.exp() * mask.unsqueeze(1)
+  summed_exp = exp.sum(2, keepdim=True)
   # Apply softmax
-  adj_in = exp / (summed_exp + 10 **-20).unsqueeze(2).expand_as(exp)
-  adj_in = mask * adj_in
+  adj_in = exp / (summed_exp + 10 **-20)
+  adj_in = adj_in * mask.unsqueeze(2)
   return adj_in
 
-def _softmax_with_padding2(adj_in, mask=None, batch_nb_nodes=None):
+def _softmax_with_padding2(adj_in, batch_nb_nodes=None):
+  if is_packed(batch_nb_nodes):
+    return batch_nb_nodes.softmax_edges(adj_in)
   S = functional.softmax(adj_in)
-  if mask is not None:
-    S = S * mask
+  if batch_nb_nodes is not None:
+    S = ts.mask_adjacency(S, batch_nb_nodes)
   E = S.sum(2,keepdim=True) + 10**-20
   return S / E
 
 
+# Squared distances between detector modules, by device
+_module_sqdist = {}
+
+def set_module_sqdist(table):
+  '''
+  Registers the (nb_modules, nb_modules) numpy array of squared distances
+  between detector modules, indexed by module ID. Kept out of kernels so
+  that it is not pickled with models
+  '''
+  _module_sqdist.clear()
+  _module_sqdist['cpu'] = torch.from_numpy(table)
+
+def _get_module_sqdist(like):
+  if like.is_cuda and 'cuda' not in _module_sqdist:
+    _module_sqdist['cuda'] = _module_sqdist['cpu'].cuda()
+  return _module_sqdist['cuda' if like.is_cuda else 'cpu']
+
+
 class Gaussian(Adj_Kernel):
     """Gaussian kernel"""
     def __init__(self, *args, diag=True, norm=False, periodic=False, spatial_coords=None, **kwargs):
@@ -168,11 +208,36 @@ class Gaussian(Adj_Kernel):
     def _apply_norm(self, adj, batch_nb_nodes):
       return adj
 
-    def forward(self, adj_in, emb, *args, mask=None, batch_nb_nodes=None,**kwargs):
+    def _forward_packed(self, emb, graphs, node_ids=None):
+        # Values of the edges of a packed batch, as computed by `forward`
+        if node_ids is not None and self.spatial_coords is not None:
+          sqdist = _get_module_sqdist(emb)[node_ids[graphs.src], node_ids[graphs.dst]]
+          adj = torch.exp(-(sqdist / len(self.spatial_coords)).div(self.sigma**2))
+        elif self.periodic:
+          adj = gaussian(graphs.edge_sqdist(emb, [1,2], periodic_coord=2), self.sigma)
+        else:
+          coords = self.spatial_coords if self.spatial_coords is not None else list(range(emb.size()[1]))
+          adj = torch.exp(-graphs.edge_sqdist(emb, coords, mean=True).div(self.sigma**2))
+        if not self.diag:
+          adj = adj * (graphs.src != graphs.dst).to(adj.dtype)
+        return adj
+
+    def forward(self, adj_in, emb, *args, batch_nb_nodes=None, node_ids=None, **kwargs):
         """takes the exponential of squared distances"""
+        if is_packed(batch_nb_nodes):
+          adj = self._forward_packed(emb, batch_nb_nodes, node_ids)
+          adj = self._apply_norm(adj, batch_nb_nodes)
+          self.save_adj(adj)
+          return adj
+
         batch,nb_node,fmap = emb.size()
 
-        if self.periodic:
+        if node_ids is not None and self.spatial_coords is not None:
+          # Distances between detector modules are read from the geometry table
+          sqdist = _get_module_sqdist(emb)[node_ids.unsqueeze(2), node_ids.unsqueeze(1)]
+          adj = sqdist / len(self.spatial_coords)
+          adj = torch.exp(-adj.div(self.sigma**2))
+        elif self.periodic:
           adj = gaussian(self.sqdist(emb), self.sigma)
         else:
           if self.spatial_coords is not None:
@@ -191,7 +256,7 @@ class Gaussian(Adj_Kernel):
         if not self.diag:
             adj = _delete_diag(adj)
 
-        adj = self._apply_norm(adj, mask, batch_nb_nodes)
+        adj = self._apply_norm(adj, batch_nb_nodes)
         self.save_adj(adj)
         return adj
 
@@ -199,7 +264,7 @@ class GaussianSoftmax(Gaussian):
   def __init__(self, *args, diag=True, norm=False, periodic=False,spatial_coords=None, **kwargs):
     super(GaussianSoftmax, self).__init__(*args, diag=diag, norm=norm, periodic=periodic,spatial_coords=spatial_coords, **kwargs)
 
-  def _apply_norm(self, adj, mask, batch_nb_nodes):
-    return _softmax_with_padding(adj, mask=mask,batch_nb_nodes=batch_nb_nodes)
+  def _apply_norm(self, adj, batch_nb_nodes):
+    return _softmax_with_padding(adj, batch_nb_nodes=batch_nb_nodes)
 
     
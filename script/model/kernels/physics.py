@@ -7,6 +7,7 @@ from torch.autograd import Variable
 
 from model.kernels.general import Adj_Kernel, _softmax_with_padding, _softmax_with_padding2
 import utils.tensor as ts
+from utils.packed import is_packed
 
 
 """Defines different kernels from the embedding"""
@@ -35,20 +36,21 @@ def _stochastich(adj):
     return adj
 
 
-def _renorm(bmatrix):
+def _renorm(bmatrix, batch_nb_nodes=None):
+    """Centers and scales `bmatrix` by its smallest off-diagonal entry,
+    over the real nodes of each sample if `batch_nb_nodes` is given"""
     nb_node = bmatrix.size()[2]
-    if bmatrix.is_cuda:
-        eye = torch.cuda.FloatTensor(nb_node, nb_node)
-    else:
-        eye = torch.FloatTensor(nb_node, nb_node)
-    eye = Variable(eye)
-    nn.init.eye(eye)
-    eye = eye.unsqueeze(0).expand_as(bmatrix)
-
-    bmat_nodiag = bmatrix + (1000 * bmatrix.data.max() + 1) * eye  # change diag before min
+    eye = torch.eye(nb_node, dtype=bmatrix.dtype, device=bmatrix.device)
+    exclude = eye.unsqueeze(0).expand_as(bmatrix)
+    if batch_nb_nodes is not None:
+        # Padded entries are excluded from the min as the diagonal is
+        mask = ts.node_mask(batch_nb_nodes, nb_node).type_as(bmatrix)
+        exclude = 1 - (1 - exclude) * mask.unsqueeze(2) * mask.unsqueeze(1)
+
+    bmat_nodiag = bmatrix + (1000 * bmatrix.detach().max() + 1) * exclude  # change diag before min
     ts.check_for_nan(bmat_nodiag, 'nan in _renorm : bmat_nodiag')
-    bmat_min, _ = bmat_nodiag.min(1)
-    bmat_min, _ = bmat_min.min(2)
+    bmat_min, _ = bmat_nodiag.min(1, keepdim=True)
+    bmat_min, _ = bmat_min.min(2, keepdim=True)
     ts.check_for_nan(bmat_min, 'nan in _renorm : bmat_min')
     bmat_min_x = bmat_min.expand_as(bmatrix)
     zero_div_protec = ((bmat_min < 1e-6).detach().type_as(bmatrix) * 1e-6).expand_as(bmatrix)
@@ -62,6 +64,12 @@ def _renorm(bmatrix):
 
 
 
+def _hook_check_for_nan(tensor, message, **kwargs):
+    # Tensors computed without autograd, when testing, take no hook
+    if tensor.requires_grad:
+        tensor.register_hook(ts.HookCheckForNan(message, action=print, **kwargs))
+
+
 class FixedGaussian(nn.Module):
     """Gaussian kernel with fixed sigma"""
     def __init__(self, sigma, diag=True, norm=False, periodic=False):
@@ -244,8 +252,8 @@ class FixedQCDAware(Adj_Kernel):
 class QCDAware(Adj_Kernel):
     """kernel based on 'QCD-Aware Recursive Neural Networks for Jet Physics'"""
 
-    def __init__(self, fmaps, alpha, beta, periodic=False):
-        super(QCDAware, self).__init__()
+    def __init__(self, fmaps, alpha, beta, periodic=False, momenta_stdev=None, **kwargs):
+        super(QCDAware, self).__init__(**kwargs)
 
         alpha = Parameter(alpha * (torch.rand(1, 1) * 0.02 + 0.99))
         beta = Parameter(beta * (torch.rand(1, 1, 1) * 0.02 + 0.99))
@@ -255,71 +263,69 @@ class QCDAware(Adj_Kernel):
         self.beta.register_hook(ts.HookCheckForNan('NAN in backward beta',
                                                    action=print, args=self.beta))
 
-        self.init_momenta_stdev = None
-        self.softmax = nn.Softmax()
+        # Dataset-wide momentum scale if known, otherwise estimated on the first batch (0 until then).
+        # A buffer, to follow the model across devices and into checkpoints
+        self.register_buffer('init_momenta_stdev', torch.tensor([float(momenta_stdev or 0.)]))
+        self._stdev_checked = False  # reads the buffer once, not at every batch
         self.sqdist = ts.sqdist_periodic_ if periodic else ts.sqdist_
 
-    def forward(self, emb):
+    def forward(self, adj_in, emb, *args, batch_nb_nodes=None, **kwargs):
+        if is_packed(batch_nb_nodes):
+            raise ValueError('QCDAware kernel does not support --packed_batches')
+
+        nb_batch, nb_node, fmap = emb.size()
         ts.check_for_nan(self.alpha, 'nan in kernel param : alpha', )
         ts.check_for_nan(self.beta, 'nan in kernel param : beta')
 
         sqdist = self.sqdist(emb)
         ts.check_for_inf(sqdist, 'inf in kernel : sqdist')
-        momentum = emb[:, 4, :]
+        momentum = emb[:, :, 4]
 
-        if self.init_momenta_stdev is None:
-            var_m = (momentum ** 2).mean().unsqueeze(1)
-            self.init_momenta_stdev = var_m.sqrt()
+        if not self._stdev_checked:
+            if not self.init_momenta_stdev.item():
+                # Over the real nodes of the batch, padding is zero
+                var_m = (momentum.detach() ** 2).sum() / batch_nb_nodes.sum()
+                self.init_momenta_stdev.copy_(var_m.sqrt().view(1))
+            self._stdev_checked = True
 
-        momentum /= self.init_momenta_stdev.expand_as(momentum)
+        # Out of place, `emb` is read by later layers
+        momentum = momentum / self.init_momenta_stdev
 
         alpha = self.alpha.expand_as(momentum)
         # alpha.register_hook(_hook_reduce_grad(100))
-        pow_momenta = (2 * alpha * momentum.log()).exp()
+        # Need to add small amt to momentum to prevent nan in backward pass
+        pow_momenta = (2 * alpha * (momentum+10**-20).log()).exp()
         ts.check_for_nan(pow_momenta, 'NAN in kernel : pow_momenta')
         min_momenta = ts.sym_min(pow_momenta)
-        min_momenta.register_hook(ts.HookCheckForNan('NAN in backward min_momenta', action=print))
+        _hook_check_for_nan(min_momenta, 'NAN in backward min_momenta')
+        min_momenta = min_momenta.unsqueeze(1).repeat(1, nb_node, 1)
         d_ij_alpha = sqdist * min_momenta
-        d_ij_alpha.register_hook(ts.HookCheckForNan('NAN in backward d_ij_alpha', action=print))
+        _hook_check_for_nan(d_ij_alpha, 'NAN in backward d_ij_alpha')
         ts.check_for_nan(d_ij_alpha, 'nan in kernel : d_ij_alpha')
 
-        d_ij_center = _renorm(d_ij_alpha)
-        d_ij_center.register_hook(ts.HookCheckForNan('NAN in backward d_ij_center', action=print))
+        d_ij_center = _renorm(d_ij_alpha, batch_nb_nodes=batch_nb_nodes)
+        _hook_check_for_nan(d_ij_center, 'NAN in backward d_ij_center')
         ts.check_for_nan(d_ij_center, 'nan in kernel : d_ij_center')
-        beta = (self.beta ** 2).expand_as(d_ij_center)
-        beta.register_hook(ts.HookCheckForNan(
-            'NAN in backward beta**2', action=print, args=('d_ij_center : {}'.format(d_ij_center),)))
-        # beta.register_hook(_hook_reduce_grad(100))
+        beta = self.beta ** 2
+        _hook_check_for_nan(beta, 'NAN in backward beta**2', args=('d_ij_center : {}'.format(d_ij_center),))
         d_ij_norm = - beta * d_ij_center
-        d_ij_norm.register_hook(ts.HookCheckForNan('NAN in backward d_ij_norm', action=print))
+        _hook_check_for_nan(d_ij_norm, 'NAN in backward d_ij_norm')
         ts.check_for_nan(d_ij_norm, 'nan in kernel : d_ij_norm')
-        w_ij = self._softmax(d_ij_norm)
-        # w_ij = d_ij_norm.exp()
+        # Centered distances are large: without the row max, whole rows underflow to 0.
+        # Diagonal and padded entries are pushed down by `_renorm`, and are never the max
+        d_ij_norm = d_ij_norm - d_ij_norm.detach().max(2, keepdim=True)[0]
+        w_ij = _softmax_with_padding(d_ij_norm, batch_nb_nodes=batch_nb_nodes)
 
+        # Save adj matrix for later layers
+        self.save_adj(w_ij)
         return w_ij
 
-    def _softmax(self, dij):
-        batch = dij.size()[0]
-
-        dij = torch.unbind(dij, dim=0)
-        dij = torch.cat(dij, dim=0)
-
-        dij = self.softmax(dij)
-
-        dij = torch.chunk(dij, batch, dim=0)
-        dij = torch.stack(dij, dim=0)
-
-        return dij
-    
-    def update(self, adj_in, *args, **kwargs):
-        return adj_in
-
 
 
 class QCDAwareMeanNorm(Adj_Kernel):
     """kernel based on 'QCD-Aware Recursive Neural Networks for Jet Physics'"""
 
-    def __init__(self, fmaps, alpha, beta, periodic=False,**kwargs):
+    def __init__(self, fmaps, alpha, beta, periodic=False, norm_pt_column=None, **kwargs):
         super(QCDAwareMeanNorm, self).__init__()
 
         alpha = Parameter(alpha * (torch.rand(1, 1) * 0.02 + 0.99))
@@ -330,9 +336,32 @@ class QCDAwareMeanNorm(Adj_Kernel):
         self.beta.register_hook(ts.HookCheckForNan('NAN in backward beta',
                                                    action=print, args=self.beta))
 
+        # Column of pT / mean pT of the event, if precomputed at load time
+        self.norm_pt_column = norm_pt_column
         self.sqdist = ts.sqdist_periodic_ if periodic else ts.sqdist_
 
-    def forward(self, adj_in, emb, *args, batch_nb_nodes=None, mask=None, **kwargs):
+    def _forward_packed(self, emb, graphs):
+        # Edge values of a packed batch, as computed by `forward`
+        periodic_coord = 2 if self.sqdist is ts.sqdist_periodic_ else None
+        sqdist = graphs.edge_sqdist(emb, [1,2], periodic_coord=periodic_coord)
+        if self.norm_pt_column is not None:
+            momentum = emb[:, self.norm_pt_column]
+        else:
+            momentum = emb[:, 4]
+            momentum = momentum / graphs.to_nodes(graphs.mean_nodes(momentum))  # out of place, as in `forward`
+
+        alpha = self.alpha.view(-1)
+        pow_momenta = (2 * alpha * (momentum+10**-20).log()).exp()
+        d_ij_alpha = sqdist * pow_momenta[graphs.dst]
+        d_ij_norm = - self.beta.view(-1) ** 2 * d_ij_alpha
+        return _softmax_with_padding(d_ij_norm, batch_nb_nodes=graphs)
+
+    def forward(self, adj_in, emb, *args, batch_nb_nodes=None, **kwargs):
+        if is_packed(batch_nb_nodes):
+            w_ij = self._forward_packed(emb, batch_nb_nodes)
+            self.save_adj(w_ij)
+            return w_ij
+
         nb_batch, nb_node, fmap = emb.size()
         ts.check_for_nan(self.alpha, 'nan in kernel param : alpha', )
         ts.check_for_nan(self.beta, 'nan in kernel param : beta')
@@ -341,11 +370,14 @@ class QCDAwareMeanNorm(Adj_Kernel):
         '''
         ts.check_for_inf(sqdist, 'inf in kernel : sqdist')
         '''
-        momentum = emb[:, :, 4]
-        mean_momentum = momentum.sum(1,keepdim=True)
-        mean_momentum = torch.div(mean_momentum, batch_nb_nodes.unsqueeze(1))
-        mean_momentum = mean_momentum.repeat(1,nb_node)
-        momentum /= mean_momentum
+        if self.norm_pt_column is not None:
+            momentum = emb[:, :, self.norm_pt_column]
+        else:
+            momentum = emb[:, :, 4]
+            mean_momentum = momentum.sum(1,keepdim=True)
+            mean_momentum = torch.div(mean_momentum, batch_nb_nodes.unsqueeze(1))
+            mean_momentum = mean_momentum.repeat(1,nb_node)
+            momentum = momentum / mean_momentum  # out of place, `emb` is read by later layers
 
         alpha = self.alpha.expand_as(momentum)
         # alpha.register_hook(_hook_reduce_grad(100))
@@ -370,8 +402,8 @@ class QCDAwareMeanNorm(Adj_Kernel):
         d_ij_norm = - beta * d_ij_alpha
         # d_ij_norm.register_hook(ts.HookCheckForNan('NAN in backward d_ij_norm', action=print))
         # ts.check_for_nan(d_ij_norm, 'nan in kernel : d_ij_norm')
-        w_ij = _softmax_with_padding(d_ij_norm, mask=mask, batch_nb_nodes=batch_nb_nodes)
-        # w_ij = _softmax_with_padding2(d_ij_norm, mask=mask, batch_nb_nodes=batch_nb_nodes)
+        w_ij = _softmax_with_padding(d_ij_norm, batch_nb_nodes=batch_nb_nodes)
+        # w_ij = _softmax_with_padding2(d_ij_norm, batch_nb_nodes=batch_nb_nodes)
         # w_ij = d_ij_norm.exp()
 
         # Save adj matrix for later layers
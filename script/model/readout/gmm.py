@@ -4,7 +4,7 @@ from torch.autograd import Variable
 from torch.nn import Parameter
 import numpy as np
 
-from utils.tensor import spatialnorm
+from utils.tensor import spatialnorm, sum_with_padding
 
 class GMM(nn.Module):
   def __init__(self, fmap, nb_gauss=8):
@@ -22,19 +22,13 @@ class GMM(nn.Module):
     self.fc = nn.Linear(nb_gauss, 1)
     self.act = nn.Sigmoid()
 
-  def forward(self, emb_in, adj_mask=None, batch_nb_nodes=None):
-    batch, nb_node, fmap = emb_in.size()
-    # Resize parameters
-    mu = self.mu.unsqueeze(0).unsqueeze(1).repeat(batch, nb_node, 1,1)
-    sigma = self.sigma.unsqueeze(0).unsqueeze(1).repeat(batch,nb_node,1,1)
-    # Apply gaussian kernel
-    sqdiff = (emb_in.unsqueeze(2) - mu)**2
-    sum_feat = (sqdiff * sigma).sum(3)
+  def forward(self, emb_in, batch_nb_nodes=None):
+    # Apply gaussian kernel, parameters broadcast over nodes
+    sqdiff = (emb_in.unsqueeze(-2) - self.mu)**2
+    sum_feat = (sqdiff * self.sigma).sum(-1)
     exp = torch.exp(sum_feat * -0.5)
-    # Mask batches
-    masked = exp * adj_mask[:,0].unsqueeze(2)
-    # Sum over all nodes in batch
-    gaussians = masked.sum(1)
+    # Sum over all nodes of each sample, without padding
+    gaussians = sum_with_padding(exp, batch_nb_nodes)
     # Apply transformation and sigmoid
     out = self.act(self.fc(gaussians))
     return out.squeeze(1)
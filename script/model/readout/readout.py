@@ -4,7 +4,7 @@ import torch.nn as nn
 from torch.nn.functional import sigmoid
 
 import loading.model.model_parameters as param
-from utils.tensor import mean_with_padding, mask_embedding
+from utils.tensor import mean_with_padding, mask_embedding, sum_with_padding
 from model.readout.gmm import GMM
 
 def get_readout():
@@ -39,12 +39,12 @@ class Readout(nn.Module):
     self.norm = nn.InstanceNorm1d(1)
     self.fcl = nn.Linear(fmaps,1)
 
-  def _pooling(self, emb_in, adj_mask, *args, **kwargs):
+  def _pooling(self, emb_in, batch_nb_nodes, *args, **kwargs):
     logging.error("Readout must be implemented with child class")
     raise
 
-  def forward(self, emb_in, adj_mask, *args, **kwargs):
-    emb = self._pooling(emb_in, adj_mask)
+  def forward(self, emb_in, batch_nb_nodes, *args, **kwargs):
+    emb = self._pooling(emb_in, batch_nb_nodes)
     emb = self.norm(emb.unsqueeze(1)).squeeze(1)
     emb = self.fcl(emb).squeeze(1)
     return sigmoid(emb)
@@ -53,28 +53,28 @@ class Mean(Readout):
   def __init__(self,fmaps):
     super(Mean, self).__init__(fmaps)
 
-  def forward(self, emb_in, adj_mask, batch_nb_nodes, *args, **kwargs):
-    emb = mean_with_padding(emb_in, batch_nb_nodes, adj_mask)
+  def forward(self, emb_in, batch_nb_nodes, *args, **kwargs):
+    emb = mean_with_padding(emb_in, batch_nb_nodes)
     emb = self.norm(emb.unsqueeze(1)).squeeze(1)
     emb = self.fcl(emb).squeeze(1)
     return sigmoid(emb)
 
-  def _pooling(self, emb_in, adj_mask):
+  def _pooling(self, emb_in, batch_nb_nodes):
     pass
 
 class Sum(Readout):
   def __init__(self,fmaps):
     super(Sum, self).__init__(fmaps)
 
-  def _pooling(self, emb_in, adj_mask):
-    return mask_embedding(emb_in, adj_mask).sum(1)
+  def _pooling(self, emb_in, batch_nb_nodes):
+    return sum_with_padding(emb_in, batch_nb_nodes)
 
 class Max(Readout):
   def __init__(self,fmaps):
     super(Sum, self).__init__(fmaps)
 
-  def _pooling(self, emb_in, adj_mask):
-    return mask_embedding(emb_in, adj_mask).max(0)
+  def _pooling(self, emb_in, batch_nb_nodes):
+    return mask_embedding(emb_in, batch_nb_nodes).max(0)
 
 
 class FCL(nn.Module):
@@ -95,9 +95,9 @@ class DTNN(nn.Module):
     self.dtnn = FCL(fmaps)
     self.readout = None
 
-  def forward(self, emb_in, adj_mask, batch_nb_nodes, *args, **kwargs):
+  def forward(self, emb_in, batch_nb_nodes, *args, **kwargs):
     emb = self.dtnn(emb_in)
-    return self.readout(emb, adj_mask, batch_nb_nodes)
+    return self.readout(emb, batch_nb_nodes)
 
 class DTNN_Sum(DTNN):
   def __init__(self, fmaps):
@@ -9,130 +9,331 @@ from torch.autograd import Variable
 
 import loading.model.model_parameters as param
 import data_ops.batching as batching
+import data_ops.curriculum as curriculum
+from data_ops.prefetch import Prefetcher
+from data_ops.batch_store import BatchStore, log_store
+from loading.data.stream import StreamDataset
 from graphics.plot_graph import construct_plot
 
 
-def train_net(net, X, y, w, criterion, optimizer):
-    """Trains net for one epoch using criterion loss and optimizer"""
+def _iter_batches(X, y, w, batch_idx):
+    # Event and batch stores gather a whole batch from an index array
+    gather = hasattr(X, 'node_rows') or isinstance(X, BatchStore)
+    y, w = np.asarray(y), np.asarray(w)
+    for idx in batch_idx:
+        idx = np.asarray(idx)
+        batch_X = X[idx] if gather else [X[s] for s in idx]
+        yield batch_X, y[idx], w[idx]
 
-    logging.warning('training on {} events'.format(len(y)))
+
+def get_batch_store(X, name):
+    """Pads samples of `X` once, in memory or memory-mapped in --batch_store_dir.
+    The store is indexed as `X`, and used in its place by every epoch
+    """
+
+    t0 = time.time()
+    store = BatchStore(X, directory=param.args.batch_store_dir)
+    log_store(store, name)
+    logging.info('  built in {:.1f}s'.format(time.time() - t0))
+    return store
+
+
+def _take(X, idx):
+    if isinstance(X, BatchStore):
+        return X.take(idx)
+    # Event stores gather from an index array
+    if hasattr(X, 'node_rows'):
+        return X[idx]
+    return [X[i] for i in idx]
+
+
+def get_train_subset(X, y, w, nb):
+    """Random subset of `nb` training samples, in dataset order, on which
+    train metrics are computed. Samples of event stores are in store order,
+    where a head slice would hold whole input files, often of one class.
+    Streamed datasets draw random chunks (see `StreamDataset`)
+    """
+
+    if isinstance(X, StreamDataset):
+        return X[:nb], None, None
+    idx = np.sort(np.random.permutation(len(X))[:nb])
+    return _take(X, idx), np.asarray(y)[idx], np.asarray(w)[idx]
+
+
+def get_sampling_table(w):
+    """Alias table drawing training samples in proportion to their weight"""
+
+    w = np.asarray(w, dtype=np.float64)
+    table = batching.alias_table(w)
+    logging.info('Sampling events by weight: effective sample size {:.0f} of {} events'.format(
+                                                  batching.effective_sample_size(w), len(w)))
+    return table, w.mean()
+
+
+def get_sample_sizes(X):
+    """Number of nodes of each sample. For streamed datasets, stored sizes
+    bounded by --max_nodes, ignoring the --min_pt cut
+    """
+
+    if isinstance(X, StreamDataset):
+        sizes = X.stored_nb_nodes()
+        if param.args.max_nodes > 0:
+            sizes = np.minimum(sizes, param.args.max_nodes)
+        return sizes
+    return batching.get_sample_sizes(X)
+
+
+def log_curriculum(X, node_cap):
+    kept, saved = curriculum.compute_saved(get_sample_sizes(X), node_cap)
+    logging.info('  curriculum node cap {}: training on {:.1f}% of events, {:.1f}% of O(N^2) compute saved'.format(
+                                                  node_cap, 100 * kept, 100 * saved))
+
+
+def log_padding(X, batch_idx):
+    sample_sizes = batching.get_sample_sizes(X)
+    random_idx = batching.get_batches(len(X), param.args.nb_batch, X, shuffle_batch=True)
+    logging.info('  padding efficiency {:.1f}% (random batches: {:.1f}%)'.format(
+                  100 * batching.padding_efficiency(batch_idx, sample_sizes, param.args.nb_extra_nodes),
+                  100 * batching.padding_efficiency(random_idx, sample_sizes, param.args.nb_extra_nodes)))
+
+
+def get_batches(X, y, w, shuffle_batch=False, sort_batch=False, sampling=None, node_cap=None,
+                batch_size=None, node_budget=None):
+    """Yields batches (batch_X, batch_y, batch_w) of samples.
+    Streamed datasets are read in order from disk, and cannot be sorted.
+    With --shuffle_block, samples are shuffled by blocks to keep reads local.
+    With `sampling` from `get_sampling_table`, samples are drawn in proportion
+    to their weight, and all weighted by the mean weight, which keeps the loss
+    an unbiased estimate of the weighted loss.
+    With `node_cap`, samples with more nodes are left out.
+    With --bucketed_training, shuffled unsorted batches group samples of similar size.
+    With --node_budget, the padded work of batches is capped instead of their size.
+    `batch_size` and `node_budget` default to --nb_batch and --node_budget
+    """
+
+    batch_size = batch_size or param.args.nb_batch
+    if node_budget is None:
+        node_budget = param.args.node_budget
+    budget = dict(node_budget=node_budget, cost=param.args.budget_cost)
+    if isinstance(X, StreamDataset):
+        return X.batches(batch_size, shuffle_batch, node_cap, **budget)
+    subset = None
+    if node_cap is not None:
+        subset = curriculum.capped_subset(batching.get_sample_sizes(X), node_cap)
+    if sampling is not None:
+        table, mean_w = sampling
+        batch_idx = batching.get_sampled_batches(len(X),
+                                                 batch_size,
+                                                 X,
+                                                 table,
+                                                 sort_batch,
+                                                 subset=subset,
+                                                 nb_buckets=param.args.bucketed_training,
+                                                 **budget
+                                                 )
+        if param.args.bucketed_training > 0 and not sort_batch:
+            log_padding(X, batch_idx)
+        return _iter_batches(X, y, np.full(len(X), mean_w), batch_idx)
+    batch_idx = batching.get_batches(len(X),
+                                     batch_size,
+                                     X,
+                                     shuffle_batch,
+                                     sort_batch,
+                                     block_size=param.args.shuffle_block,
+                                     window=param.args.shuffle_buffer,
+                                     subset=subset,
+                                     nb_buckets=param.args.bucketed_training,
+                                     **budget
+                                     )
+    if param.args.bucketed_training > 0 and shuffle_batch and not sort_batch:
+        log_padding(X, batch_idx)
+    return _iter_batches(X, y, w, batch_idx)
+
+
+def make_batch(batch):
+    """Pads samples of a batch and puts them into Variables.
+    Tensors share memory with the collated arrays, without copy
+    """
+
+    batch_X, batch_y, batch_w = batch
+    batch_X, batch_nb_nodes, batch_y, batch_w = batching.collate(
+                                          batch_X,
+                                          batch_y,
+                                          batch_w,
+                                          param.args.nb_extra_nodes,
+                                          packed=param.args.packed_batches
+                                          )
+
+    ground_truth = Variable(torch.from_numpy(batch_y))
+    jet = Variable(torch.from_numpy(batch_X))
+    weight = Variable(torch.from_numpy(batch_w))
+    batch_nb_nodes = Variable(torch.from_numpy(batch_nb_nodes.astype(np.float32)))
+    return jet, batch_nb_nodes, ground_truth, weight
+
+
+def batch_loss(criterion, out, ground_truth, weight):
+    """Returns the mean loss of a batch, and the loss to minimize.
+    With --node_budget, batch sizes vary: the loss to minimize is summed over
+    samples and divided by --nb_batch, so that every sample weighs the same
+    """
+
+    loss = criterion(out, ground_truth, weight)
+    if param.args.node_budget > 0:
+        return loss, loss * (len(ground_truth) / float(param.args.nb_batch))
+    return loss, loss
+
+
+def get_prefetcher(batches):
+    return Prefetcher(
+                      batches,
+                      make_batch,
+                      depth=param.args.prefetch,
+                      nb_workers=param.args.prefetch_workers
+                      )
+
+
+def log_wait_time(prefetcher, t0):
+    epoch_time = time.time() - t0
+    logging.info('  waited {:.1f}s for data ({:.1f}% of {:.1f}s)'.format(
+                                              prefetcher.wait_time,
+                                              100 * prefetcher.wait_time / (epoch_time + 10**-20),
+                                              epoch_time
+                                              ))
+
+
+def train_net(net, X, y, w, criterion, optimizer, sampling=None, node_cap=None, roccurve=None):
+    """Trains net for one epoch using criterion loss and optimizer.
+    Only samples with at most `node_cap` nodes are used if given.
+    Predictions made while training are added to `roccurve` if given
+    """
+
+    logging.warning('training on {} events'.format(len(X)))
+    if node_cap is not None:
+        log_curriculum(X, node_cap)
     epoch_loss = 0
     step_loss = 0
     net.train()
+    if roccurve is not None:
+        roccurve.reset()
 
     plots = construct_plot()
 
-    batch_idx = batching.get_batches(len(y), 
-                                     param.args.nb_batch, 
-                                     X,
-                                     param.args.shuffle_while_training,
-                                     param.args.sorted_training
-                                     )
+    batches = get_batches(X, y, w,
+                          param.args.shuffle_while_training,
+                          param.args.sorted_training,
+                          sampling,
+                          node_cap
+                          )
 
-    for i, idx in enumerate(batch_idx):
-        optimizer.zero_grad()
+    # Batches are padded and put into variables ahead of time
+    prefetcher = get_prefetcher(batches)
 
-        # X = [np.random.randint(0, 10, size=(6,3))]
-        # X = [np.random.randint(0,3,size=(6,2)), np.random.randint(0, 10, size=(6,3))]
-        # Put samples into batches
-        batch_X, adj_mask, batch_nb_nodes = batching.pad_batch(
-                                              [X[s] for s in idx],
-                                              param.args.nb_extra_nodes
-                                              )
-        batch_y = [int(y[s]) for s in idx]
-        batch_w = [w[s] for s in idx]
-
-        # Put into variables
-        ground_truth = Variable(torch.Tensor(batch_y))
-        jet = Variable(torch.Tensor(batch_X).transpose(1,2))
-        weight = Variable(torch.Tensor(batch_w))
-        adj_mask = Variable(torch.Tensor(adj_mask))
-        batch_nb_nodes = Variable(torch.Tensor(batch_nb_nodes.tolist()))
+    t0 = time.time()
+    nb_samples = 0
+    for i, (jet, batch_nb_nodes, ground_truth, weight) in enumerate(prefetcher):
+        optimizer.zero_grad()
+        nb_samples += len(ground_truth)
 
         # Put on cuda if necessary
         if param.args.cuda:
             ground_truth = ground_truth.cuda()
             jet = jet.cuda()
             weight = weight.cuda()
-            adj_mask = adj_mask.cuda()
             batch_nb_nodes = batch_nb_nodes.cuda()
 
         # t0 = time.time()
         if i == 2:
-          out = net(jet, adj_mask, batch_nb_nodes, plotting=plots)
+          out = net(jet, batch_nb_nodes, plotting=plots)
         else:
-          out = net(jet, adj_mask, batch_nb_nodes)
+          out = net(jet, batch_nb_nodes)
         # print("sample took {:.3e} s".format(time.time()-t0))
 
-        loss = criterion(out, ground_truth, weight)
+        mean_loss, loss = batch_loss(criterion, out, ground_truth, weight)
         loss.backward()
         optimizer.step()
 
-        epoch_loss += loss.data[0]
-        step_loss += loss.data[0]
+        # Losses are averaged over samples, whatever the batch sizes
+        epoch_loss += mean_loss.item() * len(ground_truth)
+        step_loss += mean_loss.item()
+        if roccurve is not None:
+            roccurve.update(out.data, ground_truth.data, weight.data)
 
         # Print info
         if (i + 1) % param.args.nbprint == 0:
           logging.info('  {} : {}'.format(
-                                            (i+1)*param.args.nb_batch, 
+                                            nb_samples, 
                                             step_loss / param.args.nbprint)
                                             )
           step_loss = 0
-    epoch_loss_avg = epoch_loss / len(batch_idx)
+    log_wait_time(prefetcher, t0)
+    epoch_loss_avg = epoch_loss / max(nb_samples, 1)
 
     return epoch_loss_avg
 
 
+def get_eval_batches(X, y, w):
+    """Batches of --eval_batch samples, or within --eval_node_budget,
+    sorted by size which greatly reduces padded zeros
+    """
+
+    node_budget = param.args.eval_node_budget or param.args.node_budget
+    return get_batches(X, y, w,
+                       sort_batch=True,
+                       batch_size=param.args.eval_batch,
+                       node_budget=node_budget
+                       )
+
+
+def online_metrics(roccurve, epoch_loss_avg):
+    """Train ROC AUC, loss and FPR from predictions made while training,
+    as returned by `test_net`
+    """
+
+    return roccurve.score_auc(), epoch_loss_avg, roccurve.score_fpr(), roccurve
+
+
 def test_net(net, X, y, w, criterion, roccurve):
-    """Tests the network, returns the ROC AUC and epoch loss"""
+    """Tests the network, returns the ROC AUC and epoch loss.
+    Runs without autograd, so that no intermediate tensor is kept
+    """
 
-    logging.warning('Testing on {} events'.format(len(y)))
+    logging.warning('Testing on {} events'.format(len(X)))
+    net.eval()
+    with torch.inference_mode():
+        return _test_net(net, X, y, w, criterion, roccurve)
+
+
+def _test_net(net, X, y, w, criterion, roccurve):
     epoch_loss = 0
     roccurve.reset()
-    net.eval()
 
-    # Sort test batches by size which greatly reduces padded zeros
-    batch_idx = batching.get_batches(
-                                      len(y), 
-                                      param.args.nb_batch, 
-                                      X,
-                                      sort_batch=True
-                                      )
-    
-    for i, idx in enumerate(batch_idx):
-        # Create batches
-        batch_X, adj_mask, batch_nb_nodes = batching.pad_batch(
-                                                [X[s] for s in idx],
-                                                param.args.nb_extra_nodes
-                                                )
-        batch_y = [int(y[s]) for s in idx]
-        batch_w = [w[s] for s in idx]
-
-        # Put Variables in batches
-        ground_truth = Variable(torch.Tensor(batch_y))
-        jet = Variable(torch.Tensor(batch_X).transpose(1,2))
-        weight = Variable(torch.Tensor(batch_w))
-        adj_mask = Variable(torch.Tensor(adj_mask))
-        batch_nb_nodes = Variable(torch.Tensor(batch_nb_nodes.tolist()))
+    batches = get_eval_batches(X, y, w)
+
+    prefetcher = get_prefetcher(batches)
+
+    t0 = time.time()
+    nb_samples = 0
+    for i, (jet, batch_nb_nodes, ground_truth, weight) in enumerate(prefetcher):
+        nb_samples += len(ground_truth)
 
         # Put on cuda if necessary
         if param.args.cuda:
             ground_truth = ground_truth.cuda()
             jet = jet.cuda()
             weight = weight.cuda()
-            adj_mask = adj_mask.cuda()
             batch_nb_nodes = batch_nb_nodes.cuda()
 
-        out = net(jet, adj_mask, batch_nb_nodes)
+        out = net(jet, batch_nb_nodes)
         loss = criterion(out, ground_truth, weight)
-        epoch_loss += loss.data[0]
+        epoch_loss += loss.item() * len(ground_truth)
         roccurve.update(out.data, ground_truth.data, weight.data)
 
         if (i + 1) % (5*param.args.nbprint) == 0:
-            logging.info('  tested on {}'.format((i+1)*param.args.nb_batch))
+            logging.info('  tested on {}'.format(nb_samples))
 
+    log_wait_time(prefetcher, t0)
     score = roccurve.score_auc()
     fpr50 = roccurve.score_fpr()
-    epoch_loss /= len(batch_idx)
+    epoch_loss /= max(nb_samples, 1)
     return score, epoch_loss, fpr50, roccurve
 
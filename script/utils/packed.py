@@ -0,0 +1,93 @@
+import torch
+
+"""Packed batches, an alternative to zero-padded (batch, n, fmap) batches.
+
+Nodes of all graphs of a batch are concatenated in a (nb_nodes_total, fmap)
+tensor. Adjacencies are block diagonal, stored as one value per edge (i, j)
+of each graph, graph by graph and row by row: the first n_0^2 values are the
+adjacency of graph 0. Per-graph operations are segment sums over node or
+edge indices, and spreading along edges is a sparse block-diagonal product.
+"""
+
+
+class PackedGraphs():
+    """Structure of a packed batch, built from the number of nodes of its graphs.
+
+    - nb_nodes : (batch,) number of nodes of each graph, as `batch_nb_nodes`
+    - node_graph : (nb_nodes_total,) graph ID of each node
+    - offsets : (batch,) index of the first node of each graph
+    - src, dst : (nb_edges,) nodes i, j of each edge (i, j)
+    """
+
+    def __init__(self, nb_nodes):
+        self.nb_nodes = nb_nodes
+        sizes = nb_nodes.long()
+        device = sizes.device
+        self.batch_size = len(sizes)
+        self.nb_nodes_total = int(sizes.sum())
+        graphs = torch.arange(self.batch_size, device=device)
+        self.node_graph = torch.repeat_interleave(graphs, sizes)
+        self.offsets = torch.cumsum(sizes, 0) - sizes
+
+        nb_edges = sizes ** 2
+        edge_graph = torch.repeat_interleave(graphs, nb_edges)
+        edge_offsets = torch.cumsum(nb_edges, 0) - nb_edges
+        local = torch.arange(int(nb_edges.sum()), device=device) - edge_offsets[edge_graph]
+        n = sizes[edge_graph]
+        self.src = self.offsets[edge_graph] + local // n
+        self.dst = self.offsets[edge_graph] + local % n
+        self.nb_edges = len(self.src)
+
+    def ones(self, like):
+        """Adjacency with all edges of value 1"""
+        return like.new_ones(self.nb_edges)
+
+    def sum_nodes(self, emb):
+        """(batch, ...) sum of `emb` over the nodes of each graph"""
+        out = emb.new_zeros((self.batch_size,) + emb.size()[1:])
+        return out.index_add(0, self.node_graph, emb)
+
+    def mean_nodes(self, emb):
+        nb_nodes = self.nb_nodes.view((-1,) + (1,) * (emb.dim() - 1))
+        return self.sum_nodes(emb) / (nb_nodes + 10**-20)
+
+    def to_nodes(self, values):
+        """Broadcasts per-graph `values` to the nodes of each graph"""
+        return values[self.node_graph]
+
+    def sum_edges(self, adj):
+        """(nb_nodes_total,) sum of edge values over each row i"""
+        return adj.new_zeros(self.nb_nodes_total).index_add(0, self.src, adj)
+
+    def softmax_edges(self, adj):
+        """Softmax of edge values over each row i, as `_softmax_with_padding`"""
+        exp = adj.exp()
+        return exp / (self.sum_edges(exp)[self.src] + 10**-20)
+
+    def spread(self, adj, emb):
+        """Sum over j of adj_ij * emb_j, for the block-diagonal adjacency `adj`"""
+        indices = torch.stack((self.src, self.dst))
+        block_diag = torch.sparse_coo_tensor(indices, adj, (self.nb_nodes_total, self.nb_nodes_total))
+        return torch.sparse.mm(block_diag, emb)
+
+    def edge_sqdist(self, emb, coords, periodic_coord=None, mean=False):
+        """Squared distances over features `coords` along each edge.
+        Differences of `periodic_coord` are wrapped in [-pi, pi]
+        """
+        diff = emb[self.src][:, coords] - emb[self.dst][:, coords]
+        if periodic_coord is not None:
+            k = coords.index(periodic_coord)
+            wrapped = torch.remainder(diff[:, k] + torch.pi, 2 * torch.pi) - torch.pi
+            diff = torch.cat((diff[:, :k], wrapped.unsqueeze(1), diff[:, k+1:]), 1)
+        if mean:
+            return (diff ** 2).mean(1)
+        return (diff ** 2).sum(1)
+
+    def first_graph(self, emb, adj):
+        """Embedding and dense adjacency of graph 0, for plotting"""
+        n = int(self.nb_nodes[0])
+        return emb[:n], adj[:n * n].view(n, n)
+
+
+def is_packed(batch_nb_nodes):
+    return isinstance(batch_nb_nodes, PackedGraphs)
@@ -2,16 +2,47 @@ import torch
 from torch.autograd import Variable
 from math import pi
 
-def mask_embedding(tensor, mask):
-  nb_feat = tensor.size()[2]
-  return torch.mul(tensor,mask[:,:,0:1].repeat(1,1,nb_feat))
-
-def mean_with_padding(tensor, batch_nb_nodes, mask):
+from utils.packed import is_packed
+
+def node_mask(batch_nb_nodes, nb_node):
+  """(batch, nb_node) mask of real nodes, from the number of nodes of each sample"""
+  nodes = torch.arange(nb_node, dtype=batch_nb_nodes.dtype, device=batch_nb_nodes.device)
+  return (nodes.unsqueeze(0) < batch_nb_nodes.unsqueeze(1)).to(batch_nb_nodes.dtype)
+
+# Packed batches (`utils.packed`) have no padding to mask,
+# `batch_nb_nodes` is then a PackedGraphs
+
+def mask_adjacency(adj, batch_nb_nodes):
+  """Zeroes rows and columns of padded nodes in a (batch, n, n) adjacency"""
+  if is_packed(batch_nb_nodes):
+    return adj
+  mask = node_mask(batch_nb_nodes, adj.size()[1])
+  return adj * mask.unsqueeze(2) * mask.unsqueeze(1)
+
+def mask_embedding(tensor, batch_nb_nodes):
+  if is_packed(batch_nb_nodes):
+    return tensor
+  return tensor * node_mask(batch_nb_nodes, tensor.size()[1]).unsqueeze(2)
+
+def sum_with_padding(tensor, batch_nb_nodes):
+  # Sum of tensor over the nodes of each sample
+  if is_packed(batch_nb_nodes):
+    return batch_nb_nodes.sum_nodes(tensor)
+  return mask_embedding(tensor, batch_nb_nodes).sum(1)
+
+def mean_with_padding(tensor, batch_nb_nodes):
   # check_for_inf(tensor, "inf in tensor")
   # Get mean of tensor, accounting for zero padding of batches
-  summed = mask_embedding(tensor, mask).sum(1)
-  batch_div_by = batch_nb_nodes.unsqueeze(1).repeat(1,tensor.size()[2])
-  return summed / (batch_div_by+10**-20)
+  if is_packed(batch_nb_nodes):
+    return batch_nb_nodes.mean_nodes(tensor)
+  summed = sum_with_padding(tensor, batch_nb_nodes)
+  return summed / (batch_nb_nodes.unsqueeze(1)+10**-20)
+
+def _expand_as_nodes(values, batch_nb_nodes, emb):
+  # Broadcasts per-sample values to all nodes of `emb`
+  if is_packed(batch_nb_nodes):
+    return batch_nb_nodes.to_nodes(values)
+  return values.unsqueeze(1).expand_as(emb)
 
 def variable_as(tensor1, tensor2):
     """Makes tensor1 a Variable depending on tensor2"""
@@ -89,23 +120,24 @@ def sqdist_(emb):
 
 def sqdist_periodic_(emb):
     """Squarred euclidean distance over embedding (phi, eta) with
-    2pi-periodicity over phi
+    2pi-periodicity over phi: differences of phi are wrapped in [-pi, pi],
+    as `PackedGraphs.edge_sqdist` does for packed batches
     """
 
-    sqdist1 = sqdist_(emb)
-    emb_pi = torch.cat((emb[:, 0:1, :], (emb[:, 2, :].unsqueeze(1) + pi) % (2 * pi)), 1)
-    sqdist2 = sqdist_(emb_pi)
-    sqdist = torch.min(sqdist1, sqdist2)
+    coord = emb[:, :, 1:3]
+    diff = coord.unsqueeze(2) - coord.unsqueeze(1)
+    dphi = torch.remainder(diff[:, :, :, 1] + pi, 2 * pi) - pi
+    sqdist = diff[:, :, :, 0] ** 2 + dphi ** 2
 
     return sqdist
 
 
 
-def spatialnorm(emb, batch_nb_nodes, adj_mask):
+def spatialnorm(emb, batch_nb_nodes):
     """Normalisation layer : each feature map is modified to have
     mean 0 and variance 1.
 
-    input : - emb : Tensor of size (batch, fm, n)
+    input : - emb : Tensor of size (batch, fm, n), or (nb_nodes_total, fm) when packed
     output : - emb_norm : same as emb, such that each emb[batch, fm, :] has
                 mean 0 and variance 1. size (batch, fm, n)
              - avg : Tensor containing the mean of each feature maps from emb.abs
@@ -114,11 +146,11 @@ def spatialnorm(emb, batch_nb_nodes, adj_mask):
                 size (batch, fm, 1)
     """
 
-    avg = mean_with_padding(emb, batch_nb_nodes, adj_mask)
-    emb_centered = emb - avg.unsqueeze(1).expand_as(emb)
+    avg = mean_with_padding(emb, batch_nb_nodes)
+    emb_centered = emb - _expand_as_nodes(avg, batch_nb_nodes, emb)
 
-    var = 10**-20+mean_with_padding(emb_centered ** 2, batch_nb_nodes, adj_mask)
-    emb_norm = emb_centered / var.sqrt().unsqueeze(1).expand_as(emb_centered)
+    var = 10**-20+mean_with_padding(emb_centered ** 2, batch_nb_nodes)
+    emb_norm = emb_centered / _expand_as_nodes(var.sqrt(), batch_nb_nodes, emb_centered)
 
     return emb_norm, avg, var
 
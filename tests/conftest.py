@@ -0,0 +1,35 @@
+import sys
+from os.path import abspath, dirname, join
+
+import numpy as np
+import pytest
+
+# Modules are imported from `script/`, as when running `script/main.py`
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'script'))
+
+import loading.model.model_parameters as param
+from loading.model.read_args import read_args
+
+
+@pytest.fixture
+def model_args(tmp_path):
+    """Sets global model arguments from command line arguments,
+    with the features of NYU events"""
+
+    def make(*argv):
+        args = read_args(['--name', 'test', '--lr', '0.005', '--lrdecay', '0.9'] + list(argv))
+        args.first_fm = 6
+        args.spatial_coords = [1, 2]
+        args.pt_column = 4
+        args.savedir = str(tmp_path / 'model')
+        param.init(args)
+        return param.args
+    return make
+
+
+def random_events(nb_events, nb_features=6, max_nodes=12, seed=0):
+    """(nb_features, nb_nodes) events of positive features, with labels and weights"""
+
+    rng = np.random.RandomState(seed)
+    X = [(rng.rand(nb_features, n) + .1).astype(np.float32) for n in rng.randint(1, max_nodes, nb_events)]
+    return X, rng.randint(0, 2, nb_events), rng.exponential(1., nb_events)
@@ -0,0 +1,173 @@
+import numpy as np
+import pytest
+
+from conftest import random_events
+from data_ops.batching import (collate, divide_budget, batch_cost, bucket_batches, get_batches,
+                               alias_table, sample_alias, get_sampled_batches, block_shuffle)
+from data_ops.batch_store import BatchStore
+from data_ops.prefetch import Prefetcher
+from loading.data.event_store import write_event_store, load_event_store
+
+
+def _sizes(X):
+    return np.array([x.shape[1] for x in X])
+
+
+@pytest.fixture
+def stored_events(tmp_path):
+    X, y, w = random_events(40)
+    write_event_store(str(tmp_path / 'store'), X, y, w)
+    return X, load_event_store(str(tmp_path / 'store'), 40)[0]
+
+
+def test_collate_padded():
+    X, y, w = random_events(10)
+    batch, sizes, y_, w_ = collate(X, y, w)
+
+    assert batch.shape == (10, _sizes(X).max(), 6)
+    assert batch.dtype == np.float32
+    assert (sizes == _sizes(X)).all()
+    for x, sample, n in zip(X, batch, sizes):
+        assert (sample[:n] == x.transpose()).all()
+        assert (sample[n:] == 0).all()
+    assert (y_ == y).all() and np.allclose(w_, w)
+
+
+def test_collate_extra_nodes():
+    X, y, w = random_events(10)
+    batch, sizes, _, _ = collate(X, y, w, nb_extra_nodes=2)
+
+    assert batch.shape == (10, _sizes(X).max() + 2, 6)
+    assert (sizes == _sizes(X) + 2).all()
+
+
+@pytest.mark.parametrize('nb_extra_nodes', [0, 2])
+def test_collate_packed(nb_extra_nodes):
+    X, y, w = random_events(10)
+    padded, sizes, _, _ = collate(X, y, w, nb_extra_nodes)
+    packed, packed_sizes, _, _ = collate(X, y, w, nb_extra_nodes, packed=True)
+
+    assert (packed_sizes == sizes).all()
+    assert packed.shape == (sizes.sum(), 6)
+    real = np.arange(padded.shape[1]) < sizes[:, None]
+    assert (packed == padded[real]).all()
+
+
+def test_collate_event_list(stored_events):
+    X, stored = stored_events
+    idx = np.array([5, 1, 30])
+    for packed in [False, True]:
+        from_list = collate([X[i] for i in idx], [0] * 3, [1] * 3, packed=packed)[0]
+        from_store = collate(stored[idx], [0] * 3, [1] * 3, packed=packed)[0]
+        assert (from_store == from_list).all()
+
+
+def test_batch_store(stored_events):
+    X, stored = stored_events
+    store = BatchStore(stored, nb_buckets=4)
+    idx = np.array([7, 2, 33, 19])
+
+    assert len(store) == len(X)
+    for packed in [False, True]:
+        expected = collate([X[i] for i in idx], [0] * 4, [1] * 4, packed=packed)[0]
+        assert (collate(store[idx], [0] * 4, [1] * 4, packed=packed)[0] == expected).all()
+    subset = store.take(idx)
+    assert (collate(subset[np.arange(4)], [0] * 4, [1] * 4)[0]
+            == collate([X[i] for i in idx], [0] * 4, [1] * 4)[0]).all()
+    assert len(store[:10]) == 10
+
+
+@pytest.mark.parametrize('cost', ['edges', 'nodes'])
+def test_divide_budget(cost):
+    sizes = np.random.RandomState(0).randint(1, 30, 200)
+    sizes[17] = 100  # over budget alone
+    idx = np.random.RandomState(1).permutation(200)
+    budget = 2000 if cost == 'edges' else 100
+    batches = divide_budget(idx, sizes, budget, cost)
+
+    # Every sample once, in order
+    assert (np.concatenate(batches) == idx).all()
+    for batch in batches:
+        if len(batch) > 1:
+            assert batch_cost(len(batch), sizes[batch].max(), cost) <= budget
+    assert [17] in [list(batch) for batch in batches]
+
+
+def test_bucket_batches():
+    sizes = np.random.RandomState(0).randint(1, 50, 203)
+    batches = bucket_batches(np.arange(203), sizes, 10, nb_buckets=4)
+    samples = np.concatenate(batches)
+
+    # Full batches only, every sample at most once
+    assert all(len(batch) == 10 for batch in batches)
+    assert len(np.unique(samples)) == len(samples) == 200
+    # Batches of the same bucket span less sizes than random batches
+    spread = np.mean([np.ptp(sizes[batch]) for batch in batches])
+    random_spread = np.mean([np.ptp(sizes[batch]) for batch in np.split(np.random.permutation(200), 20)])
+    assert spread < random_spread
+
+
+def test_bucket_batches_budget():
+    sizes = np.random.RandomState(0).randint(1, 50, 200)
+    batches = bucket_batches(np.arange(200), sizes, 10, nb_buckets=4, node_budget=5000)
+
+    assert sorted(np.concatenate(batches).tolist()) == list(range(200))
+    for batch in batches:
+        if len(batch) > 1:
+            assert batch_cost(len(batch), sizes[batch].max()) <= 5000
+
+
+def test_sorted_batches():
+    X, _, _ = random_events(100)
+    batches = get_batches(100, 10, X, sort_batch=True)
+    sizes = _sizes(X)
+
+    assert sorted(np.concatenate(batches).tolist()) == list(range(100))
+    for first, second in zip(batches[:-1], batches[1:]):
+        assert sizes[first].max() <= sizes[second].min()
+
+
+def test_block_shuffle():
+    idx = block_shuffle(100, 10, 1)
+
+    assert sorted(idx.tolist()) == list(range(100))
+    # Blocks of consecutive samples
+    assert all((np.diff(idx[i:i+10]) == 1).all() for i in range(0, 100, 10))
+
+
+def test_alias_sampling():
+    np.random.seed(0)
+    weights = np.array([1., 0., 3., 6.])
+    draws = sample_alias(alias_table(weights), 100000)
+
+    frequencies = np.bincount(draws, minlength=4) / len(draws)
+    assert np.allclose(frequencies, weights / weights.sum(), atol=0.01)
+    with pytest.raises(ValueError):
+        alias_table([0., 0.])
+
+
+def test_sampled_batches():
+    X, _, w = random_events(100)
+    batches = get_sampled_batches(100, 10, X, alias_table(w))
+
+    assert len(batches) == 10
+    assert all(len(batch) == 10 and (np.diff(batch) >= 0).all() for batch in batches)
+
+
+@pytest.mark.parametrize('depth', [0, 3])
+def test_prefetcher_order(depth):
+    batches = (np.arange(i, i + 3) for i in range(20))
+    prefetched = Prefetcher(batches, lambda batch: batch * 2, depth=depth, nb_workers=2)
+
+    assert [list(batch) for batch in prefetched] == [list(np.arange(i, i + 3) * 2) for i in range(20)]
+
+
+def test_prefetcher_errors():
+    def batches():
+        yield 1
+        raise IOError('read failed')
+
+    prefetched = iter(Prefetcher(batches(), lambda b: b, depth=2))
+    assert next(prefetched) == 1
+    with pytest.raises(IOError):
+        next(prefetched)
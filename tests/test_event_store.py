@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from conftest import random_events
+from loading.data.codec import FeatureCodec
+from loading.data.event_store import write_event_store, load_event_store
+
+
+def test_store_round_trip(tmp_path):
+    X, y, w = random_events(50)
+    write_event_store(str(tmp_path / 'store'), X, y, w)
+    X_, y_, w_ = load_event_store(str(tmp_path / 'store'), 1000)
+
+    assert len(X_) == len(X)
+    assert (np.asarray(X_.nb_nodes) == [x.shape[1] for x in X]).all()
+    for x, x_ in zip(X, X_):
+        assert x_.shape == x.shape
+        assert (x_ == x).all()
+    assert (y_ == y).all()
+    assert np.allclose(w_, w)
+
+
+def test_store_first_events(tmp_path):
+    X, y, w = random_events(50)
+    write_event_store(str(tmp_path / 'store'), X, y, w)
+    X_, y_, _ = load_event_store(str(tmp_path / 'store'), 10)
+
+    assert len(X_) == 10
+    assert all((x_ == x).all() for x, x_ in zip(X[:10], X_))
+    assert (y_ == y[:10]).all()
+
+
+def test_store_random_subset(tmp_path):
+    X, _, _ = random_events(200)
+    for i, x in enumerate(X):
+        x[0, 0] = i  # event ID
+    # Labels grouped in store order, as NERSC stores are
+    y = np.repeat([1, 0], 100)
+    w = np.arange(200.)
+    write_event_store(str(tmp_path / 'store'), X, y, w)
+    X_, y_, w_ = load_event_store(str(tmp_path / 'store'), 50, shuffle=True)
+
+    ids = np.array([x[0, 0] for x in X_]).astype(int)
+    assert len(np.unique(ids)) == 50
+    assert (w_ == ids).all()
+    assert (y_ == y[ids]).all()
+    assert all((x_ == X[i]).all() for i, x_ in zip(ids, X_))
+    # Returned in random order, not in store order
+    assert not (np.diff(ids) > 0).all()
+
+
+def test_store_slices(tmp_path):
+    X, y, w = random_events(30)
+    write_event_store(str(tmp_path / 'store'), X, y, w)
+    X_, _, _ = load_event_store(str(tmp_path / 'store'), 30)
+
+    idx = np.array([3, 17, 0, 29])
+    subset = X_[idx]
+    assert len(subset) == len(idx)
+    assert all((x_ == X[i]).all() for i, x_ in zip(idx, subset))
+
+
+@pytest.mark.parametrize('dtype, log_columns, rtol', [
+                         ('float32', (), 0),
+                         ('float16', (), 1e-3),
+                         ('float16', (0, 4), 5e-3),  # half precision of log(x)
+                         ('int16', (), 1e-3),
+                         ('int16', (0, 4), 1e-3),
+                         ])
+def test_codec_round_trip(tmp_path, dtype, log_columns, rtol):
+    X, y, w = random_events(40)
+    X = [x * np.array([[100.], [1.], [1.], [100.], [100.], [1.]], dtype=np.float32) for x in X]
+    codec = FeatureCodec(dtype, log_columns)
+    write_event_store(str(tmp_path / 'store'), X, y, w, codec)
+    X_, _, _ = load_event_store(str(tmp_path / 'store'), 40)
+
+    assert np.asarray(X_.features).dtype == np.dtype(dtype)
+    span = np.concatenate(X, axis=1).max(axis=1, keepdims=True)
+    for x, x_ in zip(X, X_):
+        assert x_.dtype == np.float32
+        assert x_.shape == x.shape
+        if dtype == 'int16' and not log_columns:
+            # Quantization error is relative to the range of each feature
+            assert (np.abs(x_ - x) <= rtol * span).all()
+        else:
+            assert np.allclose(x_, x, rtol=rtol, atol=1e-6)
+
+
+def test_codec_meta_round_trip():
+    X, _, _ = random_events(10)
+    codec = FeatureCodec('int16', (0, 4)).fit(X)
+    codec_ = FeatureCodec.from_meta({'codec': codec.to_meta(), 'dtype': codec.dtype.str})
+
+    assert codec_.spec == codec.spec
+    nodes = X[0].transpose()
+    assert (codec_.encode(nodes) == codec.encode(nodes)).all()
+
+
+def test_float16_overflow():
+    with pytest.raises(ValueError):
+        FeatureCodec('float16').encode(np.array([[1e6]], dtype=np.float32))
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+import torch
+
+from conftest import random_events
+from data_ops.batching import collate
+from model.build_model import init_network
+from model.kernels.general import Gaussian, GaussianSoftmax, DistMult
+from model.kernels.physics import QCDAware, QCDAwareMeanNorm
+from utils.packed import PackedGraphs
+import utils.tensor as ts
+
+
+def _batches(nb_events=5, phi=False):
+    X, y, w = random_events(nb_events)
+    if phi:
+        rng = np.random.RandomState(1)
+        for x in X:
+            x[2] = rng.uniform(-np.pi, np.pi, x.shape[1])
+    padded, sizes, _, _ = collate(X, y, w)
+    packed, _, _, _ = collate(X, y, w, packed=True)
+    sizes = torch.from_numpy(sizes.astype(np.float32))
+    return torch.from_numpy(padded), torch.from_numpy(packed), sizes
+
+
+def _edges(adj, sizes):
+    """Edge values of a padded adjacency, in packed order"""
+    return torch.cat([a[:n, :n].reshape(-1) for a, n in zip(adj, sizes.long().tolist())])
+
+
+def test_packed_graphs():
+    graphs = PackedGraphs(torch.tensor([2., 1., 3.]))
+
+    assert graphs.nb_nodes_total == 6
+    assert graphs.nb_edges == 4 + 1 + 9
+    assert graphs.node_graph.tolist() == [0, 0, 1, 2, 2, 2]
+    assert graphs.offsets.tolist() == [0, 2, 3]
+    assert graphs.src[:5].tolist() == [0, 0, 1, 1, 2]
+    assert graphs.dst[:5].tolist() == [0, 1, 0, 1, 2]
+    # Edges stay within their graph
+    assert (graphs.node_graph[graphs.src] == graphs.node_graph[graphs.dst]).all()
+
+
+def test_packed_reductions():
+    padded, packed, sizes = _batches()
+    graphs = PackedGraphs(sizes)
+
+    assert torch.allclose(graphs.sum_nodes(packed), padded.sum(1), atol=1e-5)
+    assert torch.allclose(graphs.mean_nodes(packed), padded.sum(1) / sizes.unsqueeze(1), atol=1e-5)
+    adj = torch.rand(len(sizes), padded.size(1), padded.size(1))
+    spread = torch.cat([(a[:n, :n] @ x[:n]) for a, x, n in zip(adj, padded, sizes.long().tolist())])
+    assert torch.allclose(graphs.spread(_edges(adj, sizes), packed), spread, atol=1e-5)
+
+
+def test_periodic_sqdist():
+    padded, packed, sizes = _batches(phi=True)
+    graphs = PackedGraphs(sizes)
+    sqdist = ts.sqdist_periodic_(padded)
+
+    assert torch.allclose(_edges(sqdist, sizes), graphs.edge_sqdist(packed, [1, 2], periodic_coord=2), atol=1e-5)
+    # Phi differences are wrapped
+    assert sqdist.max() <= (padded[..., 1].max() - padded[..., 1].min()) ** 2 + np.pi ** 2 + 1e-5
+
+
+@pytest.mark.parametrize('make_kernel', [
+                         lambda: Gaussian(spatial_coords=[1, 2]),
+                         lambda: Gaussian(),
+                         lambda: GaussianSoftmax(spatial_coords=[1, 2]),
+                         lambda: DistMult(6),
+                         lambda: QCDAwareMeanNorm(6, 1.0, 0.7),
+                         lambda: QCDAwareMeanNorm(6, 1.0, 0.7, periodic=True),
+                         ])
+def test_kernel_packed_equals_padded(make_kernel):
+    torch.manual_seed(0)
+    kernel = make_kernel()
+    padded, packed, sizes = _batches(phi=True)
+    padded_in, packed_in = padded.clone(), packed.clone()
+
+    adj_padded = kernel(None, padded, batch_nb_nodes=sizes)
+    adj_packed = kernel(None, packed, batch_nb_nodes=PackedGraphs(sizes))
+
+    assert torch.allclose(_edges(adj_padded, sizes), adj_packed, atol=1e-5)
+    # Inputs are left as they are
+    assert torch.equal(padded, padded_in) and torch.equal(packed, packed_in)
+
+
+@pytest.mark.parametrize('kernel', ['QCDAwareMeanNorm', 'Gaussian'])
+def test_gnn_packed_equals_padded(model_args, kernel):
+    model_args('--data', 'NERSC', '--kernels', kernel, '--combine_kernels', 'Affine', '--fm', '8', '--depth', '3')
+    torch.manual_seed(0)
+    net = init_network().eval()
+    padded, packed, sizes = _batches(phi=True)
+
+    with torch.no_grad():
+        assert torch.allclose(net(padded, sizes), net(packed, sizes), atol=1e-5)
+
+
+@pytest.mark.parametrize('momenta_stdev', [None, 0.5])
+def test_qcdaware_momentum_scale(momenta_stdev):
+    padded, _, sizes = _batches()
+    kernel = QCDAware(6, 1.0, 0.7, momenta_stdev=momenta_stdev, spatial_coords=[1, 2])
+    padded_in = padded.clone()
+    adj = kernel(None, padded, batch_nb_nodes=sizes)
+
+    scale = kernel.state_dict()['init_momenta_stdev']
+    if momenta_stdev is None:
+        expected = (padded[..., 4] ** 2).sum() / sizes.sum()
+        assert torch.allclose(scale, expected.sqrt().view(1))
+    else:
+        assert scale.item() == momenta_stdev
+    assert torch.equal(padded, padded_in)
+    # Rows of real nodes sum to 1, padded rows and columns are 0
+    for a, n in zip(adj, sizes.long().tolist()):
+        assert torch.allclose(a[:n].sum(1), torch.ones(n), atol=1e-5)
+        assert (a[n:] == 0).all() and (a[:, n:] == 0).all()
+
+    restored = QCDAware(6, 1.0, 0.7)
+    restored.load_state_dict(kernel.state_dict())
+    assert torch.allclose(restored(None, padded, batch_nb_nodes=sizes), adj)
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import pytest
+import torch
+
+from conftest import random_events
+import train_model as model
+from experiment_handler import train_model
+from graphics.roccurve import ROCCurve
+from model.build_model import init_network
+from loading.model.checkpoint import checkpoint_path, load_checkpoint
+
+
+_small = ['--nb_batch', '8', '--fm', '8', '--depth', '2', '--nbtest', '40',
+          '--kernels', 'QCDAwareMeanNorm', '--combine_kernels', 'Affine']
+
+
+def _net(model_args, *argv):
+    args = model_args(*(_small + list(argv)))
+    args.nbtrain = 80
+    os.makedirs(args.savedir, exist_ok=True)
+    torch.manual_seed(0)
+    return args, init_network()
+
+
+def test_test_net(model_args):
+    _, net = _net(model_args)
+    X, y, w = random_events(40)
+    auc, loss, inv_fpr, _ = model.test_net(net, X, y, w, torch.nn.functional.binary_cross_entropy, ROCCurve('test'))
+
+    assert 0 <= auc <= 1
+    assert np.isfinite(loss) and loss > 0
+
+
+@pytest.mark.parametrize('argv', [
+                         [],
+                         ['--node_budget', '500'],
+                         ['--bucketed_training', '3'],
+                         ['--packed_batches'],
+                         ['--batch_store'],
+                         ['--weight_sampling'],
+                         ['--prefetch', '0'],
+                         ])
+def test_train_net(model_args, argv):
+    _, net = _net(model_args, *argv)
+    X, y, w = random_events(80)
+    optimizer = torch.optim.Adamax(net.parameters(), lr=0.005)
+    if '--batch_store' in argv:
+        X = model.get_batch_store(X, 'train')
+    sampling = model.get_sampling_table(w) if '--weight_sampling' in argv else None
+    before = [p.detach().clone() for p in net.parameters()]
+    loss = model.train_net(net, X, y, w, torch.nn.functional.binary_cross_entropy, optimizer, sampling=sampling)
+
+    assert np.isfinite(loss) and loss > 0
+    assert any(not torch.equal(b, p) for b, p in zip(before, net.parameters()))
+
+
+def test_train_and_resume(model_args):
+    args = model_args(*(_small + ['--nbepoch', '1', '--checkpoint']))
+    args.nbtrain = 80
+    os.makedirs(args.savedir)
+    data = random_events(80) + random_events(40, seed=1)
+    train_model(*data)
+
+    path = checkpoint_path(args.savedir, args.name)
+    assert load_checkpoint(path)['epoch'] == 1
+    # Resumes from the checkpoint for a second epoch
+    args.nbepoch = 2
+    train_model(*data)
+    assert load_checkpoint(path)['epoch'] == 2